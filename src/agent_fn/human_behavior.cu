@@ -104,8 +104,19 @@ FLAMEGPU_AGENT_FUNCTION(human_behavior, flamegpu::MessageNone, flamegpu::Message
         auto resource_id = FLAMEGPU->getVariable<flamegpu::id_t, N_RESOURCE_TYPES>(
             "closest_resource_id", resource_type);
         // printf("collecting x=%d, y=%d\n", resource_x, resource_y);
-        FLAMEGPU->setVariable<int, N_DIM>("ana_last_resource_location", 0, resource_x);
-        FLAMEGPU->setVariable<int, N_DIM>("ana_last_resource_location", 1, resource_y);
+        // output the collection event of the step, see sx.make_step_summary
+        const int event[N_EVENT_COLUMNS] = {
+            static_cast<int>(FLAMEGPU->getStepCounter()),
+            static_cast<int>(FLAMEGPU->getID()),
+            static_cast<int>(resource_id),
+            resource_x,
+            resource_y,
+            resource_type,
+        };
+        for (unsigned int column = 0; column < N_EVENT_COLUMNS; column++) {
+            FLAMEGPU->agent_out.setVariable<int, N_EVENT_COLUMNS>("event", column,
+                                                                  event[column]);
+        }
         FLAMEGPU->message_out.setVariable<int>("amount", 1);
         FLAMEGPU->message_out.setKey(resource_id); // bucket of resource that is collected
     };
@@ -153,10 +164,6 @@ FLAMEGPU_AGENT_FUNCTION(human_behavior, flamegpu::MessageNone, flamegpu::Message
         }
     }
 
-    // reset analysis data
-    FLAMEGPU->setVariable<int, N_DIM>("ana_last_resource_location", 0, -1);
-    FLAMEGPU->setVariable<int, N_DIM>("ana_last_resource_location", 1, -1);
-
     // GOAP algorithm
     int scores[Action::EOF];
     memset(&scores, 0, Action::EOF * sizeof(int));
@@ -223,9 +230,13 @@ FLAMEGPU_AGENT_FUNCTION(human_behavior, flamegpu::MessageNone, flamegpu::Message
     FLAMEGPU->setVariable<int>("y", y);
     FLAMEGPU->setVariable<float>("actionpotential", ap);
     FLAMEGPU->setVariable<int>("hunger", hunger);
+    // totals of the surviving humans, see sx.make_step_summary
+    auto resource_totals =
+        FLAMEGPU->environment.getMacroProperty<int, N_RESOURCE_TYPES>("resource_totals");
     for (int resource_type = 0; resource_type < N_RESOURCE_TYPES; resource_type++) {
         FLAMEGPU->setVariable<int, N_RESOURCE_TYPES>("resources", resource_type,
                                                      resources[resource_type]);
+        resource_totals[resource_type] += resources[resource_type];
     }
     return flamegpu::ALIVE;
 }
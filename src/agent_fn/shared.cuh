@@ -5,3 +5,5 @@ FLAMEGPU_DEVICE_FUNCTION float vec2Dist(int x, int y, int xo, int yo) {
 
 constexpr int N_RESOURCE_TYPES = 2;
 constexpr int N_DIM = 2;
+// see util.COLLECTION_EVENT_COLUMNS
+constexpr unsigned int N_EVENT_COLUMNS = 6;
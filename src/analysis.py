@@ -12,12 +12,20 @@ import optuna
 from pprint import pp
 import yaml
 
+import cache
 import optimal_transport as solver
+import parallel
 import util
 
 
 # FIG_TYPE = 'svg'
 FIG_TYPE = "pdf"
+# ABM backend: "cuda" or "cpu" (no GPU required), see sx.make_simulation
+BACKEND = os.getenv("SX_BACKEND", "cuda")
+# root seed of the randomly generated problems, see parallel.task_seed
+SEED = int(os.getenv("SX_SEED", "0"))
+# results of the solvers, see cache.Cache for the SX_CACHE* variables
+CACHE = cache.Cache()
 
 plt.rcParams.update(
     {
@@ -106,7 +114,7 @@ tex = {}
 
 
 def analyze_ot_with_sinkhorn(xs, xt, SCALE):
-    sinkhorn, sinkhorn_meta = solver.solve_ot_with_sinkhorn(xs, xt, SCALE=SCALE)
+    sinkhorn, sinkhorn_meta = solve_ot_with_sinkhorn(xs, xt, SCALE=SCALE)
 
     def plot_ot(meta, xs, xt, solution, file=""):
         # rows and columns
@@ -197,7 +205,9 @@ def analyze_ot_with_sinkhorn(xs, xt, SCALE):
 
 
 def optimal_parameter_metrics(xs, xt, conf, sinkhorn):
-    abm, abm_meta = solver.solve_ot_with_abm(xs, xt, **conf)
+    [(abm, abm_meta)] = _solve_ot_with_abm_sequence(
+        [(xs, xt)], [{**conf, "record": "metrics"}]
+    )
     abm = util.doubly_stochastic(abm)
     result = solver.compare(xs, xt, abm, sinkhorn)
     diff = np.abs(result.loss_abm - result.loss_ot) / result.loss_ot * 100
@@ -224,15 +234,93 @@ def optimal_parameter_metrics(xs, xt, conf, sinkhorn):
     plt.clf()
 
 
+def generate_distributions(seed, SCALE):
+    """generate_distributions generates distributions, drawing all random
+    numbers from `seed`."""
+    parallel.seed_all(seed)
+    return solver.generate_distributions(SCALE=SCALE)
+
+
+def generate_problems(name, n, SCALE):
+    """generate_problems generates the distributions of the tasks
+    (name, 0..n-1) in parallel and solves them in one batch with sinkhorn, the
+    result does not depend on the number of workers.
+
+    Returns: list of ((xs, xt), sinkhorn, sinkhorn_meta)
+    """
+    seeds = [parallel.task_seed(SEED, name, i) for i in range(n)]
+    distributions = parallel.parallel_map(generate_distributions, seeds, [SCALE] * n)
+    parallel.seed_all(parallel.task_seed(SEED, name, "sinkhorn"))
+    solutions = CACHE.cached(solver.solve_ot_with_sinkhorn_batch, random_state=True)(
+        distributions, SCALE=SCALE
+    )
+    return [(d, *solution) for d, solution in zip(distributions, solutions)]
+
+
+def solve_ot_with_sinkhorn(*args, **kwargs):
+    """solve_ot_with_sinkhorn is solver.solve_ot_with_sinkhorn, cached in
+    CACHE. The jiggle draws from numpy's global generator, its state is part
+    of the key."""
+    return CACHE.cached(solver.solve_ot_with_sinkhorn, random_state=True)(
+        *args, **kwargs
+    )
+
+
+def _abm_cache_key(distribution, conf):
+    # runs writing their paths to disk are not cached, the store may change
+    if conf.get("record_path") is not None:
+        return None
+    return CACHE.key(distribution, conf)
+
+
+def _solve_ot_with_abm_sequence(distributions, confs):
+    keys = [_abm_cache_key(d, c) for d, c in zip(distributions, confs)]
+    results = [None if key is None else CACHE.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results
+    distributions = [distributions[i] for i in missing]
+    confs = [confs[i] for i in missing]
+    if BACKEND == "cpu":
+        solutions = solver.solve_ot_with_abm_ensemble(distributions, confs)
+    else:
+        solutions = [
+            solver.solve_ot_with_abm(*d, **c) for d, c in zip(distributions, confs)
+        ]
+    for i, solution in zip(missing, solutions):
+        results[i] = solution
+        if keys[i] is not None:
+            CACHE.put(keys[i], solution)
+    return results
+
+
+def solve_ot_with_abm_many(distributions, confs):
+    """solve_ot_with_abm_many solves every distribution with its config. The
+    runs are split over parallel.WORKERS processes, each running its share on
+    the CPU backend as a single ensemble. Runs found in CACHE are not
+    repeated."""
+    tasks = parallel.split(range(len(distributions)), parallel.WORKERS)
+    results = parallel.parallel_map(
+        _solve_ot_with_abm_sequence,
+        [[distributions[i] for i in task] for task in tasks],
+        [[confs[i] for i in task] for task in tasks],
+    )
+    return [result for task in results for result in task]
+
+
 def analyze_optimality(conf, SCALE, n_samples=5):
     diffs = []
-    distributions = []
-    for _ in range(n_samples):
-        xs, xt = solver.generate_distributions(SCALE=SCALE)
-        distributions.append((xs, xt))
-        sinkhorn, sinkhorn_meta = solver.solve_ot_with_sinkhorn(xs, xt, SCALE=SCALE)
-        abm, abm_meta = solver.solve_ot_with_abm(xs, xt, **conf)
-        abm = util.doubly_stochastic(abm)
+    problems = generate_problems("optimality", n_samples, SCALE)
+    distributions = [distribution for distribution, _, _ in problems]
+    sinkhorns = [sinkhorn for _, sinkhorn, _ in problems]
+    # only the paths of the last run are plotted, from an on-disk store
+    confs = [{**conf, "record": "events"}] * (n_samples - 1)
+    confs.append({**conf, "record_path": "output/abm-optimality-paths"})
+    abms = solve_ot_with_abm_many(distributions, confs)
+    plans = util.doubly_stochastic(np.stack([abm for abm, _ in abms]))
+    for (xs, xt), sinkhorn, abm, (_, abm_meta) in zip(
+        distributions, sinkhorns, plans, abms
+    ):
         result = solver.compare(xs, xt, abm, sinkhorn)
         diff = np.abs(result.loss_abm - result.loss_ot) / result.loss_ot * 100
         diffs.append(diff)
@@ -248,7 +336,18 @@ def analyze_optimality(conf, SCALE, n_samples=5):
         pickle.dump({"distributions": distributions}, fd)
 
 
-def analyze_convergence(xs, xt, sinkhorn, input_config):
+# what the cost matrix of a window of analyze_convergence contains
+CONVERGENCE_WINDOWS = {
+    # only the collections of the steps (i, j), transports crossing the window
+    # borders are cut (the published numbers)
+    "filtered": lambda index, i, j: index.filtered_cost_matrix(i, j),
+    # the transports completed in the steps [i, j), with their weights in the
+    # whole run
+    "completed": lambda index, i, j: index.cost_matrix(i, j),
+}
+
+
+def analyze_convergence(xs, xt, sinkhorn, input_config, windows="filtered"):
 
     def no_axis_ticks(p):
         p.tick_params(
@@ -256,13 +355,17 @@ def analyze_convergence(xs, xt, sinkhorn, input_config):
         )
         p.tick_params(axis="y", which="both", right=False, left=False, labelleft=False)
 
+    if windows not in CONVERGENCE_WINDOWS:
+        raise RuntimeError(f"unknown convergence windows: {windows}")
     steps = 6000  # 12000
     tex["ConvergenceStepsTotal"] = steps
+    tex["ConvergenceWindows"] = windows
     steps_per_plot = 1000  # 2000
 
     config = input_config.copy()
     config["steps"] = steps
     config["hunger_starved_to_death"] = steps  # no human should die here
+    config["record"] = "events"
 
     N_plots = int(steps / steps_per_plot)
     if N_plots % 2 != 0:
@@ -270,9 +373,11 @@ def analyze_convergence(xs, xt, sinkhorn, input_config):
             f"should pick an even number of step intervals to analyze steps/steps_per_plot = {steps}/{steps_per_plot} = {N_plots}"
         )
 
-    abm, abm_meta = solver.solve_ot_with_abm(xs, xt, **config)
+    [(abm, abm_meta)] = _solve_ot_with_abm_sequence([(xs, xt)], [config])
     abm = util.doubly_stochastic(abm)
-    total_result = solver.compare(xs, xt, abm, sinkhorn)
+    # the cost matrix is shared by all comparisons below
+    problem = solver.Problem(xs, xt)
+    total_result = solver.compare(problem, None, abm, sinkhorn)
 
     # plot the whole thing
     plt.figure(figsize=SIZE_2x1)  # Adjust the figure size as needed
@@ -301,18 +406,20 @@ def analyze_convergence(xs, xt, sinkhorn, input_config):
     plt.figure(figsize=SIZE_Nx2)  # Adjust the figure size as needed
     conv_loss = []
     conv_loss_diff = []
-    for n in range(N_plots):
-        i, j = n * steps_per_plot, (n + 1) * steps_per_plot
-        all_resources = abm_meta["collected_resources"]
-        collected_resources = all_resources[
-            (all_resources[:, 0] > i) & (all_resources[:, 0] < j)
-        ]
-        partial = util.collected_resource_list_to_cost_matrix(
-            collected_resources[:, 1:], xs, xt
+    index = util.CostMatrixIndex(abm_meta["collected_resources"], xs, xt)
+    window_cost_matrix = CONVERGENCE_WINDOWS[windows]
+    bounds = [(n * steps_per_plot, (n + 1) * steps_per_plot) for n in range(N_plots)]
+    partials = util.doubly_stochastic(
+        np.stack([window_cost_matrix(index, i, j) for i, j in bounds])
+    )
+    result = solver.compare(problem, None, partials, sinkhorn)
+    for n, ((i, j), partial) in enumerate(zip(bounds, partials)):
+        collected_resources = (
+            index.events_between(i + 1, j)
+            if windows == "filtered"
+            else index.events_between(i, j)
         )
-        partial = util.doubly_stochastic(partial)
-        result = solver.compare(xs, xt, partial, sinkhorn)
-        loss = result.loss_abm
+        loss = result.loss_abm[n]
         tex["ConvergenceLoss" + "i" * n] = round(loss, 2)
         conv_loss.append(loss)
         loss_diff = (
@@ -349,6 +456,7 @@ def analyze_convergence(xs, xt, sinkhorn, input_config):
             {
                 "conv_loss": conv_loss,
                 "conv_loss_diff": conv_loss_diff,
+                "windows": windows,
                 "total_result": total_result,
             },
             fd,
@@ -373,24 +481,30 @@ def analyze_optimality2(trialdb, SCALE, N_tests=5, M_top=5):
         return unique_trials[:n]
 
     data = []
-    sinkhorn_solutions = []
     confs = []
-    distributions = []
-    for i in range(N_tests):
-        xs, xt = solver.generate_distributions(SCALE=SCALE)
-        distributions.append((xs, xt))
-        data.append([])
-        sinkhorn, sinkhorn_meta = solver.solve_ot_with_sinkhorn(xs, xt, SCALE=SCALE)
-        sinkhorn_solutions.append((sinkhorn, sinkhorn_meta))
-        for trial in top(study, M_top):
-            conf = trial.params
-            conf["seed"] = 2
-            conf["hunger_starved_to_death"] = 6000
-            abm, abm_meta = solver.solve_ot_with_abm(xs, xt, **conf)
-            abm = util.doubly_stochastic(abm)
-            result = solver.compare(xs, xt, abm, sinkhorn)
-            diff = np.abs(result.loss_abm - result.loss_ot) / result.loss_ot * 100
-            data[-1].append(diff)
+    problems = generate_problems("optimality2", N_tests, SCALE)
+    distributions = [distribution for distribution, _, _ in problems]
+    sinkhorn_solutions = [(sinkhorn, meta) for _, sinkhorn, meta in problems]
+    abm_confs = []
+    for trial in top(study, M_top):
+        conf = trial.params
+        conf["seed"] = 2
+        conf["hunger_starved_to_death"] = 6000
+        conf["backend"] = BACKEND
+        conf["record"] = "metrics"
+        abm_confs.append(conf)
+    abms = solve_ot_with_abm_many(
+        [d for d in distributions for _ in abm_confs],
+        [c for _ in distributions for c in abm_confs],
+    )
+    M = len(abm_confs)
+    plans = util.doubly_stochastic(np.stack([abm for abm, _ in abms]))
+    for i, ((xs, xt), (sinkhorn, _)) in enumerate(
+        zip(distributions, sinkhorn_solutions)
+    ):
+        result = solver.compare(xs, xt, plans[i * M : (i + 1) * M], sinkhorn)
+        diff = np.abs(result.loss_abm - result.loss_ot) / result.loss_ot * 100
+        data.append(list(diff))
     for trial in top(study, M_top):
         confs.append(trial.params)
     with open("output/abm-optimality-of-top-hyperparameter-sets.pickle", "wb") as fd:
@@ -435,6 +549,7 @@ if __name__ == "__main__":
     hyperparam_optimization_results["seed"] = 2
     for key, value in hyperparam_optimization_results.items():
         tex[key.replace("_", "")] = value
+    hyperparam_optimization_results["backend"] = BACKEND
     optimal_parameter_metrics(xs, xt, hyperparam_optimization_results, sinkhorn)
 
     print(f"optimality: comparison with sinkhorn")
@@ -5,6 +5,9 @@ import io
 import pytest
 import numpy as np
 
+import analysis
+import cache
+import parallel
 from analysis import _dump_yaml, analyze_optimality2
 
 
@@ -60,3 +63,49 @@ def test_dump_yaml(tex, expected):
 # def test_dumpdata():
 #    with open("output/abm-convergence-parts.pickle", "wb") as fd:
 #        pickle.dump({"conv_loss": [1, 2, 3], "conv_loss_diff": np.array([0.1, 1e-3])}, fd)
+
+
+def test_solve_ot_with_abm_many_independent_of_workers(monkeypatch):
+    monkeypatch.setattr(analysis, "BACKEND", "cpu")
+    # workers are spawned and read the environment
+    monkeypatch.setenv("SX_CACHE", "0")
+    monkeypatch.setattr(analysis, "CACHE", cache.Cache(enabled=False))
+    confs = [
+        {"n_humans": 5, "steps": 30, "seed": i, "backend": "cpu"} for i in range(3)
+    ]
+    results = []
+    for workers in [1, 2]:
+        monkeypatch.setattr(parallel, "WORKERS", workers)
+        problems = analysis.generate_problems("test", 3, SCALE=5)
+        distributions = [distribution for distribution, _, _ in problems]
+        abms = analysis.solve_ot_with_abm_many(distributions, confs)
+        results.append((distributions, abms))
+    (exp_distributions, exp_abms), (distributions, abms) = results
+    for (xs, xt), (exp_xs, exp_xt) in zip(distributions, exp_distributions):
+        assert (xs == exp_xs).all() and (xt == exp_xt).all()
+    for (M, meta), (exp_M, exp_meta) in zip(abms, exp_abms):
+        assert (M == exp_M).all()
+        assert (meta["paths"] == exp_meta["paths"]).all()
+
+
+def test_solve_ot_with_abm_many_cached(monkeypatch, tmp_path):
+    monkeypatch.setattr(analysis, "BACKEND", "cpu")
+    monkeypatch.setattr(parallel, "WORKERS", 1)
+    monkeypatch.setattr(analysis, "CACHE", cache.Cache(tmp_path))
+    problems = analysis.generate_problems("test", 2, SCALE=5)
+    assert len(list(tmp_path.iterdir())) == 1, "sinkhorn solutions"
+    for (_, sinkhorn, _), (_, exp_sinkhorn, _) in zip(
+        analysis.generate_problems("test", 2, SCALE=5), problems
+    ):
+        assert (sinkhorn == exp_sinkhorn).all()
+    assert len(list(tmp_path.iterdir())) == 1, "hit"
+    distributions = [distribution for distribution, _, _ in problems]
+    confs = [{"n_humans": 5, "steps": 30, "seed": 1, "backend": "cpu"}] * 2
+    exp = analysis.solve_ot_with_abm_many(distributions, confs)
+    assert len(list(tmp_path.iterdir())) == 3
+    monkeypatch.setattr(analysis.solver, "solve_ot_with_abm_ensemble", None)
+    for (M, meta), (exp_M, exp_meta) in zip(
+        analysis.solve_ot_with_abm_many(distributions, confs), exp
+    ):
+        assert (M == exp_M).all()
+        assert (meta["paths"] == exp_meta["paths"]).all()
@@ -0,0 +1,204 @@
+"""Content-addressed on-disk cache of solver results.
+
+An entry is keyed on a hash of the inputs (arrays, keyword arguments, seeds)
+and a fingerprint of the model and solver sources, so a change to the model,
+the solvers or the inputs is a cache miss. The directory is bounded in size,
+the least recently used entries are evicted first.
+"""
+
+import collections.abc
+import functools
+import glob
+import hashlib
+import inspect
+import os
+import pickle
+import random
+import tempfile
+
+import numpy as np
+
+from optimal_transport import Problem
+
+# directory of the cache entries
+CACHE_DIR = os.getenv("SX_CACHE_DIR", "output/cache")
+# size limit of CACHE_DIR in bytes
+CACHE_MAX_BYTES = int(os.getenv("SX_CACHE_MAX_BYTES", str(4 << 30)))
+# SX_CACHE=0 bypasses the cache, nothing is read or written
+CACHE = os.getenv("SX_CACHE", "1") != "0"
+# sources of the model, relative to this file, a change invalidates all entries
+MODEL_SOURCES = ["sx.py", "sx_cpu.py", "perception.py", "agent_fn/*"]
+# sources turning model runs and problems into the cached results
+SOLVER_SOURCES = [
+    "optimal_transport.py",
+    "util.py",
+    "recorder.py",
+    "trajectories.py",
+    "sinkhorn.py",
+]
+# directory the sources are relative to
+SOURCE_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+# types whose repr is their canonical representation
+SCALARS = (type(None), bool, int, float, complex, str, bytes, np.generic)
+
+
+def _update(h, obj):
+    """_update feeds a canonical representation of `obj` into the hash `h`,
+    it raises TypeError for objects without one."""
+    if isinstance(obj, np.ndarray):
+        h.update(f"ndarray{obj.dtype.str}{obj.shape}".encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, SCALARS):
+        h.update(repr(obj).encode())
+    elif isinstance(obj, Problem):
+        h.update(b"Problem")
+        _update(h, (obj.xs, obj.xt, obj.a, obj.b))
+    elif isinstance(obj, collections.abc.Mapping):
+        # dicts, OpenStructs and Constants with equal items are equal
+        h.update(f"mapping{len(obj)}".encode())
+        for key in sorted(obj, key=repr):
+            _update(h, key)
+            _update(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"{type(obj).__name__}{len(obj)}".encode())
+        for item in obj:
+            _update(h, item)
+    elif callable(obj) and hasattr(obj, "__qualname__"):
+        # functions and classes by name, not instances with a __call__
+        h.update(f"{obj.__module__}.{obj.__qualname__}".encode())
+    else:
+        raise TypeError(f"no canonical representation of {type(obj).__name__}")
+    h.update(b";")
+
+
+def digest(*objs) -> str:
+    """digest returns the hex SHA-256 of `objs`, equal for equal contents."""
+    h = hashlib.sha256()
+    _update(h, objs)
+    return h.hexdigest()
+
+
+@functools.lru_cache
+def fingerprint(sources=tuple(MODEL_SOURCES + SOLVER_SOURCES), root=SOURCE_ROOT) -> str:
+    """fingerprint returns the digest of the files matching `sources` in
+    `root`, computed once per process."""
+    h = hashlib.sha256()
+    for pattern in sources:
+        for file in sorted(glob.glob(os.path.join(root, pattern))):
+            h.update(os.path.relpath(file, root).encode())
+            with open(file, "rb") as fd:
+                h.update(hashlib.sha256(fd.read()).digest())
+    return h.hexdigest()
+
+
+class Cache:
+    """Cache stores pickled values in `directory`, one file per key.
+
+    Arguments:
+        max_bytes (int): after a `put`, the least recently used entries are
+            removed until the directory is smaller
+        enabled (bool): False bypasses the cache, `get` always misses and
+            `put` does nothing
+        sources (list): model and solver sources, see fingerprint
+    """
+
+    def __init__(
+        self,
+        directory=CACHE_DIR,
+        max_bytes=CACHE_MAX_BYTES,
+        enabled=CACHE,
+        sources=MODEL_SOURCES + SOLVER_SOURCES,
+    ):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.fingerprint = fingerprint(tuple(sources))
+
+    def key(self, *parts) -> str:
+        """key returns the key of the inputs `parts` under the current model
+        and solver sources."""
+        return digest(self.fingerprint, *parts)
+
+    def _file(self, key):
+        return os.path.join(self.directory, f"{key}.pickle")
+
+    def get(self, key, default=None):
+        """get returns the value of `key`, or `default` on a miss."""
+        if not self.enabled:
+            return default
+        try:
+            with open(self._file(key), "rb") as fd:
+                value = pickle.load(fd)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return default
+        try:
+            # the modification time orders the entries for eviction
+            os.utime(self._file(key))
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """put stores `value` under `key` and evicts old entries."""
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # written under a temporary name, readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._file(key))
+        self.evict()
+
+    def evict(self):
+        """evict removes the least recently used entries until the directory
+        holds at most max_bytes."""
+        entries = []
+        for file in glob.glob(os.path.join(self.directory, "*.pickle")):
+            try:
+                stat = os.stat(file)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file))
+        size = sum(s for _, s, _ in entries)
+        for _, s, file in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            size -= s
+
+    def cached(self, fn, random_state=False):
+        """cached wraps `fn` so that its results are cached.
+
+        The key includes the source of `fn` and its arguments. The state of
+        the global random generators of `random` and numpy after the call is
+        stored with the result and restored on a hit, so code drawing random
+        numbers afterwards sees the same numbers.
+
+        Arguments:
+            random_state (bool): `fn` draws from the global random generators
+                without a seed argument, their state is part of the key
+        """
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            parts = [fn, inspect.getsource(fn), args, kwargs]
+            if random_state:
+                parts += [random.getstate(), np.random.get_state()]
+            key = self.key(*parts)
+            entry = self.get(key)
+            if entry is None:
+                value = fn(*args, **kwargs)
+                entry = (value, random.getstate(), np.random.get_state())
+                self.put(key, entry)
+            value, python_state, numpy_state = entry
+            random.setstate(python_state)
+            np.random.set_state(numpy_state)
+            return value
+
+        return wrapper
@@ -0,0 +1,100 @@
+import functools
+import os
+import random
+
+import numpy as np
+import ostruct
+import pytest
+
+import cache
+
+
+def test_digest():
+    x = np.arange(6)
+    assert cache.digest(x, {"a": 1, "b": 2}) == cache.digest(x.copy(), {"b": 2, "a": 1})
+    assert cache.digest(x) != cache.digest(x.astype("int32"))
+    assert cache.digest(x) != cache.digest(x.reshape(2, 3))
+    assert cache.digest(x, {"a": 1}) != cache.digest(x, {"a": 1.0})
+    assert cache.digest([1, 2]) != cache.digest((1, 2))
+    xs, xt = np.array([[0, 0], [1, 1]]), np.array([[5, 5]])
+    problem = cache.Problem(xs, xt)
+    assert cache.digest(problem) == cache.digest(cache.Problem(xs.copy(), xt.copy()))
+    assert cache.digest(problem) != cache.digest(cache.Problem(xs, xt + 1))
+    assert cache.digest(problem) != cache.digest(cache.Problem(xs, xt, a=[0.9, 0.1]))
+    assert cache.digest(ostruct.OpenStruct(a=1)) == cache.digest({"a": 1})
+    with pytest.raises(TypeError):
+        cache.digest(object())
+    with pytest.raises(TypeError):
+        cache.digest(functools.partial(print))
+
+
+def test_fingerprint(tmp_path):
+    assert cache.fingerprint(("sx.py",)) == cache.fingerprint(("sx.py",))
+    assert cache.fingerprint(("sx.py",)) != cache.fingerprint(("sx.py", "agent_fn/*"))
+    assert cache.Cache(tmp_path).key(1) != cache.Cache(tmp_path, sources=[]).key(1)
+
+
+@pytest.mark.parametrize("source", cache.SOLVER_SOURCES + ["sx.py"])
+def test_fingerprint_dependencies(tmp_path, source):
+    sources = tuple(cache.MODEL_SOURCES + cache.SOLVER_SOURCES)
+    for file in ["sx.py", "sx_cpu.py", "perception.py"] + cache.SOLVER_SOURCES:
+        (tmp_path / file).write_text(file)
+    before = cache.fingerprint(sources, str(tmp_path))
+    (tmp_path / source).write_text("edited")
+    cache.fingerprint.cache_clear()
+    assert cache.fingerprint(sources, str(tmp_path)) != before
+    assert cache.Cache(tmp_path).fingerprint == cache.fingerprint(sources)
+
+
+def test_get_put(tmp_path):
+    c = cache.Cache(tmp_path)
+    key = c.key(np.arange(3), {"seed": 1})
+    assert c.get(key) is None
+    c.put(key, {"M": np.eye(2)})
+    assert (c.get(key)["M"] == np.eye(2)).all()
+    assert c.get(c.key(np.arange(3), {"seed": 2}), "miss") == "miss"
+
+
+def test_bypass(tmp_path):
+    c = cache.Cache(tmp_path, enabled=False)
+    c.put("key", 1)
+    assert c.get("key") is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_evict_least_recently_used(tmp_path):
+    value = np.zeros(1000)
+    c = cache.Cache(tmp_path, max_bytes=2.5 * len(cache.pickle.dumps(value, -1)))
+    for i, key in enumerate(["a", "b"]):
+        c.put(key, value)
+        os.utime(c._file(key), (i, i))
+    assert c.get("a") is not None, "a is used now, b is the oldest entry"
+    c.put("c", value)
+    assert c.get("b") is None
+    assert c.get("a") is not None and c.get("c") is not None
+
+
+@pytest.mark.parametrize("random_state", [False, True])
+def test_cached(tmp_path, random_state):
+    calls = []
+
+    def jiggle(x, scale=1):
+        calls.append(x)
+        return x + scale * np.random.rand(*x.shape)
+
+    fn = cache.Cache(tmp_path).cached(jiggle, random_state=random_state)
+    x = np.zeros(3)
+    np.random.seed(0)
+    random.seed(0)
+    exp = jiggle(x), np.random.rand(), random.random()
+    for _ in range(2):
+        np.random.seed(0)
+        random.seed(0)
+        result = fn(x), np.random.rand(), random.random()
+        assert (result[0] == exp[0]).all() and result[1:] == exp[1:]
+    assert len(calls) == 2, "second call is a hit"
+    np.random.seed(1)
+    fn(x)
+    assert len(calls) == 2 + random_state, "other random state"
+    fn(x, scale=2)
+    assert len(calls) == 3 + random_state
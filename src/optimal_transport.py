@@ -1,13 +1,53 @@
+import collections
+import copy
+import inspect
+import itertools
+import os
+import pickle
 import random
+import tempfile
 
 import ostruct
 import numpy as np
 from matplotlib import pyplot as plt
 import ot
+import parallel
+import sinkhorn
 import util
-import pyflamegpu
+import trajectories
+from recorder import Recorder
 
-from sx import make_simulation, C
+import sx_cpu
+from sx import make_environment, make_simulation, C, Constants, pyflamegpu
+
+
+class Problem:
+    """Problem is the optimal transport problem between the samples `xs` and
+    `xt` with weights `a` and `b` (uniform by default).
+
+    The cost matrices are computed on first use and kept, one per metric (see
+    ot.dist), and are read-only. The solvers, loss and compare accept a
+    Problem in place of the samples.
+    """
+
+    def __init__(self, xs, xt, a=None, b=None):
+        self.xs, self.xt = np.asarray(xs), np.asarray(xt)
+        n, m = len(self.xs), len(self.xt)
+        self.a = np.ones((n,)) / n if a is None else np.asarray(a)
+        self.b = np.ones((m,)) / m if b is None else np.asarray(b)
+        self._costs = {}
+
+    def cost(self, metric="sqeuclidean"):
+        """cost returns the n x m matrix of the distances from xs to xt."""
+        if metric not in self._costs:
+            M = ot.dist(self.xs, self.xt, metric=metric)
+            M.setflags(write=False)
+            self._costs[metric] = M
+        return self._costs[metric]
+
+
+def _problem(xs, xt):
+    return xs if isinstance(xs, Problem) else Problem(xs, xt)
 
 
 def solve_ot_with_sinkhorn(
@@ -18,6 +58,11 @@ def solve_ot_with_sinkhorn(
     numItermax=10000,
     regularization=1e-1,
     metric="euclidean",  # default metric is 'seuclidean' i.e. squared euclidean! 'cityblock' = manhattan
+    method="sinkhorn",
+    emd=True,
+    dtype="float64",
+    block_rows=1024,
+    warmstart=None,
 ):
     """solve_ot_with_sinkhorn uses the sinkhorn algorithm to solve the optimal
         transport problem between distributions pos_source and pos_target.
@@ -27,29 +72,150 @@ def solve_ot_with_sinkhorn(
         jiggle_factor (float): amount of jiggling applied to resource locations
         numItermax (int): max iteratations of the sinkhorn-knopp algorithm
         regularization (float): regularization of the sinkhorn-knopp algorithm
+        method (str): "sinkhorn" for ot.sinkhorn on dense matrices, "log" for
+            the log-domain sinkhorn.solve, which evaluates the cost in blocks
+            of `block_rows` rows and returns a sinkhorn.Plan; meta["loss"]
+            and meta["loss_jiggled"] are then None, unless `emd` needs the
+            former
+        emd (bool): also solve the exact problem with ot.emd, meta["emd"] is
+            None otherwise
+        dtype (str): with method="log", "float32" or "float64"
+        warmstart (tuple): initial scalings (log u, log v) instead of
+            uniform ones, e.g. meta["warmstart"] of a solution at a nearby
+            regularization or sinkhorn.warmstart of an ABM plan
+
+    pos_source may be a Problem, pos_target is then ignored.
+    meta["iterations"] are the sinkhorn iterations, meta["warmstart"] the
+    final scalings.
     """
-    M_loss = ot.dist(pos_source, pos_target, metric=metric)
+    problem = _problem(pos_source, pos_target)
+    M_loss = problem.cost(metric) if method == "sinkhorn" or emd else None
     # NOTE: To ensure convergence of sinkhorns algorithm the distributions must
     # not have resources at the exact same distances, thus locations are "jiggled" a bit.
-    jiggle = lambda x: (x + jiggle_factor * np.random.rand(*x.shape)) / SCALE
-    pos_source_j, pos_target_j = jiggle(pos_source), jiggle(pos_target)
-    M_loss_jiggled = ot.dist(pos_source_j, pos_target_j)
-    # M_loss_jiggled /= np.sum(M_loss_jiggled)
-    n, m = len(pos_source), len(pos_target)
+    pos_source_j = _jiggle(problem.xs, jiggle_factor, SCALE)
+    pos_target_j = _jiggle(problem.xt, jiggle_factor, SCALE)
     # sinkhorn: needs x,y \in [0, 1] and requires jiggled input for convergence
     # (equal distances that are common with integer locations on a small scale hinder convergence)
-    a, b = np.ones((n,)) / n, np.ones((m,)) / m  # uniform distribution on samples
-    sinkhorn = ot.sinkhorn(a, b, M_loss_jiggled, regularization, numItermax=numItermax)
-    a, b = np.ones((n,)) / n, np.ones((m,)) / m  # uniform distribution on samples
-    emd = ot.emd(a, b, M_loss)
-    return sinkhorn, {
-        "emd": emd,
+    a, b = problem.a, problem.b
+    if method == "sinkhorn":
+        M_loss_jiggled = ot.dist(pos_source_j, pos_target_j)
+        # M_loss_jiggled /= np.sum(M_loss_jiggled)
+        solution, log = ot.sinkhorn(
+            a,
+            b,
+            M_loss_jiggled,
+            regularization,
+            numItermax=numItermax,
+            warmstart=warmstart,
+            log=True,
+        )
+        iterations = log["niter"] + 1
+        scalings = (np.log(log["u"]), np.log(log["v"]))
+    elif method == "log":
+        M_loss_jiggled = None
+        solution = sinkhorn.solve(
+            a,
+            b,
+            pos_source_j,
+            pos_target_j,
+            regularization,
+            dtype=dtype,
+            block_rows=block_rows,
+            max_iterations=numItermax,
+            warmstart=warmstart,
+        )
+        iterations = solution.iterations
+        scalings = solution.warmstart()
+    else:
+        raise RuntimeError(f"unknown sinkhorn method: {method}")
+    return solution, {
+        "emd": ot.emd(a, b, M_loss) if emd else None,
         "loss": M_loss,
         "loss_jiggled": M_loss_jiggled,
         "x": (pos_source_j, pos_target_j),
+        "iterations": iterations,
+        "warmstart": scalings,
     }
 
 
+def _jiggle(x, jiggle_factor, SCALE):
+    return (x + jiggle_factor * np.random.rand(*x.shape)) / SCALE
+
+
+def solve_ot_with_sinkhorn_batch(
+    distributions,
+    SCALE=5,
+    jiggle_factor=0.01,
+    numItermax=10000,
+    regularization=1e-1,
+    metric="euclidean",
+    emd=True,
+    warmstart=None,
+):
+    """solve_ot_with_sinkhorn_batch solves many small problems with the
+    batched sinkhorn.solve_batch instead of one ot.sinkhorn loop each.
+
+    Arguments:
+        distributions (list): (pos_source, pos_target) or Problem of every
+            problem
+        warmstart (list): initial scalings (log u, log v) of every problem
+        see solve_ot_with_sinkhorn for the others
+
+    Returns: list of (sinkhorn, meta) as returned by solve_ot_with_sinkhorn
+        for each problem in turn (equal up to rounding)
+    """
+    problems = [d if isinstance(d, Problem) else Problem(*d) for d in distributions]
+    # the jiggle draws the same random numbers as solve_ot_with_sinkhorn
+    jiggled = [
+        (_jiggle(p.xs, jiggle_factor, SCALE), _jiggle(p.xt, jiggle_factor, SCALE))
+        for p in problems
+    ]
+    losses_jiggled = [ot.dist(xs, xt) for xs, xt in jiggled]
+    plans, info = sinkhorn.solve_batch(
+        sinkhorn.pad([p.a for p in problems]),
+        sinkhorn.pad([p.b for p in problems]),
+        sinkhorn.pad(losses_jiggled),
+        regularization,
+        max_iterations=numItermax,
+        warmstart=(
+            None
+            if warmstart is None
+            else [sinkhorn.pad([w[i] for w in warmstart]) for i in range(2)]
+        ),
+    )
+    solutions = []
+    for k, (p, x, M_loss_jiggled) in enumerate(zip(problems, jiggled, losses_jiggled)):
+        M_loss = p.cost(metric)
+        solutions.append(
+            (
+                plans[k, : len(p.xs), : len(p.xt)].copy(),
+                {
+                    "emd": ot.emd(p.a, p.b, M_loss) if emd else None,
+                    "loss": M_loss,
+                    "loss_jiggled": M_loss_jiggled,
+                    "x": x,
+                    "iterations": info.iterations[k],
+                    "warmstart": (
+                        info.warmstart[0][k, : len(p.xs)],
+                        info.warmstart[1][k, : len(p.xt)],
+                    ),
+                },
+            )
+        )
+    return solutions
+
+
+# arguments of solve_ot_with_abm that override model constants
+ABM_CONSTANTS = {
+    "resource_depleted_after_collections": "RESOURCE_DEPLETED_AFTER_COLLECTIONS",
+    "resource_restoration_ticks": "RESOURCE_RESTORATION_TICKS",
+    "hunger_starved_to_death": "HUNGER_STARVED_TO_DEATH",
+    "n_humans_crowded": "N_HUMANS_CROWDED",
+    "target_resource_amount": "TARGET_RESOURCE_AMOUNT",
+    "hunger_per_resource_consumption": "HUNGER_PER_RESOURCE_CONSUMPTION",
+}
+
+
 def solve_ot_with_abm(
     pos_source,
     pos_target,
@@ -63,21 +229,346 @@ def solve_ot_with_abm(
     target_resource_amount=5,
     hunger_per_resource_consumption=8,
     resource_depleted_after_collections=5,
+    backend="cuda",
+    record="full",
+    record_every=1,
+    record_ids=None,
+    record_path=None,
+    record_compact=False,
+    callback=None,
+    callback_every=500,
+    checkpoint_path=None,
+    checkpoint_every=1000,
+    resume=None,
+    stop_tol=None,
+    stop_window=1000,
+    stop_on="plan",
 ):
-    """Solver for the optimal transport problem using the ABM sx.py"""
+    """Solver for the optimal transport problem using the ABM sx.py
+
+    Arguments:
+        pos_source (array|Problem): source samples, or the problem, then
+            pos_target is ignored
+        backend (str): "cuda" or "cpu", see sx.make_simulation
+        record (str): what to keep in the returned meta data: "metrics",
+            "events", "sampled" or "full", see recorder.Recorder
+        record_every (int): with record="sampled", keep the paths of every
+            Nth step
+        record_ids (list): with record="sampled", keep only the paths of these
+            human ids
+        record_path (str): write the paths to an on-disk trajectory store in
+            this directory while running, meta["paths"] is then a
+            trajectories.TrajectoryStore
+        record_compact (bool): keep the paths in memory move coded,
+            meta["paths"] is then a trajectories.CompactPaths
+        callback (callable): called as `callback(step, M)` every
+            `callback_every` steps with the cost matrix M of the collections
+            so far, e.g. to report an interim loss to an optuna pruner (see
+            tuning.PruningCallback); returning True stops the run, which
+            then returns the results so far
+        checkpoint_path (str): with backend="cpu", write the state of the run
+            to this file every `checkpoint_every` steps and after the last
+            step, see load_checkpoint
+        resume (str|OpenStruct): with backend="cpu", a checkpoint (or its
+            file) to continue instead of starting at step 0. `steps` counts
+            from step 0 and the constants of this call apply from the
+            checkpoint on, so runs with a shared prefix resume one checkpoint
+            with different constants or step budgets
+        stop_tol (float): stop the run once the cost matrix has converged,
+            i.e. changed by at most `stop_tol` over the trailing
+            `stop_window` steps, see Convergence. meta["stop_step"] is the
+            step it stopped at (None if it ran all `steps`)
+        stop_on (str): what has to converge, "plan" (the cost matrix) or
+            "loss" (the loss of its doubly stochastic plan), see
+            STOP_CRITERIA
+    """
+    if isinstance(pos_source, Problem):
+        pos_source, pos_target = pos_source.xs, pos_source.xt
     random.seed(seed)
     grid_size = int(np.max([pos_source, pos_target]))
-    # save global variable
-    Cold = dict()
-    for k, v in C.items():
-        Cold[k] = v
-    C.RESOURCE_DEPLETED_AFTER_COLLECTIONS = resource_depleted_after_collections
-    C.RESOURCE_RESTORATION_TICKS = resource_restoration_ticks
-    C.HUNGER_STARVED_TO_DEATH = hunger_starved_to_death
-    C.N_HUMANS_CROWDED = n_humans_crowded
-    C.TARGET_RESOURCE_AMOUNT = target_resource_amount
-    C.HUNGER_PER_RESOURCE_CONSUMPTION = hunger_per_resource_consumption
-    model, simulation, ctx = make_simulation(grid_size=grid_size)
+    constants = C.replace(
+        RESOURCE_DEPLETED_AFTER_COLLECTIONS=resource_depleted_after_collections,
+        RESOURCE_RESTORATION_TICKS=resource_restoration_ticks,
+        HUNGER_STARVED_TO_DEATH=hunger_starved_to_death,
+        N_HUMANS_CROWDED=n_humans_crowded,
+        TARGET_RESOURCE_AMOUNT=target_resource_amount,
+        HUNGER_PER_RESOURCE_CONSUMPTION=hunger_per_resource_consumption,
+    )
+    model, simulation, ctx = make_simulation(
+        grid_size=grid_size, backend=backend, constants=constants
+    )
+    if backend != "cpu" and (checkpoint_path is not None or resume is not None):
+        raise RuntimeError("checkpoints require backend='cpu'")
+    if record_path is not None and (checkpoint_path is not None or resume is not None):
+        raise RuntimeError("checkpoints do not support record_path")
+    if resume is not None:
+        if not isinstance(resume, ostruct.OpenStruct):
+            resume = load_checkpoint(resume)
+        simulation = sx_cpu.CPUSimulation.restore(resume.simulation, simulation.env)
+        step = _step_cpu(simulation)
+    elif backend == "cpu":
+        step = _setup_cpu(
+            simulation, constants, pos_source, pos_target, seed, n_humans, grid_size
+        )
+    else:
+        step = _setup_cuda(
+            simulation,
+            ctx,
+            constants,
+            pos_source,
+            pos_target,
+            seed,
+            n_humans,
+            grid_size,
+        )
+    recorder = Recorder(
+        constants.N_RESOURCE_TYPES,
+        record,
+        record_every,
+        record_ids,
+        store=record_path,
+        compact=record_compact,
+    )
+    if resume is not None:
+        recorder = copy.deepcopy(resume.recorder)
+    convergence = Convergence(
+        stop_tol, stop_window, stop_on, pos_source, pos_target, use_last_only
+    )
+    for i in range(simulation.step_counter if resume is not None else 0, steps):
+        alive, avg_resources, events, ids, xs, ys = step(recorder.wants_paths(i))
+        recorder.record_step(i, alive, avg_resources, events, ids, xs, ys)
+        stop = alive == 0
+        if stop:
+            print("[WARNING] All humans are dead. Simulation stops early.")
+        else:
+            stop = _callback(
+                callback,
+                callback_every,
+                i + 1,
+                recorder,
+                pos_source,
+                pos_target,
+                use_last_only,
+            ) or convergence.update(i + 1, recorder)
+        if checkpoint_path is not None and (
+            stop or i + 1 == steps or (i + 1) % checkpoint_every == 0
+        ):
+            save_checkpoint(checkpoint_path, simulation, recorder)
+        if stop:
+            break
+    meta = recorder.meta(constants)
+    meta["stop_step"] = convergence.step
+    return _cost_matrix(recorder, pos_source, pos_target, use_last_only), meta
+
+
+def _cost_matrix(recorder, pos_source, pos_target, use_last_only):
+    return util.collected_resource_list_to_cost_matrix(
+        recorder.collected_resources.array,
+        pos_source,
+        pos_target,
+        use_last_only=use_last_only,
+    )
+
+
+# what has to converge for the stopping rule of solve_ot_with_abm
+STOP_CRITERIA = ["plan", "loss"]
+
+
+class Convergence:
+    """Convergence is the stopping rule of solve_ot_with_abm.
+
+    Every `window // 10` steps the cost matrix of the collections so far
+    (folding in only the events since the last check, see
+    util.CostMatrixAccumulator) is compared with the matrices of the previous
+    checks of the trailing `window` steps. The run has converged if none of
+    them differs by more than `tol`: the L1 distance of the normalized
+    matrices for criterion "plan", the relative difference of the losses of
+    their doubly stochastic plans against the problem for "loss".
+
+    Arguments:
+        tol (float): None never stops
+        criterion (str): see STOP_CRITERIA
+    """
+
+    def __init__(
+        self, tol, window, criterion, pos_source, pos_target, use_last_only=False
+    ):
+        if criterion not in STOP_CRITERIA:
+            raise RuntimeError(f"unknown stopping criterion '{criterion}'")
+        self.tol = tol
+        self.window = window
+        self.criterion = criterion
+        self.every = max(1, window // 10)
+        self.problem = Problem(pos_source, pos_target)
+        self.accumulator = util.CostMatrixAccumulator(
+            pos_source, pos_target, use_last_only
+        )
+        # number of events of the recorder in the accumulator
+        self.n_events = 0
+        # (step, cost matrix or loss) of the checks in the trailing window
+        self.checks = collections.deque()
+        # step at which the run converged
+        self.step = None
+
+    def update(self, step, recorder) -> bool:
+        """update checks the run after `step` steps, it returns True if the
+        run has converged and should stop."""
+        if self.tol is None or step % self.every != 0:
+            return False
+        self.accumulator.add(recorder.collected_resources.array[self.n_events :])
+        self.n_events = len(recorder.collected_resources)
+        M = self.accumulator.cost_matrix()
+        if np.sum(M) == 0:
+            return False
+        if self.criterion == "loss":
+            M = loss(self.problem, util.doubly_stochastic(M))
+        # keep the last check at or before the start of the window
+        while len(self.checks) > 1 and self.checks[1][0] <= step - self.window:
+            self.checks.popleft()
+        if self.checks and self.checks[0][0] <= step - self.window:
+            if self.criterion == "plan":
+                change = max(np.abs(M - previous).sum() for _, previous in self.checks)
+            else:
+                change = max(abs(M - previous) for _, previous in self.checks) / M
+            if change <= self.tol:
+                self.step = step
+                return True
+        self.checks.append((step, M))
+        return False
+
+
+def _callback(callback, every, step, recorder, pos_source, pos_target, use_last_only):
+    """_callback calls `callback` every `every` steps with the cost matrix of
+    the run so far, it returns True if the run should stop."""
+    if callback is None or step % every != 0:
+        return False
+    M = _cost_matrix(recorder, pos_source, pos_target, use_last_only)
+    return bool(callback(step, M))
+
+
+def solve_ot_with_abm_ensemble(distributions, configs):
+    """solve_ot_with_abm_ensemble solves many optimal transport problems with
+    the ABM, running all of them as replicas of one vectorized CPU simulation.
+
+    Arguments:
+        distributions (list): (pos_source, pos_target) or Problem of every
+            replica
+        configs (list|dict): keyword arguments of solve_ot_with_abm for every
+            replica (or one for all), the backend is always "cpu"
+
+    Returns: list of (cost matrix, meta) as returned by solve_ot_with_abm,
+        replica k is identical to
+        `solve_ot_with_abm(*distributions[k], **configs[k], backend="cpu")`
+    """
+    K = len(distributions)
+    if isinstance(configs, dict):
+        configs = [configs] * K
+    defaults = {
+        k: p.default
+        for k, p in inspect.signature(solve_ot_with_abm).parameters.items()
+        if p.default is not inspect.Parameter.empty
+    }
+    configs = [ostruct.OpenStruct({**defaults, **config}) for config in configs]
+    if any(c.checkpoint_path is not None or c.resume is not None for c in configs):
+        raise RuntimeError("checkpoints require solve_ot_with_abm")
+    distributions = [
+        (d.xs, d.xt) if isinstance(d, Problem) else d for d in distributions
+    ]
+    grid_sizes = [int(np.max([xs, xt])) for xs, xt in distributions]
+    constants = [
+        C.replace(**{name: config[key] for key, name in ABM_CONSTANTS.items()})
+        for config in configs
+    ]
+    env = make_environment(np.array(grid_sizes))
+    for name in [*ABM_CONSTANTS.values(), *Constants.DERIVED]:
+        env[name] = np.array([c[name] for c in constants])
+    simulation = sx_cpu.CPUSimulation(
+        env, seed=[config.seed for config in configs], n_replicas=K
+    )
+    for k, ((pos_source, pos_target), config) in enumerate(zip(distributions, configs)):
+        random.seed(config.seed)
+        _populate_cpu(
+            simulation,
+            constants[k],
+            pos_source,
+            pos_target,
+            config.n_humans,
+            grid_sizes[k],
+            k,
+        )
+
+    recorders = [
+        Recorder(
+            env.N_RESOURCE_TYPES,
+            c.record,
+            c.record_every,
+            c.record_ids,
+            store=c.record_path,
+            compact=c.record_compact,
+        )
+        for c in configs
+    ]
+    convergences = [
+        Convergence(c.stop_tol, c.stop_window, c.stop_on, *d, c.use_last_only)
+        for c, d in zip(configs, distributions)
+    ]
+    running = set(range(K))
+    for i in range(max(config.steps for config in configs)):
+        simulation.step()
+        humans = simulation.humans
+        # humans and events are sorted by replica
+        bounds = np.searchsorted(humans.replica, np.arange(K + 1))
+        event_bounds = np.searchsorted(simulation.event_replica, np.arange(K + 1))
+        for k in sorted(running):
+            h = slice(bounds[k], bounds[k + 1])
+            recorders[k].record(
+                i,
+                humans.id[h],
+                humans.x[h],
+                humans.y[h],
+                humans.resources[h],
+                simulation.events[event_bounds[k] : event_bounds[k + 1]],
+            )
+            config = configs[k]
+            if bounds[k + 1] == bounds[k]:
+                print(f"[WARNING] All humans of replica {k} are dead. Stops early.")
+                running.remove(k)
+            elif (
+                i + 1 == config.steps
+                or _callback(
+                    config.callback,
+                    config.callback_every,
+                    i + 1,
+                    recorders[k],
+                    *distributions[k],
+                    config.use_last_only,
+                )
+                or convergences[k].update(i + 1, recorders[k])
+            ):
+                running.remove(k)
+                simulation.remove_replica(k)
+        if not running:
+            break
+
+    solutions = []
+    for (pos_source, pos_target), config, recorder, c, convergence in zip(
+        distributions, configs, recorders, constants, convergences
+    ):
+        M = _cost_matrix(recorder, pos_source, pos_target, config.use_last_only)
+        meta = recorder.meta(c)
+        meta["stop_step"] = convergence.step
+        solutions.append((M, meta))
+    return solutions
+
+
+def _setup_cuda(
+    simulation, ctx, constants, pos_source, pos_target, seed, n_humans, grid_size
+):
+    """_setup_cuda populates a CUDASimulation and returns a function running a
+    single step, which returns the number of humans, their mean resources,
+    the collection events of the step (see sx.make_step_summary) and the per
+    human arrays ids, x and y, which are only read from the device if the
+    argument `paths` of the function is True (else None)."""
     simulation.SimulationConfig().random_seed = seed
     resources = pyflamegpu.AgentVector(ctx.resource, len(pos_source) + len(pos_target))
     for i, p in enumerate(pos_source):
@@ -93,60 +584,102 @@ def solve_ot_with_abm(
         human.setVariableInt("x", random.randint(0, grid_size))
         human.setVariableInt("y", random.randint(0, grid_size))
         human.setVariableArrayInt("resources", (2, 2))
-        human.setVariableFloat("actionpotential", C.AP_DEFAULT)
+        human.setVariableFloat("actionpotential", constants.AP_DEFAULT)
     for av in [resources, humans]:
         simulation.setPopulationData(av)
-    paths = []
-    collected_resources = []
-    alive_humans = []
-    avg_resources = []
-    for step in range(steps):
+
+    def step(paths):
         simulation.step()
-        simulation.getPopulationData(humans)
-        alive_humans.append(len(humans))
-        if len(humans) == 0:
-            print("[WARNING] All humans are dead. Simulation stops early.")
-            break
-        avg_resources.append(np.array([0, 0], dtype="float64"))
-        for human in humans:
-            id = human.getID()
-            res = np.array(human.getVariableArrayInt("resources"))
-            avg_resources[-1] += res
-            x, y = human.getVariableInt("x"), human.getVariableInt("y")
-            paths.append([step, id, x, y])
-            loc = human.getVariableArrayInt("ana_last_resource_location")
-            if loc != (-1, -1):
-                collected_resources.append([step, id, *loc])
-        avg_resources[-1] /= len(humans)
-    for k, v in Cold.items():
-        C[k] = v
-    collected_resources = np.array(collected_resources)
-    return (
-        util.collected_resource_list_to_cost_matrix(
-            collected_resources[:, 1:],
-            pos_source,
-            pos_target,
-            use_last_only=use_last_only,
-        ),
-        {
-            "paths": paths,
-            "alive_humans": alive_humans,
-            "avg_resources": avg_resources,
-            "constants": C,
-            "collected_resources": collected_resources,
-        },
+        summary = ctx.step_summary
+        ids = x = y = None
+        if paths:
+            simulation.getPopulationData(humans)
+            ids = np.array([human.getID() for human in humans], dtype="int64")
+            x = np.array([human.getVariableInt("x") for human in humans], dtype="int64")
+            y = np.array([human.getVariableInt("y") for human in humans], dtype="int64")
+        return summary.alive, summary.avg_resources, summary.events, ids, x, y
+
+    return step
+
+
+def _setup_cpu(
+    simulation, constants, pos_source, pos_target, seed, n_humans, grid_size
+):
+    """_setup_cpu is _setup_cuda for a sx_cpu.CPUSimulation."""
+    simulation.seed(seed)
+    _populate_cpu(simulation, constants, pos_source, pos_target, n_humans, grid_size)
+    return _step_cpu(simulation)
+
+
+def _step_cpu(simulation):
+    def step(paths):
+        # the per human arrays are views, `paths` saves nothing
+        simulation.step()
+        humans = simulation.humans
+        avg_resources = None
+        if len(humans.id) > 0:
+            avg_resources = np.mean(humans.resources, axis=0, dtype="float64")
+        return (
+            len(humans.id),
+            avg_resources,
+            simulation.events,
+            humans.id,
+            humans.x,
+            humans.y,
+        )
+
+    return step
+
+
+def save_checkpoint(path, simulation, recorder):
+    """save_checkpoint writes the state of a solve_ot_with_abm run, i.e. the
+    snapshot of the sx_cpu.CPUSimulation and the Recorder, to the file
+    `path`, the file is replaced atomically."""
+    checkpoint = ostruct.OpenStruct(simulation=simulation.snapshot(), recorder=recorder)
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+    )
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path):
+    """load_checkpoint returns the checkpoint in the file `path`, see
+    save_checkpoint, `checkpoint.simulation.step_counter` steps are done."""
+    with open(path, "rb") as fd:
+        return pickle.load(fd)
+
+
+def _populate_cpu(
+    simulation, constants, pos_source, pos_target, n_humans, grid_size, replica=0
+):
+    for type, pos in enumerate([pos_source, pos_target]):
+        pos = np.asarray(pos)
+        simulation.add_resources(len(pos), replica, x=pos[:, 0], y=pos[:, 1], type=type)
+    # same order of random numbers as in _setup_cuda
+    xy = np.array(
+        [[random.randint(0, grid_size) for _ in range(2)] for _ in range(n_humans)]
+    ).reshape(n_humans, 2)
+    simulation.add_humans(
+        n_humans,
+        replica,
+        x=xy[:, 0],
+        y=xy[:, 1],
+        resources=(2, 2),
+        actionpotential=constants.AP_DEFAULT,
     )
 
 
 def plot_paths_4x4(pos_source, pos_target, paths, file=""):
     fig, axs = plt.subplots(4, 4, figsize=(20, 20))
     axs = axs.flatten()
-    paths = np.array(paths)
+    paths = trajectories.as_trajectories(paths)
     grid_size = int(np.max([pos_source, pos_target]))
-    for i, id in enumerate(set(paths[:, 1])):
+    for i, id in enumerate(paths.ids()):
         if i == 16:
             break  # only size for 16 humans in this grid
-        path = paths[paths[:, 1] == id][:, 2:4]
+        path = paths.path(id)[:, 2:4]
         x = path[:, 0]
         y = path[:, 1]
         ax = axs[i]
@@ -222,24 +755,34 @@ def plot_ot(meta, xs, xt, solution, what, extra="", file=""):
 # TODO: should penalize every single row (and column) that does not sum up to
 #       1/(len(rows) | 1/(len(columns) respectively, since this means it is not
 #       saturated, i.e. mines/factories are not working 100%
-def loss(M_cost, M_solution):
+def loss(M_cost, M_solution, metric="sqeuclidean"):
     """loss is defined as the cost of transport from xs[i] to xt[i] (i.e.
     M_cost[i,j] multiplied with the amount (M_sol[i,j])
+
+    M_cost may be a Problem, its cost matrix of `metric` is used.
+    M_solution may be a stack of K plans (K, n, m), the K losses are then
+    computed with a single matrix-vector product.
     """
-    l = np.sum(M_cost * M_solution.T)
+    if isinstance(M_cost, Problem):
+        M_cost = M_cost.cost(metric)
+    M_cost, M_solution = np.asarray(M_cost), np.asarray(M_solution)
+    plans = M_solution.reshape(-1, *M_solution.shape[-2:])
+    # sum(M_cost * plan.T) of every plan
+    losses = plans.reshape(len(plans), -1) @ M_cost.T.ravel()
     # penalty for avoiding a source/target spot
     avg_dist = np.mean(M_cost)
-    missing_sources = np.sum(np.all(M_solution == 0, axis=1))  # rows
-    missing_targets = np.sum(np.all(M_solution == 0, axis=1))  # columns
+    empty_rows = np.all(plans == 0, axis=-1)
+    missing_sources = np.sum(empty_rows, axis=-1)  # rows
+    missing_targets = np.sum(empty_rows, axis=-1)  # columns
     missing = missing_sources + missing_targets
-    if missing > 0:
-        l += missing * avg_dist
-    return l
+    losses = losses + missing * avg_dist
+    return losses if M_solution.ndim == 3 else losses[0]
 
 
 def compare(xs, xt, solution_abm, solution_ot):
     """compare returns a comparison object with various metrics comparing the
-    input solutions.
+    input solutions. xs may be a Problem, xt is then ignored. The solutions
+    may be stacks of plans (K, n, m), see loss.
 
     Returns
     -------
@@ -248,7 +791,7 @@ def compare(xs, xt, solution_abm, solution_ot):
             .loss_abm       loss of the ABM solution
     """
     comparison = ostruct.OpenStruct()
-    M_loss = ot.dist(xs, xt)
+    M_loss = _problem(xs, xt).cost()
     comparison.loss_ot = loss(M_loss, solution_ot)
     comparison.loss_abm = loss(M_loss, solution_abm)
     return comparison
@@ -366,14 +909,110 @@ def _make_distrib_unique(x):
     return x
 
 
+def abm_objective(candidate, steps, problem, solution_ot, **config):
+    """abm_objective is the objective of the hyperparameter search: the
+    difference in % of the loss of the doubly stochastic plan of an ABM run
+    with the hyperparameters `candidate` (and `config`) for `steps` steps to
+    the loss of `solution_ot`.
+
+    Use functools.partial to bind problem, solution_ot and config, e.g.
+    `partial(abm_objective, problem=Problem(xs, xt), solution_ot=sinkhorn)`.
+    """
+    config = {**config, **candidate, "steps": steps, "record": "metrics"}
+    M, _ = solve_ot_with_abm(problem, None, **config)
+    result = compare(problem, None, util.doubly_stochastic(M), solution_ot)
+    return abs(result.loss_abm - result.loss_ot) / result.loss_ot * 100
+
+
 class Optimizer:
+    """Optimizer searches the hyperparameters `config`, given as
+    name=HyperParameter, for the candidate with the smallest loss.
+
+    Candidates are sampled with `candidates` and evaluated in parallel by
+    `search`, or by `successive_halving`, which evaluates them with a growing
+    number of ABM steps and drops the weak ones on the way. The objective
+    must be importable by the worker processes, see parallel.parallel_map,
+    e.g. a functools.partial of abm_objective.
+    """
+
     def __init__(self, **config):
         self.config = ostruct.OpenStruct(**config)
+        # (steps, results) of every round of successive_halving
+        self.history = []
 
     def all(self):
-        for name, param in self.config.items():
-            for val in param.all():
-                yield ostruct.OpenStruct({name: val})
+        """all yields every combination of the parameter values (grid)."""
+        names = list(self.config.keys())
+        values = [self.config[name].all() for name in names]
+        for combination in itertools.product(*values):
+            yield ostruct.OpenStruct(dict(zip(names, combination)))
+
+    def _at(self, u):
+        """_at returns the candidate at the point `u` of the unit cube."""
+        return ostruct.OpenStruct(
+            {name: param.at(x) for (name, param), x in zip(self.config.items(), u)}
+        )
+
+    def candidates(self, sampling="grid", n=None, seed=0):
+        """candidates returns a list of candidates.
+
+        Arguments:
+            sampling (str): "grid" for all combinations, "random" for `n`
+                uniformly random ones or "lhs" for `n` ones of a latin
+                hypercube, which covers the range of every parameter evenly
+            seed (int): of the random samplings
+        """
+        rng = np.random.default_rng(seed)
+        d = len(self.config)
+        if sampling == "grid":
+            return list(self.all())
+        elif sampling == "random":
+            u = rng.random((n, d))
+        elif sampling == "lhs":
+            strata = np.stack([rng.permutation(n) for _ in range(d)], axis=1)
+            u = (strata + rng.random((n, d))) / n
+        else:
+            raise RuntimeError(f"unknown sampling '{sampling}'")
+        return [self._at(x) for x in u]
+
+    def search(self, objective, candidates, workers=None):
+        """search evaluates `objective(candidate)` of every candidate on
+        `workers` processes (default: parallel.WORKERS).
+
+        Returns: list of (loss, candidate), sorted by loss
+        """
+        losses = parallel.parallel_map(objective, candidates, workers=workers)
+        return _ranked(losses, candidates)
+
+    def successive_halving(
+        self, objective, candidates, min_steps, max_steps, eta=3, workers=None
+    ):
+        """successive_halving evaluates `objective(candidate, steps)` of all
+        candidates with `min_steps` steps, keeps the best 1/eta of them and
+        repeats with eta times the steps, until the survivors ran `max_steps`
+        steps. The rounds are recorded in `history`.
+
+        Returns: list of (loss, candidate) of the last round, sorted by loss
+        """
+        self.history = []
+        steps = min_steps
+        while True:
+            steps = min(steps, max_steps)
+            losses = parallel.parallel_map(
+                objective, candidates, [steps] * len(candidates), workers=workers
+            )
+            results = _ranked(losses, candidates)
+            self.history.append((steps, results))
+            if steps == max_steps:
+                return results
+            survivors = max(1, len(candidates) // eta)
+            candidates = [candidate for _, candidate in results[:survivors]]
+            steps *= eta
+
+
+def _ranked(losses, candidates):
+    order = np.argsort(losses, kind="stable")
+    return [(losses[i], candidates[i]) for i in order]
 
 
 class HyperParameter:
@@ -385,3 +1024,8 @@ class HyperParameter:
 
     def all(self):
         return range(self.min, self.max, self.steps)
+
+    def at(self, u):
+        """at returns the value at the fraction `u` in [0, 1) of the range."""
+        values = self.all()
+        return values[min(int(u * len(values)), len(values) - 1)]
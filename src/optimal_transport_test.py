@@ -42,6 +42,75 @@ def test_solve_ot_with_abm(name, xs, xt, config):
     assert len(meta["alive_humans"]) == config["steps"]
 
 
+def test_solve_ot_with_abm_cpu():
+    xs, xt = np.array([[1, 1]]), np.array([[9, 9]])
+    M, meta = solver.solve_ot_with_abm(xs, xt, n_humans=1, steps=12, backend="cpu")
+    assert (M == np.array([[1]])).all()
+    assert len(meta["collected_resources"]) >= 2
+    assert len(meta["alive_humans"]) == 12
+
+
+def test_solve_ot_with_abm_ensemble():
+    np.random.seed(0)
+    distributions = [solver.generate_distributions(s=10, t=10) for _ in range(3)]
+    configs = [
+        {
+            "seed": i,
+            "n_humans": 20 + i,
+            "steps": 100 + 10 * i,
+            "n_humans_crowded": i,
+            "hunger_per_resource_consumption": 6 + i,
+        }
+        for i in range(3)
+    ]
+    ensemble = solver.solve_ot_with_abm_ensemble(distributions, configs)
+    for (M, meta), (xs, xt), config in zip(ensemble, distributions, configs):
+        exp_M, exp_meta = solver.solve_ot_with_abm(xs, xt, **config, backend="cpu")
+        assert (M == exp_M).all()
+        assert (meta["paths"] == exp_meta["paths"]).all()
+        assert (meta["alive_humans"] == exp_meta["alive_humans"]).all()
+        assert (meta["collected_resources"] == exp_meta["collected_resources"]).all()
+
+
+def test_solve_ot_with_abm_constants():
+    xs, xt = np.array([[1, 1]]), np.array([[9, 9]])
+    defaults = dict(solver.C)
+    _, meta = solver.solve_ot_with_abm(
+        xs, xt, n_humans=1, steps=2, backend="cpu", hunger_per_resource_consumption=3
+    )
+    assert meta["constants"].HUNGER_PER_RESOURCE_CONSUMPTION == 3
+    assert meta["constants"].HUNGER_TO_TRIGGER_CONSUMPTION == 3, "derived"
+    with pytest.raises(RuntimeError):
+        solver.solve_ot_with_abm(xs, xt, steps=2, backend="unknown")
+    assert dict(solver.C) == defaults, "runs do not change the defaults"
+
+
+def test_solve_ot_with_abm_record_levels():
+    xs, xt = np.array([[1, 1]]), np.array([[9, 9]])
+    config = {"n_humans": 3, "steps": 12, "backend": "cpu"}
+    exp_M, exp_meta = solver.solve_ot_with_abm(xs, xt, **config)
+    M, meta = solver.solve_ot_with_abm(
+        xs, xt, **config, record="sampled", record_every=3, record_ids=[2]
+    )
+    assert (M == exp_M).all(), "recording does not change the plan"
+    paths = exp_meta["paths"]
+    assert (meta["paths"] == paths[(paths[:, 0] % 3 == 0) & (paths[:, 1] == 2)]).all()
+    M, meta = solver.solve_ot_with_abm(xs, xt, **config, record="metrics")
+    assert (M == exp_M).all()
+    assert len(meta["paths"]) == 0 and len(meta["collected_resources"]) == 0
+    assert (meta["alive_humans"] == exp_meta["alive_humans"]).all()
+
+
+def test_solve_ot_with_abm_record_path(tmp_path):
+    xs, xt = np.array([[1, 1]]), np.array([[9, 9]])
+    config = {"n_humans": 3, "steps": 12, "backend": "cpu"}
+    _, exp_meta = solver.solve_ot_with_abm(xs, xt, **config)
+    _, meta = solver.solve_ot_with_abm(xs, xt, **config, record_path=tmp_path)
+    assert (meta["paths"].steps() == exp_meta["paths"]).all()
+    _, meta = solver.solve_ot_with_abm(xs, xt, **config, record_compact=True)
+    assert (meta["paths"].steps() == exp_meta["paths"]).all()
+
+
 def test__make_distrib_unique():
     random.seed(2)
     orig = [[1, 1], [1, 1], [1, 20]]
@@ -85,6 +154,59 @@ def test_loss():
     assert loss == 6
 
 
+def test_loss_batched():
+    rng = np.random.default_rng(0)
+    M = rng.random((6, 6))
+    plans = rng.random((5, 6, 6))
+    plans[1, 2] = 0
+    plans[3] = 0
+    losses = solver.loss(M, plans)
+    assert losses.shape == (5,)
+    assert np.allclose(losses, [solver.loss(M, plan) for plan in plans])
+    result = solver.compare(M[:, :2], M[:, 2:4], plans, plans[0])
+    assert np.allclose(
+        result.loss_abm,
+        [solver.compare(M[:, :2], M[:, 2:4], p, plans[0]).loss_abm for p in plans],
+    )
+
+
+def test_Problem():
+    xs, xt = np.array([[0, 0], [1, 2]]), np.array([[3, 0], [0, 1], [2, 2]])
+    problem = solver.Problem(xs, xt)
+    assert problem.cost() is problem.cost(), "computed once"
+    assert (problem.cost() == ot.dist(xs, xt)).all()
+    assert (problem.cost("euclidean") == ot.dist(xs, xt, "euclidean")).all()
+    assert not problem.cost().flags.writeable
+    assert (problem.a == 0.5).all() and np.isclose(problem.b.sum(), 1)
+    plan = np.full((2, 2), 0.25)
+    square = solver.Problem(xs, xt[:2])
+    assert solver.loss(square, plan) == solver.loss(ot.dist(xs, xt[:2]), plan)
+    exp = solver.compare(xs, xt[:2], plan, np.eye(2) / 2)
+    assert solver.compare(square, None, plan, np.eye(2) / 2) == exp
+
+
+def test_solve_ot_with_sinkhorn_problem():
+    xs, xt = solver.generate_distributions(s=10, t=10)
+    np.random.seed(0)
+    exp, exp_meta = solver.solve_ot_with_sinkhorn(xs, xt)
+    np.random.seed(0)
+    sinkhorn, meta = solver.solve_ot_with_sinkhorn(solver.Problem(xs, xt), None)
+    assert (sinkhorn == exp).all() and (meta["emd"] == exp_meta["emd"]).all()
+
+
+def test_solve_ot_with_sinkhorn_log():
+    xs, xt = solver.generate_distributions(s=10, t=10)
+    np.random.seed(0)
+    exp, exp_meta = solver.solve_ot_with_sinkhorn(xs, xt)
+    np.random.seed(0)
+    plan, meta = solver.solve_ot_with_sinkhorn(xs, xt, method="log", emd=False)
+    assert meta["emd"] is None and meta["loss"] is None
+    assert np.allclose(np.asarray(plan), exp, atol=1e-4)
+    assert np.isclose(
+        solver.loss(exp_meta["loss"], plan), solver.loss(exp_meta["loss"], exp)
+    )
+
+
 def test_HyperParameter():
     p = solver.HyperParameter(min=1, max=10, steps=1)
 
@@ -102,8 +224,167 @@ def test_Optimizer_single_param():
     assert next(it).n_humans == 20
 
 
-# def test_Optimizer_multiple_params():
-#    o = solver.Optimizer(n_humans=solver.HyperParameter(min=10, max=12, steps=1))
-#    it = o.all()
-#    assert next(it) == 10
-#    assert next(it) == 11
+def test_Optimizer_multiple_params():
+    o = solver.Optimizer(
+        n_humans=solver.HyperParameter(min=10, max=12, steps=1),
+        seed=solver.HyperParameter(min=0, max=3, steps=1),
+    )
+    grid = [(c.n_humans, c.seed) for c in o.candidates("grid")]
+    assert grid == [(10, 0), (10, 1), (10, 2), (11, 0), (11, 1), (11, 2)]
+
+
+@pytest.mark.parametrize("sampling", ["random", "lhs"])
+def test_Optimizer_sampling(sampling):
+    o = solver.Optimizer(
+        n_humans=solver.HyperParameter(min=0, max=100, steps=1),
+        seed=solver.HyperParameter(min=0, max=10, steps=1),
+    )
+    candidates = o.candidates(sampling, n=10, seed=1)
+    assert len(candidates) == 10
+    assert all(0 <= c.n_humans < 100 and 0 <= c.seed < 10 for c in candidates)
+    assert candidates == o.candidates(sampling, n=10, seed=1)
+    if sampling == "lhs":
+        assert sorted(c.seed for c in candidates) == list(range(10)), "one per stratum"
+        assert sorted(c.n_humans // 10 for c in candidates) == list(range(10))
+
+
+def distance_to_optimum(candidate, steps=100):
+    """the loss is noisy with few steps"""
+    noise = 20 / steps * ((candidate.x * 7919) % 13 - 6)
+    return (candidate.x - 42) ** 2 + noise
+
+
+def test_Optimizer_search():
+    o = solver.Optimizer(x=solver.HyperParameter(min=0, max=100, steps=1))
+    results = o.search(distance_to_optimum, o.candidates("grid"), workers=1)
+    assert results[0][1].x == 42
+    assert results == o.search(distance_to_optimum, o.candidates("grid"), workers=2)
+    assert [loss for loss, _ in results] == sorted(loss for loss, _ in results)
+
+
+def test_Optimizer_successive_halving():
+    o = solver.Optimizer(x=solver.HyperParameter(min=0, max=100, steps=1))
+    results = o.successive_halving(
+        distance_to_optimum, o.candidates("grid"), min_steps=10, max_steps=300
+    )
+    assert results[0][1].x == 42
+    assert [(steps, len(r)) for steps, r in o.history] == [
+        (10, 100),
+        (30, 33),
+        (90, 11),
+        (270, 3),
+        (300, 1),
+    ]
+
+
+def test_abm_objective():
+    xs, xt = np.array([[1, 1]]), np.array([[9, 9]])
+    problem = solver.Problem(xs, xt)
+    loss = solver.abm_objective(
+        {"n_humans": 1}, 12, problem, np.array([[1.0]]), backend="cpu"
+    )
+    assert loss == 0
+
+
+def test_solve_ot_with_sinkhorn_batch():
+    np.random.seed(0)
+    distributions = [solver.generate_distributions(s=s, t=10) for s in [10, 15, 20]]
+    state = np.random.get_state()
+    exp = [solver.solve_ot_with_sinkhorn(xs, xt) for xs, xt in distributions]
+    np.random.set_state(state)
+    batch = solver.solve_ot_with_sinkhorn_batch(distributions)
+    for (sinkhorn, meta), (exp_sinkhorn, exp_meta) in zip(batch, exp):
+        assert np.allclose(sinkhorn, exp_sinkhorn, rtol=1e-10, atol=0)
+        assert (meta["emd"] == exp_meta["emd"]).all()
+        assert (meta["x"][0] == exp_meta["x"][0]).all()
+        assert meta["iterations"] > 0
+
+
+@pytest.mark.parametrize("method", ["sinkhorn", "log"])
+def test_solve_ot_with_sinkhorn_warmstart(method):
+    xs, xt = solver.generate_distributions(s=10, t=10)
+    problem = solver.Problem(xs, xt)
+    np.random.seed(0)
+    config = {"method": method, "emd": False, "regularization": 1.0}
+    exp, meta = solver.solve_ot_with_sinkhorn(problem, None, **config)
+    assert meta["iterations"] > 1
+    np.random.seed(0)
+    sinkhorn, warm_meta = solver.solve_ot_with_sinkhorn(
+        problem, None, **config, warmstart=meta["warmstart"]
+    )
+    assert warm_meta["iterations"] < meta["iterations"]
+    assert np.allclose(np.asarray(sinkhorn), np.asarray(exp), atol=1e-6)
+
+
+def test_solve_ot_with_sinkhorn_batch_warmstart():
+    np.random.seed(0)
+    distributions = [solver.generate_distributions(s=s, t=10) for s in [10, 15]]
+    state = np.random.get_state()
+    config = {"emd": False, "regularization": 1.0}
+    exp = solver.solve_ot_with_sinkhorn_batch(distributions, **config)
+    np.random.set_state(state)
+    warm = solver.solve_ot_with_sinkhorn_batch(
+        distributions, **config, warmstart=[meta["warmstart"] for _, meta in exp]
+    )
+    for (sinkhorn, meta), (exp_sinkhorn, exp_meta) in zip(warm, exp):
+        assert meta["iterations"] == 1 < exp_meta["iterations"]
+        assert np.allclose(sinkhorn, exp_sinkhorn)
+
+
+def test_solve_ot_with_abm_checkpoint(tmp_path):
+    xs, xt = solver.generate_distributions(s=8, t=8)
+    config = {"n_humans": 20, "backend": "cpu"}
+    exp_M, exp_meta = solver.solve_ot_with_abm(xs, xt, **config, steps=60)
+    path = tmp_path / "checkpoint"
+    solver.solve_ot_with_abm(
+        xs, xt, **config, steps=30, checkpoint_path=path, checkpoint_every=10
+    )
+    checkpoint = solver.load_checkpoint(path)
+    assert checkpoint.simulation.step_counter == 30
+    M, meta = solver.solve_ot_with_abm(xs, xt, **config, steps=60, resume=path)
+    assert (M == exp_M).all(), "resuming continues the run exactly"
+    assert (meta["paths"] == exp_meta["paths"]).all()
+    assert (meta["alive_humans"] == exp_meta["alive_humans"]).all()
+    _, meta = solver.solve_ot_with_abm(
+        xs, xt, **config, steps=60, resume=checkpoint, n_humans_crowded=1
+    )
+    assert meta["constants"].N_HUMANS_CROWDED == 1, "forked with other constants"
+    assert (meta["alive_humans"][:30] == exp_meta["alive_humans"][:30]).all()
+    assert checkpoint.simulation.step_counter == 30, "the checkpoint is reusable"
+    with pytest.raises(RuntimeError):
+        solver.solve_ot_with_abm(xs, xt, steps=2, resume=path)
+
+
+@pytest.mark.parametrize("stop_on", ["plan", "loss"])
+def test_solve_ot_with_abm_stop_tol(stop_on):
+    xs, xt = solver.generate_distributions(s=8, t=8)
+    config = {"n_humans": 20, "backend": "cpu", "stop_window": 50, "stop_on": stop_on}
+    M, meta = solver.solve_ot_with_abm(xs, xt, **config, steps=200, stop_tol=np.inf)
+    stop_step = meta["stop_step"]
+    assert stop_step % 5 == 0 and 55 <= stop_step < 200, "after a full window"
+    assert len(meta["alive_humans"]) == stop_step
+    exp_M, exp_meta = solver.solve_ot_with_abm(xs, xt, **config, steps=stop_step)
+    assert (M == exp_M).all()
+    assert exp_meta["stop_step"] is None, "no stopping rule"
+    _, meta = solver.solve_ot_with_abm(xs, xt, **config, steps=200, stop_tol=-1)
+    assert meta["stop_step"] is None and len(meta["alive_humans"]) == 200
+    (M, meta), _ = solver.solve_ot_with_abm_ensemble(
+        [(xs, xt)] * 2,
+        [{**config, "steps": 200, "stop_tol": np.inf}, {**config, "steps": 200}],
+    )
+    assert meta["stop_step"] == stop_step and (M == exp_M).all()
+    with pytest.raises(RuntimeError):
+        solver.solve_ot_with_abm(xs, xt, **{**config, "stop_on": "unknown"})
+
+
+@pytest.mark.parametrize("stop_on,tol", [("plan", 0.2), ("loss", 0.05)])
+def test_solve_ot_with_abm_stop_tol_finite(stop_on, tol):
+    np.random.seed(0)
+    xs, xt = solver.generate_distributions(s=8, t=8)
+    config = {"n_humans": 50, "backend": "cpu", "steps": 1000, "seed": 1}
+    config.update(stop_window=100, stop_on=stop_on)
+    _, meta = solver.solve_ot_with_abm(xs, xt, **config, stop_tol=tol)
+    assert meta["stop_step"] is not None and meta["stop_step"] < 1000, "converges"
+    assert len(meta["alive_humans"]) == meta["stop_step"]
+    _, meta = solver.solve_ot_with_abm(xs, xt, **config, stop_tol=1e-9)
+    assert meta["stop_step"] is None and len(meta["alive_humans"]) == 1000
@@ -0,0 +1,53 @@
+"""Parallel execution of independent experiment tasks.
+
+Every task derives its random state from a root seed and its own key, so the
+results do not depend on the number of workers or the order in which tasks
+complete.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import random
+import zlib
+
+import numpy as np
+
+# number of worker processes, 1 runs the tasks in this process
+WORKERS = int(os.getenv("SX_WORKERS", "1"))
+
+
+def task_seed(root_seed, *key):
+    """task_seed derives the seed of the task identified by `key` (e.g. name
+    and index) from `root_seed`."""
+    entropy = [root_seed] + [zlib.crc32(repr(k).encode()) for k in key]
+    return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+
+def seed_all(seed):
+    """seed_all seeds the global random generators of `random` and numpy,
+    which the distributions and the solvers draw from."""
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def parallel_map(fn, *iterables, workers=None):
+    """parallel_map returns `list(map(fn, *iterables))`, computed by a pool of
+    `workers` processes (default: WORKERS).
+
+    Processes are spawned rather than forked, which is safe with an
+    initialized CUDA context. `fn` must be importable by the workers.
+    """
+    workers = WORKERS if workers is None else workers
+    if workers <= 1:
+        return list(map(fn, *iterables))
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context) as pool:
+        return list(pool.map(fn, *iterables))
+
+
+def split(items, n):
+    """split splits `items` into at most `n` contiguous parts of similar size."""
+    items = list(items)
+    bounds = np.linspace(0, len(items), min(n, len(items)) + 1).astype(int)
+    return [items[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
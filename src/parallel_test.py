@@ -0,0 +1,30 @@
+import random
+
+import numpy as np
+
+import parallel
+
+
+def draw(seed, n):
+    parallel.seed_all(seed)
+    return [random.random() for _ in range(n)] + list(np.random.rand(n))
+
+
+def test_task_seed():
+    seeds = [parallel.task_seed(0, "optimality", i) for i in range(100)]
+    assert len(set(seeds)) == 100
+    assert parallel.task_seed(0, "optimality", 3) == seeds[3]
+    assert parallel.task_seed(1, "optimality", 3) != seeds[3]
+    assert parallel.task_seed(0, "optimality2", 3) != seeds[3]
+
+
+def test_parallel_map_independent_of_workers():
+    seeds = [parallel.task_seed(0, "test", i) for i in range(5)]
+    exp = parallel.parallel_map(draw, seeds, [3] * 5, workers=1)
+    assert parallel.parallel_map(draw, seeds, [3] * 5, workers=2) == exp
+
+
+def test_split():
+    assert parallel.split(range(5), 2) == [[0, 1], [2, 3, 4]]
+    assert parallel.split(range(2), 4) == [[0], [1]]
+    assert parallel.split([], 4) == []
@@ -0,0 +1,291 @@
+"""Perception stages shared by the numpy engines of the sx model.
+
+The functions in here replace the brute-force message scans of the CUDA agent
+functions with vectorized lookups over all agents, keeping their semantics.
+Agents can be split into independent groups (the replicas of an ensemble),
+which only perceive agents of their own group.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# value of `closest_resource` if no resource of a type is available, see
+# `human_perception_resource_locations.cu`
+FLT_MAX = np.finfo(np.float32).max
+
+
+def distance(x, y, xo, yo):
+    """Euclidean distance computed in float32 like `vec2Dist` in CUDA."""
+    d2 = (x - xo) ** 2 + (y - yo) ** 2
+    return np.sqrt(d2.astype("float32"))
+
+
+def tile_occupancy(x, y, group=None):
+    """tile_occupancy returns the number of agents on the tile of each agent
+    (including itself).
+
+    One bincount over the linearized tiles, then one gather per agent: O(n)
+    instead of comparing all pairs of agents.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    group = np.zeros(len(x), dtype="int64") if group is None else np.asarray(group)
+    if len(x) == 0:
+        return np.zeros(0, dtype="int64")
+    # humans are not strictly bound to the grid (see random_walk), so
+    # linearize over the occupied bounding box
+    x, y = x - x.min(), y - y.min()
+    width, height = int(x.max()) + 1, int(y.max()) + 1
+    if (int(group.max()) + 1) * width * height <= 4 * len(x) + 1024:
+        tile = (group * width + x) * height + y
+    else:  # sparse agents on a huge area: compact the tiles first
+        tiles = np.stack([group, x, y], axis=1)
+        _, tile = np.unique(tiles, axis=0, return_inverse=True)
+        tile = tile.reshape(-1)
+    return np.bincount(tile)[tile]
+
+
+def crowding(x, y, n_humans_crowded, group=None):
+    """crowding returns 1 for every human that shares its tile with at least
+    `n_humans_crowded` other humans, else 0 (see `N_HUMANS_CROWDED`)."""
+    close_humans = tile_occupancy(x, y, group) - 1  # excluding self
+    return (close_humans >= n_humans_crowded).astype("int64")
+
+
+def _no_resources(n, n_types):
+    shape = (n, n_types)
+    return (
+        np.full(shape, FLT_MAX, dtype="float32"),
+        np.zeros(shape, dtype="int64"),
+        np.zeros(shape, dtype="int64"),
+        np.full(shape, -1, dtype="int64"),
+    )
+
+
+def _set_nearest(nearest, resource_type, x, y, resources, index):
+    """_set_nearest stores resource `index` (-1: none) as closest resource
+    of type `resource_type` for the humans at `x`, `y`."""
+    closest, closest_x, closest_y, closest_id = nearest
+    found = index >= 0
+    i = index[found]
+    closest[found, resource_type] = distance(
+        x[found], y[found], resources.x[i], resources.y[i]
+    )
+    closest_x[found, resource_type] = resources.x[i]
+    closest_y[found, resource_type] = resources.y[i]
+    closest_id[found, resource_type] = i
+
+
+def _groups(n, group):
+    return np.zeros(n, dtype="int64") if group is None else np.asarray(group)
+
+
+def nearest_resources(
+    x, y, resources, available, n_types, group=None, resource_group=None
+):
+    """nearest_resources returns the closest available resource of each type
+    for humans at `x`, `y` by scanning all resources, see
+    `human_perception_resource_locations.cu`.
+
+    Returns: closest, closest_x, closest_y, closest_id
+        arrays of shape (humans, n_types): distance (FLT_MAX if none is
+        available), location and index into `resources` (-1 if none)
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    group = _groups(len(x), group)
+    resource_group = _groups(len(resources.x), resource_group)
+    nearest = _no_resources(len(x), n_types)
+    for resource_type in range(n_types):
+        candidates = np.flatnonzero((resources.type == resource_type) & available)
+        if len(candidates) == 0 or len(x) == 0:
+            continue
+        d = distance(
+            x[:, None],
+            y[:, None],
+            resources.x[None, candidates],
+            resources.y[None, candidates],
+        )
+        d[group[:, None] != resource_group[None, candidates]] = np.inf
+        # argmin returns the first minimum, like the strict `<` over the
+        # messages in the CUDA implementation
+        index = candidates[np.argmin(d, axis=1)]
+        index[np.min(d, axis=1) == np.inf] = -1
+        _set_nearest(nearest, resource_type, x, y, resources, index)
+    return nearest
+
+
+class ResourceIndex:
+    """ResourceIndex answers nearest-available-resource queries with a static
+    KD-tree per resource type.
+
+    Resources never move, so the trees are built once. Depletion (`amount <=
+    0`) only changes the availability mask passed to `nearest`, the result is
+    identical to `nearest_resources`. Groups are stacked along a third axis,
+    far enough apart that a query rarely sees resources of other groups.
+    """
+
+    def __init__(self, resources, n_types, resource_group=None):
+        self.resources = resources
+        self.n_types = n_types
+        self.resource_group = _groups(len(resources.x), resource_group)
+        extent = np.ptp(np.concatenate([resources.x, resources.y, [0]]))
+        self.spacing = 4 * (int(extent) + 1)
+        self.indices = []
+        self.trees = []
+        for resource_type in range(n_types):
+            index = np.flatnonzero(resources.type == resource_type)
+            points = self._points(
+                resources.x[index], resources.y[index], self.resource_group[index]
+            )
+            self.indices.append(index)
+            self.trees.append(cKDTree(points) if len(index) > 0 else None)
+
+    def _points(self, x, y, group):
+        return np.stack([x, y, group * self.spacing], axis=1)
+
+    def nearest(self, x, y, available, group=None):
+        """nearest returns the closest resource with `available[i]` of each
+        type for humans at `x`, `y`, see `nearest_resources`."""
+        x, y = np.asarray(x), np.asarray(y)
+        group = _groups(len(x), group)
+        nearest = _no_resources(len(x), self.n_types)
+        for resource_type, (index, tree) in enumerate(zip(self.indices, self.trees)):
+            mask = available[index]
+            if len(x) == 0 or not mask.any():
+                continue
+            # humans of groups without any available resource find none
+            n_available = np.bincount(
+                self.resource_group[index][mask], minlength=group.max() + 1
+            )
+            query = np.flatnonzero(n_available[group] > 0)
+            i = self._query(tree, index, mask, x[query], y[query], group[query])
+            found = np.full(len(x), -1, dtype="int64")
+            found[query] = index[i]
+            _set_nearest(nearest, resource_type, x, y, self.resources, found)
+        return nearest
+
+    def _query(self, tree, index, mask, x, y, group):
+        """_query returns the position in `index` of the closest resource with
+        `mask` set of the same group, on ties the lowest one (first message in
+        CUDA)."""
+        n = len(index)
+        rx, ry = self.resources.x[index], self.resources.y[index]
+        rgroup = self.resource_group[index]
+        points = self._points(x, y, group)
+        best = np.zeros(len(x), dtype="int64")
+        pending = np.arange(len(x))
+        # expected number of neighbours to find an available one
+        k = min(n, max(4, 2 * -(-n // np.count_nonzero(mask))))
+        while len(pending) > 0:
+            _, j = tree.query(points[pending], k=k)
+            j = j.reshape(len(pending), k)
+            # exact integer distances for tie detection
+            d2 = (rx[j] - x[pending, None]) ** 2 + (ry[j] - y[pending, None]) ** 2
+            same_group = rgroup[j] == group[pending, None]
+            d2_tree = d2 + ((rgroup[j] - group[pending, None]) * self.spacing) ** 2
+            valid = mask[j] & same_group
+            d2_available = np.where(valid, d2, np.iinfo(d2.dtype).max)
+            best_d2 = d2_available.min(axis=1)
+            # all ties of the best distance are among the k neighbours if the
+            # farthest of them is farther away
+            resolved = (best_d2 < d2_tree[:, -1]) | (k == n)
+            ties = valid & (d2 == best_d2[:, None])
+            best[pending[resolved]] = np.where(ties, j, n)[resolved].min(axis=1)
+            pending = pending[~resolved]
+            k = min(n, 2 * k)
+        return best
+
+
+class DistanceField:
+    """DistanceField is a per tile lookup table of the closest available
+    resource of each type on the grid [0, grid_size]² of every group.
+
+    Perception is a gather per human. The table is only maintained on steps
+    on which the availability of a resource flips, and then only for the
+    tiles whose closest resource changes. Humans outside of the grid fall
+    back to the ResourceIndex `index`, which also computes the table entries.
+    """
+
+    # rebuild the whole table if more resources become available at once
+    MAX_INCREMENTAL_RESTORES = 16
+
+    def __init__(self, index, grid_size, n_groups=1):
+        self.index = index
+        self.size = grid_size + 1
+        tiles = self.size**2
+        self.tile_group, tile = np.divmod(np.arange(n_groups * tiles), tiles)
+        self.tile_x, self.tile_y = np.divmod(tile, self.size)
+        self.available = None
+        # resource index per tile and type, -1 if none is available
+        self.field = None
+
+    def _query(self, tiles, available):
+        nearest = self.index.nearest(
+            self.tile_x[tiles], self.tile_y[tiles], available, self.tile_group[tiles]
+        )
+        return nearest[3]
+
+    def _affected_tiles(self, available):
+        """_affected_tiles returns a mask of tiles whose closest resource may
+        have changed, None if the whole table needs to be rebuilt."""
+        flipped = available != self.available
+        depleted = np.flatnonzero(flipped & ~available)
+        restored = np.flatnonzero(flipped & available)
+        if len(restored) > self.MAX_INCREMENTAL_RESTORES:
+            return None
+        affected = np.isin(self.field, depleted).any(axis=1)
+        resources = self.index.resources
+        for i in restored:
+            group = self.index.resource_group[i]
+            tiles = slice(group * self.size**2, (group + 1) * self.size**2)
+            tile_x, tile_y = self.tile_x[tiles], self.tile_y[tiles]
+            current = self.field[tiles, resources.type[i]]
+            d2_current = np.where(
+                current >= 0,
+                (tile_x - resources.x[current]) ** 2
+                + (tile_y - resources.y[current]) ** 2,
+                np.iinfo("int64").max,
+            )
+            d2 = (tile_x - resources.x[i]) ** 2 + (tile_y - resources.y[i]) ** 2
+            affected[tiles] |= (d2 < d2_current) | ((d2 == d2_current) & (i < current))
+        return affected
+
+    def update(self, available):
+        """update recomputes the table for the tiles affected by resources
+        that were depleted or restored since the last update."""
+        if self.available is not None and (available == self.available).all():
+            return
+        affected = None if self.field is None else self._affected_tiles(available)
+        if affected is None:
+            self.field = self._query(slice(None), available)
+        elif affected.any():
+            self.field[affected] = self._query(affected, available)
+        self.available = available.copy()
+
+    def nearest(self, x, y, available, group=None):
+        """nearest returns the closest resource with `available[i]` of each
+        type for humans at `x`, `y`, see `nearest_resources`."""
+        self.update(available)
+        x, y = np.asarray(x), np.asarray(y)
+        group = _groups(len(x), group)
+        n_types = self.index.n_types
+        on_grid = (x >= 0) & (x < self.size) & (y >= 0) & (y < self.size)
+        tile = (group * self.size + x) * self.size + y
+        index = np.empty((len(x), n_types), dtype="int64")
+        index[on_grid] = self.field[tile[on_grid]]
+        off_grid = ~on_grid
+        if off_grid.any():
+            nearest = self.index.nearest(
+                x[off_grid], y[off_grid], available, group[off_grid]
+            )
+            index[off_grid] = nearest[3]
+        nearest = _no_resources(len(x), n_types)
+        for resource_type in range(n_types):
+            _set_nearest(
+                nearest,
+                resource_type,
+                x,
+                y,
+                self.index.resources,
+                index[:, resource_type],
+            )
+        return nearest
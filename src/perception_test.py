@@ -0,0 +1,85 @@
+import numpy as np
+import ostruct
+import pytest
+
+import perception
+
+
+def crowding_brute_force(x, y, n_humans_crowded):
+    """Reference: the message scan of `sx.human_perception_human_locations`."""
+    crowded = []
+    for i in range(len(x)):
+        close_humans = 0
+        for j in range(len(x)):
+            if i != j and x[i] == x[j] and y[i] == y[j]:
+                close_humans += 1
+        crowded.append(1 if close_humans >= n_humans_crowded else 0)
+    return np.array(crowded, dtype="int64")
+
+
+@pytest.mark.parametrize(
+    "name, x, y",
+    [
+        ["no humans", [], []],
+        ["single human", [3], [4]],
+        ["all on one tile", [1] * 12, [1] * 12],
+        ["off grid", [-1, -1, 10, 11, 11], [0, 0, 10, 11, 11]],
+        ["sparse", [0, 0, 10**6], [0, 0, 10**6]],
+    ],
+)
+def test_tile_occupancy(name, x, y):
+    got = perception.tile_occupancy(x, y)
+    exp = [
+        sum(1 for j in range(len(x)) if (x[i], y[i]) == (x[j], y[j]))
+        for i in range(len(x))
+    ]
+    assert list(got) == exp
+
+
+@pytest.mark.parametrize("n_humans_crowded", [0, 1, 2, 10])
+def test_crowding_parity_with_message_scan(n_humans_crowded):
+    rng = np.random.default_rng(0)
+    x, y = rng.integers(0, 5, 300), rng.integers(-1, 6, 300)
+    assert (
+        perception.crowding(x, y, n_humans_crowded)
+        == crowding_brute_force(x, y, n_humans_crowded)
+    ).all()
+
+
+@pytest.mark.parametrize("available_fraction", [1.0, 0.5, 0.02, 0.0])
+def test_ResourceIndex_parity_with_message_scan(available_fraction):
+    rng = np.random.default_rng(1)
+    n = 200
+    resources = ostruct.OpenStruct(
+        # small grid: many equal distances to test the tie breaking
+        x=rng.integers(0, 8, n),
+        y=rng.integers(0, 8, n),
+        type=rng.integers(0, 2, n),
+    )
+    available = rng.random(n) < available_fraction
+    x, y = rng.integers(-2, 10, 500), rng.integers(-2, 10, 500)
+    index = perception.ResourceIndex(resources, 2)
+    got = index.nearest(x, y, available)
+    exp = perception.nearest_resources(x, y, resources, available, 2)
+    for g, e in zip(got, exp):
+        assert (g == e).all()
+
+
+def test_DistanceField_parity_with_message_scan():
+    rng = np.random.default_rng(2)
+    n, grid_size = 60, 12
+    resources = ostruct.OpenStruct(
+        x=rng.integers(0, grid_size + 1, n),
+        y=rng.integers(0, grid_size + 1, n),
+        type=rng.integers(0, 2, n),
+    )
+    field = perception.DistanceField(perception.ResourceIndex(resources, 2), 12)
+    # humans off the grid are answered by the KD-tree
+    x, y = rng.integers(-2, grid_size + 3, 400), rng.integers(-2, grid_size + 3, 400)
+    available = np.ones(n, dtype=bool)
+    for flips in [0, 1, 3, 20, 0, 5, 60]:
+        available[rng.choice(n, flips, replace=False)] ^= True
+        got = field.nearest(x, y, available)
+        exp = perception.nearest_resources(x, y, resources, available, 2)
+        for g, e in zip(got, exp):
+            assert (g == e).all()
@@ -0,0 +1,188 @@
+"""Recording of the per step output of ABM runs into numpy buffers.
+
+The buffers are preallocated and grow in chunks, each step is written with a
+few bulk array assignments instead of one Python list per human.
+"""
+
+import numpy as np
+
+import util
+from trajectories import CompactPaths, TrajectoryStore, TrajectoryWriter
+
+
+class Table:
+    """Table is a growable 2D array with one column per name in `columns`.
+
+    The buffer is column major, so every column is contiguous, and grows by
+    at least `chunk_size` rows (or doubles) when it is full. `array` is a view
+    of the filled rows.
+    """
+
+    def __init__(self, columns, dtype="int64", chunk_size=1 << 16):
+        self.columns = list(columns)
+        self.chunk_size = chunk_size
+        self.buffer = np.empty((0, len(self.columns)), dtype=dtype, order="F")
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def _reserve(self, n):
+        capacity = len(self.buffer)
+        if self.n + n <= capacity:
+            return
+        capacity = max(self.n + n, 2 * capacity, self.chunk_size)
+        buffer = np.empty((capacity, len(self.columns)), self.buffer.dtype, order="F")
+        buffer[: self.n] = self.buffer[: self.n]
+        self.buffer = buffer
+
+    def append(self, *columns):
+        """append adds rows given column wise, scalars are repeated."""
+        sizes = [np.size(c) for c in columns if np.ndim(c) > 0]
+        n = max(sizes) if sizes else 1
+        self._reserve(n)
+        rows = self.buffer[self.n : self.n + n]
+        for i, column in enumerate(columns):
+            rows[:, i] = column
+        self.n += n
+
+    def append_rows(self, rows):
+        """append_rows adds the rows of the 2D array `rows`."""
+        rows = np.asarray(rows).reshape(-1, len(self.columns))
+        self._reserve(len(rows))
+        self.buffer[self.n : self.n + len(rows)] = rows
+        self.n += len(rows)
+
+    @property
+    def array(self):
+        return self.buffer[: self.n]
+
+
+# recording levels, each one includes the data of the previous one
+RECORD_LEVELS = ["metrics", "events", "sampled", "full"]
+
+
+class Recorder:
+    """Recorder collects the data of `solve_ot_with_abm` runs:
+
+    - alive_humans: number of humans per step
+    - avg_resources: mean resources of each type per step (while any human
+      is alive)
+    - collected_resources: rows of util.COLLECTION_EVENT_COLUMNS of every
+      collection, the event stream of the model
+    - paths: rows of [step, id, x, y] of the humans in a step
+
+    Arguments:
+        level (str): what to keep, see RECORD_LEVELS. "metrics" keeps only
+            alive_humans and avg_resources, "events" adds
+            collected_resources, "sampled" adds the paths of every `every`th
+            step and only of the humans in `ids` (all if None), "full" adds
+            the paths of all humans in all steps. Collection events are always
+            recorded as the transport plan is computed from them, but are not
+            part of `meta` below "events".
+        store (str): directory of a trajectories.TrajectoryStore the paths
+            are written to during the run instead of keeping them in memory
+        compact (bool): keep the paths in memory as trajectories.CompactPaths
+    """
+
+    def __init__(
+        self,
+        n_resource_types=2,
+        level="full",
+        every=1,
+        ids=None,
+        chunk_size=1 << 16,
+        store=None,
+        compact=False,
+    ):
+        if level not in RECORD_LEVELS:
+            raise RuntimeError(f"unknown recording level '{level}'")
+        self.level = level
+        self.every = every if level == "sampled" else 1
+        self.ids = None if ids is None or level != "sampled" else np.asarray(ids)
+        self.paths = None
+        if RECORD_LEVELS.index(level) < RECORD_LEVELS.index("sampled"):
+            pass
+        elif store is not None:
+            self.paths = TrajectoryWriter(store)
+        elif compact:
+            self.paths = CompactPaths()
+        else:
+            self.paths = Table(["step", "id", "x", "y"], chunk_size=chunk_size)
+        self.collected_resources = Table(util.COLLECTION_EVENT_COLUMNS, chunk_size=1024)
+        self.alive_humans = Table(["alive_humans"], chunk_size=1024)
+        self.avg_resources = Table(
+            [f"resource_{i}" for i in range(n_resource_types)],
+            dtype="float64",
+            chunk_size=1024,
+        )
+
+    def record(self, step, ids, x, y, resources, events):
+        """record stores the state of the humans after `step`.
+
+        Arguments:
+            ids, x, y (array): per human
+            resources (array): per human and resource type
+            events (array): collections of the step, rows of
+                util.COLLECTION_EVENT_COLUMNS
+        """
+        ids = np.asarray(ids)
+        avg_resources = None
+        if len(ids) > 0:
+            avg_resources = np.mean(resources, axis=0, dtype="float64")
+        self.record_step(step, len(ids), avg_resources, events, ids, x, y)
+
+    def record_step(self, step, alive, avg_resources, events, ids, x, y):
+        """record_step is `record` for backends which reduce the humans
+        before, e.g. on the device.
+
+        Arguments:
+            alive (int): number of humans
+            avg_resources (array): mean resources of each type
+            ids, x, y (array): per human, only used if wants_paths(step)
+        """
+        self.alive_humans.append(alive)
+        if alive == 0:
+            return
+        self.avg_resources.append_rows(avg_resources)
+        self.collected_resources.append_rows(events)
+        if not self.wants_paths(step):
+            return
+        ids = np.asarray(ids)
+        if self.ids is None:
+            self.paths.append(step, ids, x, y)
+        else:
+            sampled = np.isin(ids, self.ids)
+            self.paths.append(
+                step, ids[sampled], np.asarray(x)[sampled], np.asarray(y)[sampled]
+            )
+
+    def wants_paths(self, step):
+        """wants_paths returns True if the positions of the humans after
+        `step` are recorded, else the backend need not read them."""
+        return self.paths is not None and step % self.every == 0
+
+    def meta(self, constants):
+        """meta returns the recorded arrays in the format of the meta data of
+        `solve_ot_with_abm`, data below the recording level is empty. Paths
+        written to a store are returned as trajectories.TrajectoryStore,
+        compact ones as trajectories.CompactPaths."""
+        empty = np.zeros((0, 4), dtype="int64")
+        events = self.level != "metrics"
+        collected = self.collected_resources.array
+        if self.paths is None:
+            paths = empty
+        elif isinstance(self.paths, TrajectoryWriter):
+            self.paths.close()
+            paths = TrajectoryStore(self.paths.directory)
+        elif isinstance(self.paths, CompactPaths):
+            paths = self.paths
+        else:
+            paths = self.paths.array
+        return {
+            "paths": paths,
+            "alive_humans": self.alive_humans.array[:, 0],
+            "avg_resources": self.avg_resources.array,
+            "constants": constants,
+            "collected_resources": collected if events else collected[:0],
+        }
@@ -0,0 +1,99 @@
+import pytest
+import numpy as np
+
+from recorder import Recorder, Table
+
+
+def test_table_grows_in_chunks():
+    table = Table(["step", "id"], chunk_size=4)
+    for step in range(5):
+        table.append(step, [1, 2])
+    assert len(table) == 10
+    assert len(table.buffer) == 16
+    assert (table.array[:, 0] == np.repeat(np.arange(5), 2)).all()
+    assert (table.array[:, 1] == [1, 2] * 5).all()
+    assert table.array[:, 1].flags.c_contiguous, "columns are contiguous"
+
+
+def test_recorder():
+    recorder = Recorder(chunk_size=2)
+    recorder.record(0, [1, 2], [3, 4], [5, 6], [[1, 0], [2, 1]], [[0, 2, 3, 7, 8, 0]])
+    recorder.record(1, [2], [4], [7], [[3, 1]], np.zeros((0, 6)))
+    recorder.record(2, [], [], [], np.zeros((0, 2)), np.zeros((0, 6)))
+    meta = recorder.meta(constants=None)
+    assert meta["paths"].tolist() == [[0, 1, 3, 5], [0, 2, 4, 6], [1, 2, 4, 7]]
+    assert meta["collected_resources"].tolist() == [[0, 2, 3, 7, 8, 0]]
+    assert meta["alive_humans"].tolist() == [2, 1, 0]
+    assert meta["avg_resources"].tolist() == [[1.5, 0.5], [3, 1]]
+
+
+@pytest.mark.parametrize(
+    "level, every, ids, exp_paths, exp_events",
+    [
+        ["metrics", 1, None, [], []],
+        ["events", 1, None, [], [[0, 2, 3, 7, 8, 0], [1, 1, 3, 7, 8, 0]]],
+        [
+            "sampled",
+            2,
+            None,
+            [[0, 1, 3, 5], [0, 2, 4, 6]],
+            [[0, 2, 3, 7, 8, 0], [1, 1, 3, 7, 8, 0]],
+        ],
+        [
+            "sampled",
+            1,
+            [1],
+            [[0, 1, 3, 5], [1, 1, 3, 6]],
+            [[0, 2, 3, 7, 8, 0], [1, 1, 3, 7, 8, 0]],
+        ],
+        [
+            "full",
+            2,
+            [1],
+            [[0, 1, 3, 5], [0, 2, 4, 6], [1, 1, 3, 6], [1, 2, 4, 7]],
+            [[0, 2, 3, 7, 8, 0], [1, 1, 3, 7, 8, 0]],
+        ],
+    ],
+)
+def test_recorder_levels(level, every, ids, exp_paths, exp_events):
+    recorder = Recorder(level=level, every=every, ids=ids)
+    recorder.record(0, [1, 2], [3, 4], [5, 6], [[1, 0], [2, 1]], [[0, 2, 3, 7, 8, 0]])
+    recorder.record(1, [1, 2], [3, 4], [6, 7], [[1, 0], [2, 1]], [[1, 1, 3, 7, 8, 0]])
+    meta = recorder.meta(constants=None)
+    assert meta["paths"].tolist() == exp_paths
+    assert meta["collected_resources"].tolist() == exp_events
+    assert meta["alive_humans"].tolist() == [2, 2]
+    assert len(meta["avg_resources"]) == 2
+    assert recorder.collected_resources.array.tolist() == [
+        [0, 2, 3, 7, 8, 0],
+        [1, 1, 3, 7, 8, 0],
+    ], "events are needed for the transport plan"
+
+
+def test_recorder_unknown_level():
+    with pytest.raises(RuntimeError):
+        Recorder(level="everything")
+
+
+def test_recorder_record_step():
+    recorder = Recorder(level="events")
+    recorder.record_step(0, 2, [1.5, 0.5], [[0, 2, 3, 7, 8, 0]], None, None, None)
+    recorder.record_step(1, 0, None, np.zeros((0, 6)), None, None, None)
+    meta = recorder.meta(constants=None)
+    assert meta["alive_humans"].tolist() == [2, 0]
+    assert meta["avg_resources"].tolist() == [[1.5, 0.5]]
+    assert meta["collected_resources"].tolist() == [[0, 2, 3, 7, 8, 0]]
+
+
+@pytest.mark.parametrize(
+    "level, every, exp",
+    [
+        ["metrics", 1, []],
+        ["events", 1, []],
+        ["sampled", 2, [0, 2]],
+        ["full", 2, [0, 1, 2]],
+    ],
+)
+def test_recorder_wants_paths(level, every, exp):
+    recorder = Recorder(level=level, every=every)
+    assert [step for step in range(3) if recorder.wants_paths(step)] == exp
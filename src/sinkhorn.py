@@ -0,0 +1,287 @@
+"""Sinkhorn solvers beyond ot.sinkhorn.
+
+`solve` is a log-domain Sinkhorn for large optimal transport problems. The
+cost matrix is evaluated in blocks of rows from the samples, so neither it
+nor the transport plan is ever held in memory as a whole; memory is O(n + m +
+block_rows * m). The iterations work on the dual potentials f and g, which
+stay finite for small regularizations, and anneal the regularization from the
+scale of the costs down to the requested one (epsilon scaling).
+
+The plan is P[i, j] = a[i] * b[j] * exp((f[i] + g[j] - C[i, j]) / reg).
+
+`solve_batch` solves many small problems at once, iterating all of them in
+lockstep like ot.sinkhorn does for a single one.
+"""
+
+import numpy as np
+import ostruct
+import ot
+
+
+def cost(x, y, metric="sqeuclidean", dtype="float64"):
+    """cost returns the len(x) x len(y) matrix of distances, like ot.dist."""
+    x, y = np.asarray(x, dtype=dtype), np.asarray(y, dtype=dtype)
+    if metric not in ["sqeuclidean", "euclidean"]:
+        return ot.dist(x, y, metric=metric).astype(dtype)
+    # differences instead of |x|^2 + |y|^2 - 2xy, which cancels in float32
+    C = np.zeros((len(x), len(y)), dtype=dtype)
+    for k in range(x.shape[1]):
+        C += np.square(x[:, k, None] - y[None, :, k])
+    return np.sqrt(C, out=C) if metric == "euclidean" else C
+
+
+def _softmin(h, log_w, x, y, eps, metric, dtype, block_rows):
+    """_softmin returns -eps * log(sum_j w[j] * exp((h[j] - C(x[i], y[j])) / eps))
+    for every x[i], evaluating C in blocks of rows."""
+    z = h / eps + log_w
+    out = np.empty(len(x), dtype=dtype)
+    for start in range(0, len(x), block_rows):
+        s = z - cost(x[start : start + block_rows], y, metric, dtype) / eps
+        smax = np.max(s, axis=1)
+        s -= smax[:, None]
+        np.exp(s, out=s)
+        out[start : start + block_rows] = -eps * (smax + np.log(np.sum(s, axis=1)))
+    return out
+
+
+class Plan:
+    """Plan is the transport plan of `solve`, evaluated block wise on demand.
+
+    np.asarray(plan) returns the dense n x m matrix, `rows` a block of it, and
+    `transport_cost` the cost of the plan without materializing it.
+
+    Attributes:
+        f, g (array): dual potentials of the sources and targets
+        iterations (int): Sinkhorn iterations, over all regularizations
+        err (float): L1 error of the target marginal at the last iteration
+    """
+
+    def __init__(self, a, b, xs, xt, f, g, reg, metric, dtype, block_rows):
+        self.a, self.b, self.xs, self.xt = a, b, xs, xt
+        self.f, self.g = f, g
+        self.reg = reg
+        self.metric = metric
+        self.dtype = np.dtype(dtype)
+        self.block_rows = block_rows
+        self.iterations = 0
+        self.err = np.inf
+
+    @property
+    def shape(self):
+        return (len(self.xs), len(self.xt))
+
+    def rows(self, start, stop):
+        """rows returns the rows [start, stop) of the plan."""
+        C = cost(self.xs[start:stop], self.xt, self.metric, self.dtype)
+        P = (self.f[start:stop, None] + self.g[None, :] - C) / self.reg
+        np.exp(P, out=P)
+        P *= self.a[start:stop, None]
+        P *= self.b[None, :]
+        return P
+
+    def __array__(self, dtype=None, copy=None):
+        P = self.rows(0, len(self.xs))
+        return P if dtype is None else P.astype(dtype)
+
+    def warmstart(self):
+        """warmstart returns the scalings (log u, log v) of the plan, to warm
+        start another solve."""
+        return self.f / self.reg + np.log(self.a), self.g / self.reg + np.log(self.b)
+
+    def transport_cost(self, xs=None, xt=None, metric=None):
+        """transport_cost returns sum(C * P), with C the cost between `xs` and
+        `xt` under `metric` (default: those of the plan)."""
+        xs = self.xs if xs is None else xs
+        xt = self.xt if xt is None else xt
+        metric = self.metric if metric is None else metric
+        total = 0.0
+        for start in range(0, len(xs), self.block_rows):
+            stop = start + self.block_rows
+            C = cost(xs[start:stop], xt, metric, self.dtype)
+            total += float(np.sum(C * self.rows(start, stop), dtype="float64"))
+        return total
+
+
+def solve(
+    a,
+    b,
+    xs,
+    xt,
+    reg,
+    metric="sqeuclidean",
+    dtype="float64",
+    block_rows=1024,
+    eps_scaling=0.5,
+    tol=1e-9,
+    max_iterations=1000,
+    warmstart=None,
+):
+    """solve solves the entropy regularized optimal transport problem between
+    the samples xs with weights a and xt with weights b.
+
+    Arguments:
+        reg (float): regularization (epsilon)
+        metric (str): cost, see ot.dist, must be symmetric
+        dtype (str): "float32" halves the memory and doubles the speed
+        block_rows (int): rows of the cost matrix evaluated at once
+        eps_scaling (float): factor the regularization shrinks by per
+            iteration, from the largest cost down to `reg`; 0 starts at `reg`
+        tol (float): stop when the L1 error of the target marginal is smaller
+        max_iterations (int): at the final regularization
+        warmstart (tuple): initial scalings (log u, log v), see `warmstart`,
+            the annealing is skipped then
+
+    Returns: Plan
+    """
+    xs, xt = np.asarray(xs, dtype=dtype), np.asarray(xt, dtype=dtype)
+    a, b = np.asarray(a, dtype=dtype), np.asarray(b, dtype=dtype)
+    log_a, log_b = np.log(a), np.log(b)
+    if warmstart is None:
+        f, g = np.zeros(len(xs), dtype=dtype), np.zeros(len(xt), dtype=dtype)
+    else:
+        log_u, log_v = (np.asarray(x, dtype=dtype) for x in warmstart)
+        f, g = reg * (log_u - log_a), reg * (log_v - log_b)
+    plan = Plan(a, b, xs, xt, f, g, reg, metric, dtype, block_rows)
+    args = (metric, dtype, block_rows)
+
+    # annealing: start at the diameter of the samples under the metric
+    points = np.concatenate([xs, xt])
+    diameter = cost(points.min(axis=0)[None], points.max(axis=0)[None], *args[:2])
+    eps = max(float(diameter[0, 0]), reg) if eps_scaling > 0 else reg
+    if warmstart is not None:
+        eps = reg
+    while eps > reg:
+        f = _softmin(g, log_b, xs, xt, eps, *args)
+        g = _softmin(f, log_a, xt, xs, eps, *args)
+        plan.iterations += 1
+        eps = max(eps * eps_scaling, reg)
+
+    for _ in range(max_iterations):
+        f = _softmin(g, log_b, xs, xt, reg, *args)
+        g_next = _softmin(f, log_a, xt, xs, reg, *args)
+        # target marginal of (f, g) is b * exp((g - g_next) / reg)
+        plan.err = float(np.sum(np.abs(b * np.expm1((g - g_next) / reg))))
+        g = g_next
+        plan.iterations += 1
+        if plan.err < tol:
+            break
+    plan.f, plan.g = f, g
+    return plan
+
+
+def pad(arrays, fill=0):
+    """pad stacks arrays of differing shapes, padding them at the end of
+    every axis with `fill`."""
+    shape = np.max([np.shape(x) for x in arrays], axis=0)
+    out = np.full((len(arrays), *shape), fill, dtype=np.result_type(*arrays))
+    for k, x in enumerate(arrays):
+        out[(k, *(slice(0, n) for n in np.shape(x)))] = x
+    return out
+
+
+def solve_batch(a, b, M, reg, tol=1e-9, max_iterations=10000, warmstart=None):
+    """solve_batch solves B entropy regularized optimal transport problems
+    with the Sinkhorn-Knopp iterations of ot.sinkhorn, all at once.
+
+    Problems of differing sizes are padded, see `pad`: the weights of padded
+    sources and targets are 0, their costs are ignored. A problem stops
+    iterating when its marginal error (checked every 10 iterations, L2 norm
+    like ot.sinkhorn) is below `tol`, or on numerical errors, when its
+    previous scalings are kept. The remaining problems continue as a smaller
+    batch.
+
+    Arguments:
+        a (array): (B, n) source weights
+        b (array): (B, m) target weights
+        M (array): (B, n, m) costs
+        reg (float|array): regularization, or one per problem
+        warmstart (tuple): initial scalings (log u, log v) of shape (B, n)
+            and (B, m), see `warmstart`
+
+    Returns: (B, n, m) plans, and an OpenStruct with the per problem arrays
+        `iterations`, `err` and `warmstart`, the final scalings (0 where
+        padded)
+    """
+    a, b, M = np.asarray(a, "float64"), np.asarray(b, "float64"), np.asarray(M)
+    B = len(M)
+    rows, cols = a > 0, b > 0
+    reg = np.broadcast_to(np.asarray(reg, "float64"), (B,))
+    K = np.exp(M / -reg[:, None, None]) * rows[:, :, None] * cols[:, None, :]
+    if warmstart is None:
+        u = rows / np.sum(rows, axis=1, keepdims=True)
+        v = cols / np.sum(cols, axis=1, keepdims=True)
+    else:
+        u, v = (np.exp(np.asarray(x, "float64")) for x in warmstart)
+        u, v = u * rows, v * cols
+    iterations = np.zeros(B, dtype="int64")
+    err = np.full(B, np.inf)
+    active = np.arange(B)
+    # iterations are in the compacted arrays of the active problems
+    Kp = np.divide(K, a[:, :, None], where=rows[:, :, None], out=np.zeros_like(K))
+    K_a, Kp_a, b_a, rows_a, cols_a = K, Kp, b, rows, cols
+    u_a, v_a = u.copy(), v.copy()
+    for ii in range(max_iterations):
+        KtransposeU = (u_a[:, None, :] @ K_a)[:, 0]
+        v_next = np.divide(b_a, KtransposeU, where=cols_a, out=np.zeros_like(b_a))
+        Kv = (Kp_a @ v_next[:, :, None])[:, :, 0]
+        u_next = np.divide(1.0, Kv, where=rows_a, out=np.zeros_like(Kv))
+        iterations[active] += 1
+        failed = (
+            np.any((KtransposeU == 0) & cols_a, axis=1)
+            | ~np.all(np.isfinite(u_next), axis=1)
+            | ~np.all(np.isfinite(v_next), axis=1)
+        )
+        # we have reached the machine precision, keep the previous scalings
+        u_next[failed], v_next[failed] = u_a[failed], v_a[failed]
+        u_a, v_a = u_next, v_next
+        done = failed
+        if ii % 10 == 0:
+            marginal = np.einsum("bi,bij,bj->bj", u_a, K_a, v_a)
+            err[active] = np.linalg.norm(marginal - b_a, axis=1)
+            done = done | (err[active] < tol)
+        if not done.any():
+            continue
+        u[active], v[active] = u_a, v_a
+        keep = ~done
+        active = active[keep]
+        if len(active) == 0:
+            break
+        K_a, Kp_a, b_a = K_a[keep], Kp_a[keep], b_a[keep]
+        rows_a, cols_a = rows_a[keep], cols_a[keep]
+        u_a, v_a = u_a[keep], v_a[keep]
+    else:
+        u[active], v[active] = u_a, v_a
+    plans = u[:, :, None] * K * v[:, None, :]
+    log_u = np.log(u, where=rows, out=np.zeros_like(u))
+    log_v = np.log(v, where=cols, out=np.zeros_like(v))
+    return plans, ostruct.OpenStruct(
+        iterations=iterations, err=err, warmstart=(log_u, log_v)
+    )
+
+
+def warmstart(plan, M, reg, reg_plan=None, sweeps=10):
+    """warmstart returns scalings (log u, log v) for which
+    diag(u) exp(-M / reg) diag(v) is close to `plan` (normalized to mass 1),
+    to warm start ot.sinkhorn, solve and solve_batch from a known plan, e.g.
+    a doubly stochastic ABM plan or the solution at a nearby regularization
+    `reg_plan` (default: reg).
+
+    log u[i] + log v[j] is fitted to log plan[i, j] + M[i, j] / reg_plan by
+    least squares over the entries > 0, alternating between u and v `sweeps`
+    times; for a plan of full support one sweep is exact. The dual potentials
+    reg_plan * log u and reg_plan * log v are then kept for `reg`. Works on
+    stacks of plans.
+    """
+    reg_plan = reg if reg_plan is None else reg_plan
+    P = np.asarray(plan, "float64")
+    P = P / np.sum(P, axis=(-2, -1), keepdims=True)
+    support = P > 0
+    L = np.log(P, where=support, out=np.zeros_like(P)) + M / reg_plan
+    L[~support] = 0
+    n_rows = np.maximum(np.sum(support, axis=-1), 1)
+    n_cols = np.maximum(np.sum(support, axis=-2), 1)
+    log_v = np.zeros(P.shape[:-2] + P.shape[-1:])
+    for _ in range(sweeps):
+        log_u = np.sum(np.where(support, L - log_v[..., None, :], 0), axis=-1) / n_rows
+        log_v = np.sum(np.where(support, L - log_u[..., :, None], 0), axis=-2) / n_cols
+    return log_u * reg_plan / reg, log_v * reg_plan / reg
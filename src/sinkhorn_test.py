@@ -0,0 +1,130 @@
+import numpy as np
+import ot
+import pytest
+
+import sinkhorn
+
+
+def make_problem(n=30, m=20, seed=0):
+    rng = np.random.default_rng(seed)
+    xs, xt = 3 * rng.random((n, 2)), 3 * rng.random((m, 2))
+    return np.ones(n) / n, np.ones(m) / m, xs, xt
+
+
+@pytest.mark.parametrize("metric", ["sqeuclidean", "euclidean", "cityblock"])
+def test_cost(metric):
+    _, _, xs, xt = make_problem()
+    assert np.allclose(sinkhorn.cost(xs, xt, metric), ot.dist(xs, xt, metric))
+
+
+@pytest.mark.parametrize(
+    "dtype, tol, eps_scaling, block_rows",
+    [
+        ("float64", 1e-12, 0.5, 1024),
+        ("float64", 1e-12, 0, 7),
+        ("float32", 1e-6, 0.5, 7),
+    ],
+)
+def test_solve(dtype, tol, eps_scaling, block_rows):
+    a, b, xs, xt = make_problem()
+    M = ot.dist(xs, xt)
+    exp = ot.sinkhorn(a, b, M, 0.1, numItermax=100000, stopThr=1e-13)
+    plan = sinkhorn.solve(
+        a,
+        b,
+        xs,
+        xt,
+        0.1,
+        dtype=dtype,
+        tol=tol,
+        eps_scaling=eps_scaling,
+        block_rows=block_rows,
+    )
+    P = np.asarray(plan)
+    assert P.dtype == dtype and P.shape == plan.shape == (30, 20)
+    assert plan.err < tol and plan.iterations > 0
+    assert np.allclose(P, exp, atol=10 * tol)
+    assert np.allclose(P.sum(axis=1), a) and np.allclose(P.sum(axis=0), b, atol=tol)
+    assert (plan.rows(5, 9) == P[5:9]).all()
+    assert np.isclose(plan.transport_cost(), np.sum(M * exp))
+    exp_cost = np.sum(ot.dist(xs, xt, "euclidean") * P)
+    assert np.isclose(plan.transport_cost(metric="euclidean"), exp_cost)
+
+
+def test_solve_small_regularization():
+    """exp(-M / reg) underflows here, the log-domain iterations do not."""
+    a, b, xs, xt = make_problem()
+    plan = sinkhorn.solve(a, b, xs, xt, 1e-2, max_iterations=1000)
+    P = np.asarray(plan)
+    assert np.isfinite(P).all() and plan.err < 1e-3
+    emd = ot.emd(a, b, ot.dist(xs, xt))
+    assert np.isclose(plan.transport_cost(), np.sum(ot.dist(xs, xt) * emd), rtol=1e-2)
+
+
+def test_pad():
+    padded = sinkhorn.pad([np.ones((2, 3)), np.ones((3, 1))])
+    assert padded.shape == (2, 3, 3)
+    assert padded.sum(axis=(1, 2)).tolist() == [6, 3]
+
+
+@pytest.mark.parametrize("reg", [0.1, [0.1, 0.5, 0.3, 1.0, 0.2]])
+def test_solve_batch(reg):
+    problems = [
+        make_problem(n, m, seed)
+        for seed, (n, m) in enumerate([(30, 20), (5, 40), (12, 12), (1, 3), (40, 40)])
+    ]
+    problems = [(a, b, ot.dist(xs, xt)) for a, b, xs, xt in problems]
+    plans, info = sinkhorn.solve_batch(
+        *[sinkhorn.pad([p[i] for p in problems]) for i in range(3)], reg
+    )
+    regs = np.broadcast_to(reg, (len(problems),))
+    for plan, (a, b, M), reg, iterations in zip(plans, problems, regs, info.iterations):
+        n, m = M.shape
+        exp, log = ot.sinkhorn(a, b, M, reg, numItermax=10000, log=True)
+        assert np.allclose(plan[:n, :m], exp, rtol=1e-12, atol=0)
+        assert (plan[n:] == 0).all() and (plan[:, m:] == 0).all()
+        assert iterations == log["niter"] + 1
+    assert (info.err < 1e-9).all()
+
+
+def test_warmstart():
+    a, b, xs, xt = make_problem()
+    M = ot.dist(xs, xt)
+    exp, log = ot.sinkhorn(a, b, M, 0.1, numItermax=10000, log=True)
+    warm = sinkhorn.warmstart(exp, M, 0.1)
+    assert np.allclose(
+        np.exp(warm[0])[:, None] * np.exp(-M / 0.1) * np.exp(warm[1]), exp
+    )
+    _, warm_log = ot.sinkhorn(a, b, M, 0.1, numItermax=10000, log=True, warmstart=warm)
+    assert warm_log["niter"] == 0
+    assert sinkhorn.solve(a, b, xs, xt, 0.1, warmstart=warm, tol=1e-8).iterations == 1
+    _, info = sinkhorn.solve_batch(
+        a[None], b[None], M[None], 0.1, warmstart=[w[None] for w in warm]
+    )
+    assert info.iterations[0] == 1
+    stacked = sinkhorn.warmstart(np.stack([exp, exp]), np.stack([M, M]), 0.1)
+    assert np.allclose(stacked[0][1], warm[0]) and np.allclose(stacked[1][1], warm[1])
+
+
+def test_warmstart_nearby_regularization():
+    a, b, xs, xt = make_problem()
+    M = ot.dist(xs, xt)
+    cold = ot.sinkhorn(a, b, M, 0.1, numItermax=10000, log=True)[1]["niter"]
+    nearby = ot.sinkhorn(a, b, M, 0.12, numItermax=10000)
+    warm = sinkhorn.warmstart(nearby, M, 0.1, reg_plan=0.12)
+    _, log = ot.sinkhorn(a, b, M, 0.1, numItermax=10000, log=True, warmstart=warm)
+    assert log["niter"] < 0.8 * cold
+
+
+def test_warmstart_sparse_plan():
+    a, b, xs, xt = make_problem(n=20, m=20)
+    M = ot.dist(xs, xt)
+    exp = ot.sinkhorn(a, b, M, 0.1, numItermax=10000)
+    P = np.eye(20) + 0.1
+    P[0] = 0
+    log_u, log_v = sinkhorn.warmstart(P, M, 0.1)
+    assert np.isfinite(log_u).all() and np.isfinite(log_v).all()
+    plan, info = sinkhorn.solve_batch(
+        a[None], b[None], M[None], 0.1, warmstart=(log_u[None], log_v[None])
+    )
+    assert np.allclose(plan[0], exp, atol=1e-8)
@@ -1,9 +1,23 @@
+from __future__ import annotations
+
+import collections.abc
 import sys
 import os
 import random
+import types
+import numpy as np
 import ostruct
-import pyflamegpu
-import pyflamegpu.codegen
+
+try:
+    import pyflamegpu
+    import pyflamegpu.codegen
+except ImportError:
+    # CPU-only machines: only `make_simulation(backend="cpu")` is available,
+    # the stub keeps the python agent functions below importable.
+    pyflamegpu = types.SimpleNamespace(agent_function=lambda fn: fn, stub=True)
+
+import sx_cpu
+import util
 
 
 def sqbrt(x):
@@ -11,7 +25,64 @@ def sqbrt(x):
     return root if x >= 0 else -root
 
 
-C = ostruct.OpenStruct(
+class Constants(collections.abc.Mapping):
+    """Constants are the immutable parameters of a model run, readable as
+    attributes or items. `replace` returns a copy with some parameters
+    changed, the derived parameters in DERIVED are always computed from the
+    others."""
+
+    DERIVED = {
+        # after this amount of hunger a human chooses to eat if possible
+        "HUNGER_TO_TRIGGER_CONSUMPTION": lambda c: c.HUNGER_PER_RESOURCE_CONSUMPTION,
+        # Restored AP per tick spend resting.
+        "AP_PER_TICK_RESTING": lambda c: c.AP_DEFAULT / c.SLEEP_REQUIRED_PER_NIGHT,
+        # AP reduction caused by crowding, see @N_HUMANS_CROWDED
+        # Note: humans should be able to move, even with reduced AP by crowding
+        "AP_REDUCTION_BY_CROWDING": lambda c: c.AP_DEFAULT / 10,
+    }
+
+    def __init__(self, **values):
+        base = ostruct.OpenStruct(values)
+        for key, derive in self.DERIVED.items():
+            values[key] = derive(base)
+        object.__setattr__(self, "_values", values)
+
+    def __getattr__(self, key):
+        if key.startswith("_"):
+            raise AttributeError(key)
+        try:
+            return self._values[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Constants are immutable, use replace()")
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return f"Constants({self._values})"
+
+    def replace(self, **overrides):
+        """replace returns a copy with the parameters `overrides` changed."""
+        for key in overrides:
+            if key not in self._values:
+                raise RuntimeError(f"unknown constant: {key}")
+            if key in self.DERIVED:
+                raise RuntimeError(f"{key} is derived and can not be replaced")
+        base = {k: v for k, v in self._values.items() if k not in self.DERIVED}
+        return Constants(**{**base, **overrides})
+
+
+# default parameters of the model
+C = Constants(
     AGENT_COUNT=64,
     # amount of different resource types
     N_RESOURCE_TYPES=2,
@@ -45,13 +116,6 @@ C = ostruct.OpenStruct(
     # amount of hunger when a human starves to death
     HUNGER_STARVED_TO_DEATH=300,
 )
-# after this amount of hunger a human chooses to eat if possible
-C.HUNGER_TO_TRIGGER_CONSUMPTION = C.HUNGER_PER_RESOURCE_CONSUMPTION
-# Restored AP per tick spend resting.
-C.AP_PER_TICK_RESTING = C.AP_DEFAULT / C.SLEEP_REQUIRED_PER_NIGHT
-# AP reduction caused by crowding, see @N_HUMANS_CROWDED
-# Note: humans should be able to move, even with reduced AP by crowding
-C.AP_REDUCTION_BY_CROWDING = C.AP_DEFAULT / 10
 
 
 @pyflamegpu.agent_function
@@ -85,43 +149,120 @@ def human_location(
     message_out.setVariableInt("y", pyflamegpu.getVariableInt("y"))
 
 
-def make_human(model):
+def make_human(model, constants=C):
     human = model.newAgent("human")
     # properties of a human agent
     human.newVariableInt("x")
     human.newVariableInt("y")
-    human.newVariableArrayInt("resources", C.N_RESOURCE_TYPES, [0, 0])
+    human.newVariableArrayInt("resources", constants.N_RESOURCE_TYPES, [0, 0])
     human.newVariableFloat("actionpotential")
     human.newVariableInt("hunger")
     # passing data between agent_functions
-    human.newVariableArrayFloat("closest_resource", C.N_RESOURCE_TYPES, [0, 0])
-    human.newVariableArrayInt("closest_resource_x", C.N_RESOURCE_TYPES, [0, 0])
-    human.newVariableArrayInt("closest_resource_y", C.N_RESOURCE_TYPES, [0, 0])
-    human.newVariableArrayInt("closest_resource_id", C.N_RESOURCE_TYPES, [0, 0])
+    human.newVariableArrayFloat("closest_resource", constants.N_RESOURCE_TYPES, [0, 0])
+    human.newVariableArrayInt("closest_resource_x", constants.N_RESOURCE_TYPES, [0, 0])
+    human.newVariableArrayInt("closest_resource_y", constants.N_RESOURCE_TYPES, [0, 0])
+    human.newVariableArrayInt("closest_resource_id", constants.N_RESOURCE_TYPES, [0, 0])
     human.newVariableInt("is_crowded")
-    # analysis data
-    human.newVariableArrayInt("ana_last_resource_location", 2, [-1, -1])
     return human
 
 
-def make_resource(model):
+def make_resource(model, constants=C):
     resource = model.newAgent("resource")
     resource.newVariableInt("x", 0)
     resource.newVariableInt("y", 0)
     resource.newVariableInt("type", 0)
-    resource.newVariableInt("amount", C.RESOURCE_DEPLETED_AFTER_COLLECTIONS)
+    resource.newVariableInt("amount", constants.RESOURCE_DEPLETED_AFTER_COLLECTIONS)
     resource.newVariableInt("regrowth_timer", 0)
     return resource
 
 
+def make_collection(model):
+    """make_collection returns the agent of a resource collection event, which
+    human_behavior.cu outputs for every collection of a step, see
+    make_step_summary."""
+    collection = model.newAgent("collection")
+    # a row of util.COLLECTION_EVENT_COLUMNS
+    collection.newVariableArrayInt(
+        "event",
+        len(util.COLLECTION_EVENT_COLUMNS),
+        [0] * len(util.COLLECTION_EVENT_COLUMNS),
+    )
+    return collection
+
+
+def make_step_summary(constants=C):
+    """make_step_summary returns a step function, which copies the results of
+    a step reduced on the device by human_behavior.cu to the host: the number
+    of humans `alive`, their mean resources of each type `avg_resources` and
+    the resource collections `events` (rows of util.COLLECTION_EVENT_COLUMNS).
+
+    The collections of a step are the population of the "collection" agent,
+    its n rows are copied at once and read with one call per row, then the
+    population is cleared for the next step. The humans are only counted."""
+
+    class StepSummary(pyflamegpu.HostFunction):
+        def __init__(self):
+            super().__init__()
+            self.alive = 0
+            self.avg_resources = None
+            self.events = np.zeros(
+                (0, len(util.COLLECTION_EVENT_COLUMNS)), dtype="int64"
+            )
+
+        def run(self, FLAMEGPU):
+            self.alive = FLAMEGPU.agent("human").count()
+            totals = FLAMEGPU.environment.getMacroPropertyInt("resource_totals")
+            types = range(constants.N_RESOURCE_TYPES)
+            total = np.array([totals[t].get() for t in types], dtype="float64")
+            self.avg_resources = total / self.alive if self.alive > 0 else None
+            for t in types:
+                totals[t].set(0)
+            collections = FLAMEGPU.agent("collection")
+            n = collections.count()
+            if n == 0:
+                self.events = self.events[:0]
+                return
+            population = collections.getPopulationData()
+            events = np.array(
+                [c.getVariableArrayInt("event") for c in population], dtype="int64"
+            ).reshape(n, len(util.COLLECTION_EVENT_COLUMNS))
+            population.clear()
+            # the device outputs in any order, the CPU backend orders by human
+            self.events = events[np.argsort(events[:, 1], kind="stable")]
+
+    return StepSummary()
+
+
 def vprint(*args, **kwargs):
     if "-vv" in sys.argv:
         print(*args, **kwargs)
 
 
+def make_environment(grid_size, constants=C):
+    """make_environment returns the environment properties of the model for
+    the numpy backend, see sx_cpu."""
+    env = ostruct.OpenStruct({k: v for k, v in constants.items() if k[0] != "_"})
+    env.GRID_SIZE = grid_size
+    return env
+
+
+def fork(snapshot, constants):
+    """fork returns a sx_cpu.CPUSimulation for each Constants in `constants`,
+    which continues `snapshot` (see sx_cpu.CPUSimulation.snapshot) with these
+    constants, e.g. to share the warm-up of runs with different parameters."""
+    return [
+        sx_cpu.CPUSimulation.restore(
+            snapshot, make_environment(snapshot.env.GRID_SIZE, c)
+        )
+        for c in constants
+    ]
+
+
 def make_simulation(
     grid_size=10,
     max_resources=100,
+    backend="cuda",
+    constants=C,
 ) -> [pyflamegpu.ModelDescription, pyflamegpu.CUDASimulation, ostruct.OpenStruct]:
     """Create s FLAMEGPU simulation with actors & messages defined, but no
     created actors (agent vectors) set.
@@ -130,18 +271,30 @@ def make_simulation(
         grid_size (int): border size of the 2D grid (square)
         max_resources (int): maximum amount of resources that you promise to
             add as agents! if adding more resource agents behavior is undefined
+        backend (str): "cuda" for FLAMEGPU or "cpu" for the numpy
+            implementation in sx_cpu.py, which does not need pyflamegpu
+        constants (Constants): parameters of the model, see C
 
     Returns: modelDescription, CUDASimulation, constants
         modelDescription, CUDASimulation (flamegpu2 swig types)
         constants (openstruct): containing all model parameters
+        For backend="cpu" modelDescription is None and the simulation is a
+        sx_cpu.CPUSimulation.
     """
     ctx = ostruct.OpenStruct()
+    if backend == "cpu":
+        env = make_environment(grid_size, constants)
+        return None, sx_cpu.CPUSimulation(env), ctx
+    if backend != "cuda":
+        raise RuntimeError(f"unknown backend: {backend}")
+    if getattr(pyflamegpu, "stub", False):
+        raise RuntimeError("pyflamegpu is not installed, use backend='cpu'")
     model = pyflamegpu.ModelDescription("socix")
     env = model.Environment()
-    for key in C:
+    for key in constants:
         if key[0] == "_":
             continue
-        val = C[key]
+        val = constants[key]
         if type(val) is float:
             vprint(f"env[{key},float] = {val}")
             env.newPropertyFloat(key, val)
@@ -151,6 +304,8 @@ def make_simulation(
         else:
             raise RuntimeError("unknown environment variable type")
     env.newPropertyInt("GRID_SIZE", grid_size)
+    # resource totals of a step, see human_behavior.cu
+    env.newMacroPropertyInt("resource_totals", constants.N_RESOURCE_TYPES)
 
     def make_location_message(model: pyflamegpu.ModelDescription, name: str):
         message = model.newMessageBruteForce(name)
@@ -166,8 +321,9 @@ def make_simulation(
     resource_collection_msg = model.newMessageBucket("resource_collection")
     resource_collection_msg.newVariableInt("amount")
     resource_collection_msg.setBounds(0, max_resources)
-    ctx.human = make_human(model)
-    ctx.resource = make_resource(model)
+    ctx.human = make_human(model, constants)
+    ctx.resource = make_resource(model, constants)
+    ctx.collection = make_collection(model)
 
     def make_agent_function(agent, name, py_fn=None, cuda_fn=None, cuda_fn_file=None):
         "Either `py_fn` or `cuda_fn` must be passed"
@@ -214,6 +370,7 @@ def make_simulation(
         cuda_fn_file=f"{cwd}/agent_fn/human_behavior.cu",
     )
     human_behavior_description.setMessageOutput("resource_collection")
+    human_behavior_description.setAgentOutput(ctx.collection)
     human_behavior_description.setAllowAgentDeath(True)
     # layer 4: environmental effects
     resource_decay_description = make_agent_function(
@@ -238,6 +395,9 @@ def make_simulation(
     model.newLayer("layer 4: environmental effects").addAgentFunction(
         resource_decay_description
     )
+    # move the reduced results of the step to the host
+    ctx.step_summary = make_step_summary(constants)
+    model.addStepFunction(ctx.step_summary)
     # Add the step function to the model.
     # step_validation_fn = step_validation()
     # model.addStepFunction(step_validation_fn)
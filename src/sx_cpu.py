@@ -0,0 +1,472 @@
+"""NumPy implementation of the sx model for machines without a CUDA device.
+
+Every agent type is stored as struct-of-arrays (an OpenStruct of equally long
+numpy arrays, one entry per agent). The layers of a step mirror the agent
+functions in `agent_fn/*.cu` and are applied to all agents at once.
+
+A simulation can hold several independent replicas of the model (an
+ensemble): every agent has a `replica` index, agents only perceive agents of
+their own replica and each constant of the environment is either a scalar or
+an array with one value per replica.
+
+The state of a simulation can be snapshot, saved to a compressed file and
+restored, to resume a run or to fork it with other constants.
+"""
+
+import copy
+import json
+import os
+import tempfile
+
+import numpy as np
+import ostruct
+
+import perception
+import util
+
+FLT_MAX = perception.FLT_MAX
+
+# actions of the GOAP algorithm, see `Action` in `human_behavior.cu`
+RANDOM_WALK = 0
+REST = 1
+COLLECT_RESOURCE_0 = 2
+COLLECT_RESOURCE_1 = 3
+MOVE_TO_CLOSEST_RESOURCE_0 = 4
+MOVE_TO_CLOSEST_RESOURCE_1 = 5
+N_ACTIONS = 6
+
+
+def make_humans(env, ids):
+    """make_humans returns the default state of humans with IDs `ids`, see
+    `sx.make_human`."""
+    n = len(ids)
+    shape = (n, env.N_RESOURCE_TYPES)
+    return ostruct.OpenStruct(
+        id=np.asarray(ids, dtype="int64"),
+        replica=np.zeros(n, dtype="int64"),
+        x=np.zeros(n, dtype="int64"),
+        y=np.zeros(n, dtype="int64"),
+        resources=np.zeros(shape, dtype="int64"),
+        actionpotential=np.zeros(n, dtype="float32"),
+        hunger=np.zeros(n, dtype="int64"),
+        closest_resource=np.zeros(shape, dtype="float32"),
+        closest_resource_x=np.zeros(shape, dtype="int64"),
+        closest_resource_y=np.zeros(shape, dtype="int64"),
+        # index into the resources (not the ID), -1 if none is available
+        closest_resource_id=np.zeros(shape, dtype="int64"),
+        is_crowded=np.zeros(n, dtype="int64"),
+    )
+
+
+def make_resources(env, ids):
+    """make_resources returns the default state of resources with IDs `ids`,
+    see `sx.make_resource`."""
+    n = len(ids)
+    return ostruct.OpenStruct(
+        id=np.asarray(ids, dtype="int64"),
+        replica=np.zeros(n, dtype="int64"),
+        x=np.zeros(n, dtype="int64"),
+        y=np.zeros(n, dtype="int64"),
+        type=np.zeros(n, dtype="int64"),
+        # RESOURCE_DEPLETED_AFTER_COLLECTIONS of the replica, see add_resources
+        amount=np.zeros(n, dtype="int64"),
+        regrowth_timer=np.zeros(n, dtype="int64"),
+    )
+
+
+def _select(agents, mask):
+    """_select returns the subset `mask` of all agent variables."""
+    return ostruct.OpenStruct({k: v[mask] for k, v in agents.items()})
+
+
+def _concat(a, b):
+    return ostruct.OpenStruct({k: np.concatenate([a[k], b[k]]) for k in a})
+
+
+def _constant(env, key, agents, dtype="int64"):
+    """_constant returns the value of the environment property `key` for
+    each agent (scalar or one value per replica)."""
+    value = np.asarray(env[key], dtype=dtype)
+    if value.ndim == 0:
+        return np.full(len(agents.replica), value)
+    return value[agents.replica]
+
+
+def output_resource_location(env, resources):
+    """Layer 1: regrowth of depleted resources, see
+    `output_resource_location.cu`."""
+    depleted = resources.amount <= 0
+    restoration_ticks = _constant(env, "RESOURCE_RESTORATION_TICKS", resources)
+    restored = depleted & (resources.regrowth_timer == restoration_ticks)
+    resources.regrowth_timer[depleted & ~restored] += 1
+    resources.regrowth_timer[restored] = 0
+    amount = _constant(env, "RESOURCE_DEPLETED_AFTER_COLLECTIONS", resources)
+    resources.amount[restored] = amount[restored]
+
+
+def human_perception_resource_locations(env, humans, resources, index=None):
+    """Layer 2.0: closest available resource of each type, see
+    `human_perception_resource_locations.cu`.
+
+    Uses `index` (perception.ResourceIndex or DistanceField) if given, else
+    scans all resources.
+    """
+    available = resources.amount > 0
+    if index is None:
+        nearest = perception.nearest_resources(
+            humans.x,
+            humans.y,
+            resources,
+            available,
+            env.N_RESOURCE_TYPES,
+            humans.replica,
+            resources.replica,
+        )
+    else:
+        nearest = index.nearest(humans.x, humans.y, available, humans.replica)
+    (
+        humans.closest_resource,
+        humans.closest_resource_x,
+        humans.closest_resource_y,
+        humans.closest_resource_id,
+    ) = nearest
+
+
+def human_perception_human_locations(env, humans):
+    """Layer 2.1: crowding, see `sx.human_perception_human_locations`."""
+    humans.is_crowded = perception.crowding(
+        humans.x,
+        humans.y,
+        _constant(env, "N_HUMANS_CROWDED", humans),
+        humans.replica,
+    )
+
+
+def human_behavior(env, humans, rngs):
+    """Layer 3: GOAP behavior of all humans, see `human_behavior.cu`.
+
+    Arguments:
+        rngs (list): np.random.Generator of each replica
+
+    Returns: humans, collectors, collections
+        humans (OpenStruct): surviving humans
+        collectors (np.array): index into `humans` of each collecting human
+        collections (np.array): resource index collected by each collecting
+            human (resource_collection messages)
+    """
+    hunger = humans.hunger + _constant(env, "HUNGER_PER_TICK", humans)
+    alive = hunger < _constant(env, "HUNGER_STARVED_TO_DEATH", humans)
+    humans = _select(humans, alive)
+    humans.hunger = hunger[alive]
+    n = len(humans.x)
+    c = ostruct.OpenStruct(
+        {
+            key: _constant(env, key, humans, dtype)
+            for key, dtype in [
+                ("AP_REDUCTION_BY_CROWDING", "float32"),
+                ("AP_PER_TICK_RESTING", "float32"),
+                ("AP_COLLECT_RESOURCE", "float32"),
+                ("AP_MOVE", "float32"),
+                ("RESOURCE_COLLECTION_RANGE", "float32"),
+                ("SCORE_REDUCTION_PER_TILE_DISTANCE", "float32"),
+                ("HUNGER_TO_TRIGGER_CONSUMPTION", "int64"),
+                ("HUNGER_PER_RESOURCE_CONSUMPTION", "int64"),
+                ("TARGET_RESOURCE_AMOUNT", "int64"),
+                ("GRID_SIZE", "int64"),
+            ]
+        }
+    )
+    crowded = humans.is_crowded == 1
+    ap = humans.actionpotential
+    ap[crowded] -= c.AP_REDUCTION_BY_CROWDING[crowded]
+    res = humans.resources
+    consume = (
+        (res[:, 0] != 0)
+        & (res[:, 1] != 0)
+        & (humans.hunger > c.HUNGER_TO_TRIGGER_CONSUMPTION)
+    )
+    res[consume] -= 1
+    humans.hunger[consume] -= c.HUNGER_PER_RESOURCE_CONSUMPTION[consume]
+
+    # GOAP algorithm
+    scores = np.zeros((n, N_ACTIONS), dtype="int64")
+    can_collect_resource = ap >= c.AP_COLLECT_RESOURCE
+    can_move = ap >= c.AP_MOVE
+    scores[:, REST] = np.where(can_move | can_collect_resource, 1, 5)
+    scores[can_move & crowded, RANDOM_WALK] = 10
+    for resource_type in range(env.N_RESOURCE_TYPES):
+        distance = humans.closest_resource[:, resource_type]
+        saturation = c.TARGET_RESOURCE_AMOUNT - res[:, resource_type]
+        collect = can_collect_resource & (distance <= c.RESOURCE_COLLECTION_RANGE)
+        scores[collect, COLLECT_RESOURCE_0 + resource_type] = 10 + saturation[collect]
+        move = (
+            can_move & (distance > c.RESOURCE_COLLECTION_RANGE) & (distance != FLT_MAX)
+        )
+        reduction = distance[move] * c.SCORE_REDUCTION_PER_TILE_DISTANCE[move]
+        move_score = np.trunc(np.float32(10) - reduction).astype("int64")
+        scores[move, MOVE_TO_CLOSEST_RESOURCE_0 + resource_type] = (
+            move_score + saturation[move]
+        )
+    # like `findMax`: first action with the highest positive score
+    action = np.argmax(scores, axis=1)
+
+    # random_walk
+    walk = np.flatnonzero(action == RANDOM_WALK)
+    ap[walk] -= c.AP_MOVE[walk]
+    d, along_x = _random_walk_directions(rngs, humans.replica[walk])
+    x, y = humans.x[walk] + d * along_x, humans.y[walk] + d * ~along_x
+    grid_size = c.GRID_SIZE[walk]
+    wrap_x_lo = x < 0
+    wrap_y_lo = ~wrap_x_lo & (y < 0)
+    wrap_x_hi = ~wrap_x_lo & ~wrap_y_lo & (x == grid_size)
+    wrap_y_hi = ~wrap_x_lo & ~wrap_y_lo & ~wrap_x_hi & (y == grid_size)
+    x[wrap_x_lo] = grid_size[wrap_x_lo]
+    y[wrap_y_lo] = grid_size[wrap_y_lo]
+    x[wrap_x_hi] = 0
+    y[wrap_y_hi] = 0
+    humans.x[walk], humans.y[walk] = x, y
+    # rest
+    rest = action == REST
+    ap[rest] += c.AP_PER_TICK_RESTING[rest]
+    ap[rest & crowded] += c.AP_REDUCTION_BY_CROWDING[rest & crowded]
+    collectors, collections = [], []
+    for resource_type in range(env.N_RESOURCE_TYPES):
+        # collect_resource
+        collect = np.flatnonzero(action == COLLECT_RESOURCE_0 + resource_type)
+        ap[collect] -= c.AP_COLLECT_RESOURCE[collect]
+        res[collect, resource_type] += 1
+        collectors.append(collect)
+        collections.append(humans.closest_resource_id[collect, resource_type])
+        # move_to_closest_resource
+        move = np.flatnonzero(action == MOVE_TO_CLOSEST_RESOURCE_0 + resource_type)
+        ap[move] -= c.AP_MOVE[move]
+        x, y = humans.x[move], humans.y[move]
+        closest_x = humans.closest_resource_x[move, resource_type]
+        closest_y = humans.closest_resource_y[move, resource_type]
+        # NOTE: the CUDA code divides by zero if already aligned on an axis,
+        # a step along that axis never reduces the distance either way.
+        step_x, step_y = np.sign(closest_x - x), np.sign(closest_y - y)
+        dist_after_x_step = perception.distance(x + step_x, y, closest_x, closest_y)
+        dist_after_y_step = perception.distance(x, y + step_y, closest_x, closest_y)
+        step_along_x = dist_after_x_step < dist_after_y_step
+        humans.x[move] = x + step_x * step_along_x
+        humans.y[move] = y + step_y * ~step_along_x
+    return humans, np.concatenate(collectors), np.concatenate(collections)
+
+
+def _random_walk_directions(rngs, replica):
+    """_random_walk_directions draws the direction (+-1) and the axis of a
+    random walk for humans of `replica`, each replica from its own rng."""
+    d = np.empty(len(replica), dtype="int64")
+    along_x = np.empty(len(replica), dtype=bool)
+    for r in np.unique(replica):
+        walkers = replica == r
+        n = np.count_nonzero(walkers)
+        d[walkers] = np.where(rngs[r].integers(0, 2, n) == 0, 1, -1)
+        along_x[walkers] = rngs[r].integers(0, 2, n) == 0
+    return d, along_x
+
+
+def resource_decay(env, resources, collections):
+    """Layer 4: collected resources are depleted, see `resource_decay.cu`."""
+    collected = np.bincount(collections, minlength=len(resources.amount))
+    resources.amount = np.maximum(resources.amount - collected, 0)
+
+
+class CPUSimulation:
+    """CPUSimulation runs the sx model on numpy arrays, see
+    `sx.make_simulation(backend="cpu")`.
+
+    Agents are added with `add_humans` / `add_resources` and can be modified
+    directly through the struct-of-arrays `humans` and `resources`.
+    Resources must not move once the simulation is stepped.
+
+    After a step, `events` holds the resource collections of the step, rows
+    of util.COLLECTION_EVENT_COLUMNS ordered by human, and `event_replica`
+    the replica of each row.
+
+    Arguments:
+        seed (int|list): seed of the random numbers, one per replica
+        resource_perception (str): "kdtree" for a static perception.ResourceIndex,
+            "distance_field" for a per tile perception.DistanceField (many
+            humans on a small grid) or "brute_force" to scan all resources of
+            every human
+        n_replicas (int): number of independent replicas, every replica is
+            identical to a simulation of its own with the same seed and
+            agents
+    """
+
+    def __init__(self, env, seed=0, resource_perception="kdtree", n_replicas=1):
+        self.env = env
+        self.resource_perception = resource_perception
+        self.n_replicas = n_replicas
+        self.humans = make_humans(env, [])
+        self.resources = make_resources(env, [])
+        self._resource_index = None
+        self.step_counter = 0
+        self._next_id = np.ones(n_replicas, dtype="int64")
+        self.events = np.zeros((0, len(util.COLLECTION_EVENT_COLUMNS)), dtype="int64")
+        self.event_replica = np.zeros(0, dtype="int64")
+        self.seed(seed)
+
+    def seed(self, seed):
+        seeds = np.broadcast_to(seed, (self.n_replicas,))
+        self.rngs = [np.random.default_rng(s) for s in seeds.tolist()]
+
+    def _new_ids(self, n, replica):
+        ids = np.arange(self._next_id[replica], self._next_id[replica] + n)
+        self._next_id[replica] += n
+        return ids
+
+    def _add(self, agents, new, replica, variables):
+        new.replica[:] = replica
+        for key, value in variables.items():
+            new[key][:] = value
+        return _concat(agents, new)
+
+    def add_humans(self, n, replica=0, **variables):
+        """add_humans adds `n` humans to `replica`, variables are broadcast to
+        all of them, e.g. `add_humans(2, x=[1, 2], resources=(1, 0))`."""
+        new = make_humans(self.env, self._new_ids(n, replica))
+        self.humans = self._add(self.humans, new, replica, variables)
+
+    def add_resources(self, n, replica=0, **variables):
+        """add_resources adds `n` resources to `replica`, see `add_humans`."""
+        new = make_resources(self.env, self._new_ids(n, replica))
+        new.amount[:] = _constant(self.env, "RESOURCE_DEPLETED_AFTER_COLLECTIONS", new)
+        self.resources = self._add(self.resources, new, replica, variables)
+        self._resource_index = None
+
+    def remove_replica(self, replica):
+        """remove_replica removes all humans of `replica`, e.g. once its
+        results are complete, so it does not cost any more time."""
+        self.humans = _select(self.humans, self.humans.replica != replica)
+
+    def resource_index(self):
+        """resource_index returns the index used for resource perception, it
+        is built once after the resources are added."""
+        if self.resource_perception == "brute_force":
+            return None
+        if self.resource_perception not in ["kdtree", "distance_field"]:
+            raise RuntimeError(
+                f"unknown resource perception: {self.resource_perception}"
+            )
+        if self._resource_index is None:
+            self._resource_index = perception.ResourceIndex(
+                self.resources, self.env.N_RESOURCE_TYPES, self.resources.replica
+            )
+            if self.resource_perception == "distance_field":
+                self._resource_index = perception.DistanceField(
+                    self._resource_index,
+                    int(np.max(self.env.GRID_SIZE)),
+                    self.n_replicas,
+                )
+        return self._resource_index
+
+    def snapshot(self):
+        """snapshot returns a copy of the state of the simulation: agents,
+        environment, random generators and step counter, see restore."""
+        return ostruct.OpenStruct(
+            env=copy.deepcopy(self.env),
+            humans=copy.deepcopy(self.humans),
+            resources=copy.deepcopy(self.resources),
+            rngs=[rng.bit_generator.state for rng in self.rngs],
+            step_counter=self.step_counter,
+            next_id=self._next_id.copy(),
+            resource_perception=self.resource_perception,
+            n_replicas=self.n_replicas,
+        )
+
+    @classmethod
+    def restore(cls, snapshot, env=None):
+        """restore returns a simulation in the state of `snapshot`, which
+        continues exactly like the simulation the snapshot was taken of.
+
+        Arguments:
+            env (OpenStruct): replaces the environment of the snapshot, e.g.
+                to fork the run with other constants, see sx.fork
+        """
+        simulation = cls(
+            copy.deepcopy(snapshot.env if env is None else env),
+            resource_perception=snapshot.resource_perception,
+            n_replicas=snapshot.n_replicas,
+        )
+        simulation.humans = copy.deepcopy(snapshot.humans)
+        simulation.resources = copy.deepcopy(snapshot.resources)
+        for rng, state in zip(simulation.rngs, snapshot.rngs):
+            rng.bit_generator.state = state
+        simulation.step_counter = snapshot.step_counter
+        simulation._next_id = np.array(snapshot.next_id, dtype="int64")
+        return simulation
+
+    def step(self):
+        output_resource_location(self.env, self.resources)
+        human_perception_resource_locations(
+            self.env, self.humans, self.resources, self.resource_index()
+        )
+        human_perception_human_locations(self.env, self.humans)
+        self.humans, collectors, collections = human_behavior(
+            self.env, self.humans, self.rngs
+        )
+        resource_decay(self.env, self.resources, collections)
+        self._collection_events(collectors, collections)
+        self.step_counter += 1
+
+    def _collection_events(self, collectors, collections):
+        """_collection_events sets `events` to the collections of this step,
+        built from the collecting humans only."""
+        order = np.argsort(collectors, kind="stable")
+        collectors, collections = collectors[order], collections[order]
+        r = self.resources
+        self.events = np.column_stack(
+            [
+                np.full(len(collectors), self.step_counter),
+                self.humans.id[collectors],
+                r.id[collections],
+                r.x[collections],
+                r.y[collections],
+                r.type[collections],
+            ]
+        ).astype("int64")
+        self.event_replica = self.humans.replica[collectors]
+
+
+def save(snapshot, path):
+    """save writes `snapshot` (see CPUSimulation.snapshot) to the compressed
+    numpy file `path`, the file is replaced atomically."""
+    arrays = {
+        f"{group}.{key}": np.asarray(value)
+        for group in ["env", "humans", "resources"]
+        for key, value in snapshot[group].items()
+    }
+    meta = {
+        "rngs": snapshot.rngs,
+        "step_counter": snapshot.step_counter,
+        "next_id": np.asarray(snapshot.next_id).tolist(),
+        "resource_perception": snapshot.resource_perception,
+        "n_replicas": snapshot.n_replicas,
+    }
+    # written under a temporary name, a crash never leaves a partial file
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.savez_compressed(f, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(tmp, path)
+
+
+def load(path):
+    """load returns the snapshot saved to `path`, see save."""
+    with np.load(path) as data:
+        snapshot = ostruct.OpenStruct(json.loads(data["meta"].item()))
+        for group in ["env", "humans", "resources"]:
+            snapshot[group] = ostruct.OpenStruct()
+        for name in data.files:
+            if name == "meta":
+                continue
+            group, key = name.split(".", 1)
+            value = data[name]
+            # scalar constants are python numbers like in sx.make_environment
+            snapshot[group][key] = (
+                value.item() if group == "env" and value.ndim == 0 else value
+            )
+    return snapshot
@@ -0,0 +1,205 @@
+import math
+
+import numpy as np
+import pytest
+
+import sx_cpu
+from sx import make_environment, make_simulation, fork, C
+
+
+def isclose(a, b) -> bool:
+    """Agent variables are float32 like in CUDA, so compare with tolerance."""
+    return math.isclose(a, b, abs_tol=1e-6, rel_tol=1e-6)
+
+
+def make_cpu_simulation(grid_size=10):
+    _, simulation, _ = make_simulation(grid_size=grid_size, backend="cpu")
+    return simulation
+
+
+def test_collect_resource_no_resource_available():
+    simulation = make_cpu_simulation()
+    simulation.add_humans(1, resources=(1, 0), actionpotential=C.AP_DEFAULT)
+    simulation.step()
+    humans = simulation.humans
+    assert len(humans.id) == 1
+    assert humans.x[0] == 0
+    assert humans.y[0] == 0
+    assert isclose(
+        humans.actionpotential[0], C.AP_DEFAULT + C.AP_PER_TICK_RESTING
+    ), "nothing todo, so human should rest"
+    assert tuple(humans.resources[0]) == (1, 0), "no resource available to collect"
+
+
+def test_collect_resource_depleted_after_multiple_collections():
+    simulation = make_cpu_simulation()
+    simulation.add_humans(5, resources=(1, 0), actionpotential=C.AP_DEFAULT)
+    simulation.add_resources(1)
+    simulation.step()
+    assert (simulation.humans.resources == (2, 0)).all(), "collected resource"
+    # rows of [step, human id, resource id, x, y, type]
+    assert simulation.events.tolist() == [[0, i, 6, 0, 0, 0] for i in range(1, 6)]
+    simulation.step()
+    assert (simulation.humans.resources == (2, 0)).all(), "resource depleted"
+    assert len(simulation.events) == 0
+    for _ in range(C.RESOURCE_RESTORATION_TICKS + 1):
+        simulation.step()
+    assert (
+        simulation.humans.resources == (3, 0)
+    ).all(), "resource is regrown, and should get collected again"
+
+
+def test_move_towards_resource_2d():
+    simulation = make_cpu_simulation()
+    simulation.add_humans(1, resources=(1, 0), actionpotential=C.AP_DEFAULT)
+    simulation.add_resources(1, x=3, y=6)
+    exp_path = [[0, 1], [0, 2], [0, 3], [0, 4], [1, 4], [1, 4]]
+    for exp_loc in exp_path:
+        simulation.step()
+        assert [simulation.humans.x[0], simulation.humans.y[0]] == exp_loc
+    assert tuple(simulation.humans.resources[0]) == (2, 0)
+    assert isclose(
+        simulation.humans.actionpotential[0],
+        C.AP_DEFAULT - 5 * C.AP_MOVE - C.AP_COLLECT_RESOURCE,
+    )
+
+
+def test_recover_actionpotential_by_sleeping():
+    simulation = make_cpu_simulation()
+    simulation.add_humans(1, actionpotential=0)
+    simulation.add_resources(1)
+    simulation.step()
+    assert tuple(simulation.humans.resources[0]) == (0, 0), "no AP to collect"
+    assert isclose(simulation.humans.actionpotential[0], C.AP_PER_TICK_RESTING)
+    simulation.step()
+    assert tuple(simulation.humans.resources[0]) == (1, 0), "got enough AP now"
+
+
+def test_crowding_reduces_actionpotential():
+    simulation = make_cpu_simulation()
+    simulation.add_humans(12, actionpotential=C.AP_DEFAULT)
+    simulation.step()
+    humans = simulation.humans
+    assert (humans.is_crowded == 1).all()
+    assert np.allclose(
+        humans.actionpotential, C.AP_DEFAULT - C.AP_REDUCTION_BY_CROWDING - C.AP_MOVE
+    ), "AP reduced & move happened"
+    assert ((humans.x != 0) | (humans.y != 0)).all(), "crowded humans random walk"
+    simulation.step()
+    assert (simulation.humans.is_crowded == 0).all()
+
+
+def test_require_2_different_resources_for_survival():
+    simulation = make_cpu_simulation(grid_size=100)
+    simulation.add_humans(
+        2, x=1, y=1, resources=[(1, 0), (1, 1)], actionpotential=C.AP_DEFAULT
+    )
+    for _ in range(C.HUNGER_STARVED_TO_DEATH + 1):
+        simulation.step()
+    assert len(simulation.humans.id) == 1, "one starves, one stays alive"
+    assert simulation.humans.id[0] == 2
+
+
+def test_move_towards_2nd_resource_to_stay_alive():
+    simulation = make_cpu_simulation(grid_size=100)
+    simulation.add_humans(1, resources=(10, 0), actionpotential=C.AP_DEFAULT)
+    simulation.add_resources(2, y=[0, 5], type=[0, 1])
+    simulation.step()
+    assert [simulation.humans.x[0], simulation.humans.y[0]] == [0, 1]
+    simulation.step()
+    assert [simulation.humans.x[0], simulation.humans.y[0]] == [0, 2]
+    simulation.step()
+    assert tuple(simulation.humans.resources[0]) == (10, 1)
+
+
+def test_replicas_are_independent():
+    """Two replicas on the same tiles with different constants: only the
+    replica with N_HUMANS_CROWDED=2 is crowded."""
+    _, simulation, _ = make_simulation(backend="cpu")
+    simulation = type(simulation)(simulation.env, seed=[0, 1], n_replicas=2)
+    simulation.env.N_HUMANS_CROWDED = np.array([2, 10])
+    for replica in range(2):
+        simulation.add_humans(
+            3, replica, resources=(1, 0), actionpotential=C.AP_DEFAULT
+        )
+        simulation.add_resources(1, replica, x=5 * replica)
+    simulation.step()
+    humans = simulation.humans
+    assert list(humans.id) == [1, 2, 3] * 2, "IDs are counted per replica"
+    assert list(humans.is_crowded) == [1, 1, 1, 0, 0, 0]
+    assert (humans.resources[3:] == (1, 0)).all(), "resource of replica 0 unseen"
+    assert (humans.closest_resource_x[3:, 0] == 5).all()
+
+
+def test_constants():
+    c = C.replace(AP_DEFAULT=2.0, HUNGER_PER_RESOURCE_CONSUMPTION=4)
+    assert c.AP_PER_TICK_RESTING == 2.0 / C.SLEEP_REQUIRED_PER_NIGHT
+    assert c.AP_REDUCTION_BY_CROWDING == 0.2
+    assert c.HUNGER_TO_TRIGGER_CONSUMPTION == 4
+    assert C.AP_DEFAULT == 1.0 and C.HUNGER_TO_TRIGGER_CONSUMPTION == 8
+    with pytest.raises(AttributeError):
+        C.AP_DEFAULT = 2.0
+    with pytest.raises(RuntimeError):
+        C.replace(AP_PER_TICK_RESTING=1.0)
+    with pytest.raises(RuntimeError):
+        C.replace(UNKNOWN=1)
+
+
+def test_make_simulation_constants():
+    constants = C.replace(N_HUMANS_CROWDED=2)
+    _, simulation, _ = make_simulation(backend="cpu", constants=constants)
+    simulation.add_humans(3, actionpotential=C.AP_DEFAULT)
+    simulation.step()
+    assert (simulation.humans.is_crowded == 1).all()
+
+
+def make_random_walk_simulation(n_replicas=1):
+    simulation = sx_cpu.CPUSimulation(
+        make_environment(10), seed=list(range(n_replicas)), n_replicas=n_replicas
+    )
+    for replica in range(n_replicas):
+        simulation.add_humans(20, replica, x=np.arange(20) % 10, actionpotential=1.0)
+        simulation.add_resources(2, replica, x=[2, 8], y=[3, 7], type=[0, 1])
+    return simulation
+
+
+def assert_same_state(a, b):
+    assert a.step_counter == b.step_counter
+    for key in a.humans:
+        assert (a.humans[key] == b.humans[key]).all(), key
+    for key in a.resources:
+        assert (a.resources[key] == b.resources[key]).all(), key
+
+
+@pytest.mark.parametrize("saved", [False, True])
+def test_snapshot_restore(tmp_path, saved):
+    simulation = make_random_walk_simulation(n_replicas=2)
+    for _ in range(15):
+        simulation.step()
+    snapshot = simulation.snapshot()
+    if saved:
+        sx_cpu.save(snapshot, tmp_path / "snapshot.npz")
+        snapshot = sx_cpu.load(tmp_path / "snapshot.npz")
+    restored = sx_cpu.CPUSimulation.restore(snapshot)
+    assert_same_state(simulation, restored)
+    for _ in range(40):
+        simulation.step()
+        restored.step()
+    assert_same_state(simulation, restored)
+    restored.add_humans(1, replica=1)
+    assert restored.humans.id[-1] == 23, "IDs continue"
+
+
+def test_fork():
+    simulation = make_random_walk_simulation()
+    for _ in range(5):
+        simulation.step()
+    snapshot = simulation.snapshot()
+    same, crowded = fork(snapshot, [C, C.replace(N_HUMANS_CROWDED=1)])
+    for _ in range(5):
+        simulation.step()
+        same.step()
+        crowded.step()
+    assert_same_state(simulation, same)
+    assert (crowded.humans.is_crowded == 1).all()
+    assert snapshot.step_counter == 5, "the snapshot is not changed"
@@ -0,0 +1,373 @@
+"""Storage of the human paths ([step, id, x, y] rows) of ABM runs.
+
+A TrajectoryStore is a directory of chunks, written while the run is going:
+
+    index.json              chunk list with the step range of every chunk
+    chunk-000000.npy        rows [step, id, x, y] (int32, column major),
+                            sorted by id, then step
+    chunk-000000-ids.npy    the ids of the chunk and the row of their first
+                            entry (per-agent offset index)
+
+A chunk holds whole steps, so the step ranges of the chunks are the step
+index. Chunks are memory mapped, "path of human k" reads one slice per chunk
+and "all rows of steps [i, j)" only reads the chunks overlapping the window.
+
+CompactPaths keeps paths in memory as move codes, PathIndex wraps plain
+arrays of rows; all three share ids(), path(id) and steps(i, j).
+"""
+
+import glob
+import json
+import os
+
+import numpy as np
+
+COLUMNS = ["step", "id", "x", "y"]
+
+
+def _chunk_file(directory, chunk, suffix=""):
+    return os.path.join(directory, f"chunk-{chunk:06d}{suffix}.npy")
+
+
+class TrajectoryWriter:
+    """TrajectoryWriter appends the rows of one step at a time to the store
+    in `directory`, writing a chunk whenever `chunk_rows` rows are pending. Readers
+    see every written chunk."""
+
+    def __init__(self, directory, chunk_rows=1 << 20):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        os.makedirs(directory, exist_ok=True)
+        # start a new store, dropping the chunks of a previous one
+        for file in glob.glob(os.path.join(directory, "chunk-*.npy")):
+            os.remove(file)
+        self.chunks = []
+        self.pending = []
+        self.n_pending = 0
+        self._write_index()
+
+    def __len__(self):
+        return sum(chunk["rows"] for chunk in self.chunks) + self.n_pending
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def append(self, step, ids, x, y):
+        """append adds the rows of the humans `ids` at `x`, `y` in `step`."""
+        ids = np.asarray(ids)
+        rows = np.empty((len(ids), len(COLUMNS)), dtype="int32")
+        for i, column in enumerate([step, ids, x, y]):
+            rows[:, i] = column
+        self.pending.append(rows)
+        self.n_pending += len(rows)
+        if self.n_pending >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """flush writes the pending rows as a new chunk."""
+        if self.n_pending == 0:
+            return
+        rows = np.concatenate(self.pending)
+        rows = rows[np.lexsort((rows[:, 0], rows[:, 1]))]
+        ids, first = np.unique(rows[:, 1], return_index=True)
+        chunk = len(self.chunks)
+        np.save(_chunk_file(self.directory, chunk), np.asfortranarray(rows))
+        np.save(
+            _chunk_file(self.directory, chunk, "-ids"), np.stack([ids, first], axis=1)
+        )
+        self.chunks.append(
+            {
+                "rows": len(rows),
+                "first_step": int(rows[:, 0].min()),
+                "last_step": int(rows[:, 0].max()),
+            }
+        )
+        self.pending = []
+        self.n_pending = 0
+        self._write_index()
+
+    def close(self):
+        self.flush()
+
+    def _write_index(self):
+        # replace atomically, a reader never sees a partial index
+        tmp = os.path.join(self.directory, "index.json.tmp")
+        with open(tmp, "w") as fd:
+            json.dump({"columns": COLUMNS, "chunks": self.chunks}, fd)
+        os.replace(tmp, os.path.join(self.directory, "index.json"))
+
+
+class TrajectoryStore:
+    """TrajectoryStore reads the paths of a store written by
+    TrajectoryWriter, `refresh` picks up chunks written since opening."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.rows = []
+        self.agents = []
+        self.refresh()
+
+    def refresh(self):
+        with open(os.path.join(self.directory, "index.json")) as fd:
+            self.chunks = json.load(fd)["chunks"]
+        for chunk in range(len(self.rows), len(self.chunks)):
+            self.rows.append(np.load(_chunk_file(self.directory, chunk), mmap_mode="r"))
+            self.agents.append(np.load(_chunk_file(self.directory, chunk, "-ids")))
+
+    def __len__(self):
+        return sum(chunk["rows"] for chunk in self.chunks)
+
+    def ids(self):
+        """ids returns the sorted ids of all humans."""
+        if not self.agents:
+            return np.zeros(0, dtype="int32")
+        return np.unique(np.concatenate([agents[:, 0] for agents in self.agents]))
+
+    def path(self, id):
+        """path returns the rows [step, id, x, y] of human `id` by step."""
+        parts = [np.zeros((0, len(COLUMNS)), dtype="int32")]
+        for rows, agents in zip(self.rows, self.agents):
+            i = np.searchsorted(agents[:, 0], id)
+            if i == len(agents) or agents[i, 0] != id:
+                continue
+            end = agents[i + 1, 1] if i + 1 < len(agents) else len(rows)
+            parts.append(rows[agents[i, 1] : end])
+        return np.concatenate(parts)
+
+    def steps(self, i=None, j=None):
+        """steps returns the rows [step, id, x, y] of the steps [i, j), all
+        steps if a bound is None, ordered by step and id."""
+        i = -np.inf if i is None else i
+        j = np.inf if j is None else j
+        parts = [np.zeros((0, len(COLUMNS)), dtype="int32")]
+        for rows, chunk in zip(self.rows, self.chunks):
+            if chunk["last_step"] < i or chunk["first_step"] >= j:
+                continue
+            if chunk["first_step"] >= i and chunk["last_step"] < j:
+                parts.append(np.asarray(rows))
+            else:
+                parts.append(rows[(rows[:, 0] >= i) & (rows[:, 0] < j)])
+        rows = np.concatenate(parts)
+        return rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+
+
+class PathIndex:
+    """PathIndex gives in-memory paths (an array of [step, id, x, y] rows)
+    the interface of a TrajectoryStore, grouping the rows by id once."""
+
+    def __init__(self, paths):
+        paths = np.asarray(paths).reshape(-1, len(COLUMNS))
+        self.paths = paths[np.lexsort((paths[:, 0], paths[:, 1]))]
+        self._ids, self.first = np.unique(self.paths[:, 1], return_index=True)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def ids(self):
+        return self._ids
+
+    def path(self, id):
+        i = np.searchsorted(self._ids, id)
+        if i == len(self._ids) or self._ids[i] != id:
+            return self.paths[:0]
+        end = self.first[i + 1] if i + 1 < len(self.first) else len(self.paths)
+        return self.paths[self.first[i] : end]
+
+    def steps(self, i=None, j=None):
+        step = self.paths[:, 0]
+        rows = self.paths[
+            (step >= (-np.inf if i is None else i))
+            & (step < (np.inf if j is None else j))
+        ]
+        return rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+
+
+# move codes of CompactPaths, packed two per byte
+ABSENT, STAY, PLUS_X, MINUS_X, PLUS_Y, MINUS_Y, JUMP = range(7)
+_CODE_DX = np.array([0, 0, 1, -1, 0, 0, 0])
+_CODE_DY = np.array([0, 0, 0, 0, 1, -1, 0])
+
+
+class CompactPaths:
+    """CompactPaths keeps paths in memory as one 4 bit move code per human
+    and recorded step instead of [step, id, x, y] rows.
+
+    Humans move at most one tile along one axis per step (see
+    `human_behavior.cu`), so a move is one of: absent (not recorded in this
+    step), stay, +-x, +-y, or a jump (wrapping around the grid, first
+    appearance, sampled steps) whose offset is kept in a side table. Every
+    `keyframe_interval` recorded steps the positions of all humans are stored,
+    decoding a window only replays the moves since the previous keyframe.
+    Rows are decoded lazily by `path` and `steps`.
+    """
+
+    def __init__(self, keyframe_interval=256):
+        self.keyframe_interval = keyframe_interval
+        self.slot_ids = np.zeros(0, dtype="int64")  # id of each slot
+        self._sorted = np.zeros(0, dtype="int64")  # slots sorted by id
+        self.position = np.zeros((0, 2), dtype="int64")  # last known
+        self.step_values = np.zeros(0, dtype="int64")
+        self.codes = np.zeros((0, 0), dtype="uint8")  # recorded steps x slots/2
+        self.keyframes = []
+        self.jumps = np.zeros((0, 4), dtype="int64")  # [row, slot, dx, dy]
+        self.n_rows = 0
+        self.n_jumps = 0
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def nbytes(self):
+        return (
+            self.codes[: self.n_rows].nbytes
+            + sum(keyframe.nbytes for keyframe in self.keyframes)
+            + self.jumps[: self.n_jumps].nbytes
+            + self.step_values[: self.n_rows].nbytes
+            + self.slot_ids.nbytes
+        )
+
+    @classmethod
+    def from_paths(cls, paths, keyframe_interval=256):
+        """from_paths encodes rows [step, id, x, y]."""
+        paths = np.asarray(paths).reshape(-1, len(COLUMNS))
+        paths = paths[np.argsort(paths[:, 0], kind="stable")]
+        compact = cls(keyframe_interval)
+        steps, first = np.unique(paths[:, 0], return_index=True)
+        for step, rows in zip(steps, np.split(paths, first[1:])):
+            compact.append(step, rows[:, 1], rows[:, 2], rows[:, 3])
+        return compact
+
+    def _slots(self, ids):
+        """_slots returns the slot of every id, adding slots for new ids."""
+        i = np.searchsorted(self.slot_ids, ids, sorter=self._sorted)
+        i = np.minimum(i, len(self._sorted) - 1)
+        known = np.zeros(len(ids), dtype=bool)
+        if len(self._sorted) > 0:
+            known = self.slot_ids[self._sorted[i]] == ids
+        if not known.all():
+            new = np.unique(ids[~known])
+            self.slot_ids = np.concatenate([self.slot_ids, new])
+            self._sorted = np.argsort(self.slot_ids, kind="stable")
+            self.position = np.concatenate([self.position, np.zeros((len(new), 2))])
+            self.position = self.position.astype("int64")
+            return self._slots(ids)
+        return self._sorted[i]
+
+    def _reserve(self, rows, slots):
+        capacity, width = self.codes.shape
+        if rows <= capacity and (slots + 1) // 2 <= width:
+            return
+        if rows > capacity:
+            capacity = max(rows, 2 * capacity, 64)
+        codes = np.zeros((capacity, max((slots + 1) // 2, width)), dtype="uint8")
+        codes[: len(self.codes), :width] = self.codes
+        self.codes = codes
+        # one step value per row of codes
+        self.step_values = np.resize(self.step_values, len(codes))
+
+    def append(self, step, ids, x, y):
+        """append adds the positions of the humans `ids` in `step`, steps
+        must be appended in increasing order."""
+        ids = np.asarray(ids, dtype="int64")
+        slots = self._slots(ids)
+        row = self.n_rows
+        self._reserve(row + 1, len(self.slot_ids))
+        xy = np.stack([np.asarray(x), np.asarray(y)], axis=1).reshape(len(ids), 2)
+        dx, dy = (xy - self.position[slots]).T
+        code = np.full(len(ids), JUMP, dtype="uint8")
+        for c in [STAY, PLUS_X, MINUS_X, PLUS_Y, MINUS_Y]:
+            code[(dx == _CODE_DX[c]) & (dy == _CODE_DY[c])] = c
+        jump = code == JUMP
+        if jump.any():
+            jumps = np.column_stack(
+                [np.full(np.count_nonzero(jump), row), slots[jump], dx[jump], dy[jump]]
+            )
+            if self.n_jumps + len(jumps) > len(self.jumps):
+                self.jumps = np.resize(
+                    self.jumps, (max(2 * len(self.jumps), self.n_jumps + len(jumps)), 4)
+                )
+            self.jumps[self.n_jumps : self.n_jumps + len(jumps)] = jumps
+            self.n_jumps += len(jumps)
+        # slot s is in the low (even s) or high (odd s) nibble of byte s // 2
+        np.bitwise_or.at(self.codes[row], slots // 2, code << (4 * (slots % 2)))
+        self.position[slots] = xy
+        self.step_values[row] = step
+        if row % self.keyframe_interval == 0:
+            self.keyframes.append(self.position.astype("int32"))
+        self.n_rows += 1
+        self.n += len(ids)
+
+    def _decode(self, a, b, slots):
+        """_decode returns the codes and positions of `slots` in the recorded
+        steps (rows) [a, b)."""
+        k = a // self.keyframe_interval
+        start = k * self.keyframe_interval
+        keyframe = self.keyframes[k]
+        base = np.zeros((len(slots), 2), dtype="int64")
+        known = slots < len(keyframe)
+        base[known] = keyframe[slots[known]]
+        codes = (self.codes[start + 1 : b, slots // 2] >> (4 * (slots % 2))) & 0xF
+        delta = np.stack([_CODE_DX[codes], _CODE_DY[codes]], axis=-1)
+        jumps = self.jumps[
+            np.searchsorted(self.jumps[: self.n_jumps, 0], start + 1) : np.searchsorted(
+                self.jumps[: self.n_jumps, 0], b
+            )
+        ]
+        column = np.full(len(self.slot_ids), -1)
+        column[slots] = np.arange(len(slots))
+        jumps = jumps[column[jumps[:, 1]] >= 0]
+        delta[jumps[:, 0] - start - 1, column[jumps[:, 1]]] = jumps[:, 2:]
+        position = base + np.concatenate(
+            [np.zeros((1, len(slots), 2), dtype="int64"), np.cumsum(delta, axis=0)]
+        )
+        codes = (self.codes[start:b, slots // 2] >> (4 * (slots % 2))) & 0xF
+        return codes[a - start :], position[a - start :]
+
+    def _rows(self, a, b, slots):
+        codes, position = self._decode(a, b, slots)
+        row, column = np.nonzero(codes != ABSENT)
+        return np.column_stack(
+            [
+                self.step_values[a + row],
+                self.slot_ids[slots[column]],
+                position[row, column],
+            ]
+        )
+
+    def ids(self):
+        """ids returns the sorted ids of all humans."""
+        return self.slot_ids[self._sorted]
+
+    def path(self, id):
+        """path returns the rows [step, id, x, y] of human `id` by step."""
+        slot = np.flatnonzero(self.slot_ids == id)
+        rows = [np.zeros((0, len(COLUMNS)), dtype="int64")]
+        for k in range(len(self.keyframes)) if len(slot) > 0 else []:
+            a = k * self.keyframe_interval
+            rows.append(
+                self._rows(a, min(a + self.keyframe_interval, self.n_rows), slot)
+            )
+        return np.concatenate(rows)
+
+    def steps(self, i=None, j=None):
+        """steps returns the rows [step, id, x, y] of the steps [i, j), all
+        steps if a bound is None, ordered by step and id."""
+        steps = self.step_values[: self.n_rows]
+        a = 0 if i is None else np.searchsorted(steps, i)
+        b = self.n_rows if j is None else np.searchsorted(steps, j)
+        if a >= b:
+            return np.zeros((0, len(COLUMNS)), dtype="int64")
+        rows = self._rows(a, b, self._sorted)
+        return rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+
+
+def as_trajectories(paths):
+    """as_trajectories returns `paths` as TrajectoryStore, CompactPaths or
+    PathIndex."""
+    if isinstance(paths, (TrajectoryStore, PathIndex, CompactPaths)):
+        return paths
+    return PathIndex(paths)
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+import trajectories
+
+
+def make_paths(n_steps=10, n_humans=5):
+    rng = np.random.default_rng(0)
+    step, id = np.divmod(np.arange(n_steps * n_humans), n_humans)
+    xy = rng.integers(0, 50, (len(step), 2))
+    return np.column_stack([step, id + 1, xy])
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 7, 1000])
+def test_trajectory_store(tmp_path, chunk_rows):
+    paths = make_paths()
+    with trajectories.TrajectoryWriter(tmp_path, chunk_rows=chunk_rows) as writer:
+        for step in range(10):
+            rows = paths[paths[:, 0] == step]
+            writer.append(step, rows[:, 1], rows[:, 2], rows[:, 3])
+    store = trajectories.TrajectoryStore(tmp_path)
+    assert len(store) == len(paths)
+    assert list(store.ids()) == [1, 2, 3, 4, 5]
+    for id in store.ids():
+        assert (store.path(id) == paths[paths[:, 1] == id]).all()
+    assert len(store.path(42)) == 0
+    assert (store.steps(3, 6) == paths[(paths[:, 0] >= 3) & (paths[:, 0] < 6)]).all()
+    assert (store.steps() == paths).all()
+    assert isinstance(store.rows[0], np.memmap)
+
+
+def test_trajectory_store_read_while_writing(tmp_path):
+    paths = make_paths()
+    writer = trajectories.TrajectoryWriter(tmp_path, chunk_rows=10)
+    store = trajectories.TrajectoryStore(tmp_path)
+    assert len(store) == 0
+    for step in range(3):
+        rows = paths[paths[:, 0] == step]
+        writer.append(step, rows[:, 1], rows[:, 2], rows[:, 3])
+    store.refresh()
+    assert len(store) == 10, "only written chunks are visible"
+    assert (store.steps() == paths[:10]).all()
+    writer.close()
+    store.refresh()
+    assert len(store) == 15
+
+
+def test_path_index():
+    paths = make_paths()
+    index = trajectories.as_trajectories(paths)
+    assert list(index.ids()) == [1, 2, 3, 4, 5]
+    assert (index.path(3) == paths[paths[:, 1] == 3]).all()
+    assert (index.steps(3, 6) == paths[(paths[:, 0] >= 3) & (paths[:, 0] < 6)]).all()
+
+
+def random_walks(n_humans=30, n_steps=300, grid_size=10):
+    """random walks with wraps around the grid and humans dying"""
+    rng = np.random.default_rng(1)
+    moves = np.array([[0, 0], [1, 0], [-1, 0], [0, 1], [0, -1]])
+    xy = rng.integers(0, grid_size, (n_humans, 2))
+    alive = np.ones(n_humans, dtype=bool)
+    rows = []
+    for step in range(n_steps):
+        xy = (xy + moves[rng.integers(0, 5, n_humans)]) % grid_size
+        alive &= rng.random(n_humans) > 0.005
+        ids = np.flatnonzero(alive) + 1
+        rows.append(np.column_stack([np.full(len(ids), step), ids, xy[alive]]))
+    return np.concatenate(rows)
+
+
+@pytest.mark.parametrize("every", [1, 7])
+@pytest.mark.parametrize("keyframe_interval", [1, 16, 1000])
+def test_compact_paths(every, keyframe_interval):
+    paths = random_walks()
+    paths = paths[paths[:, 0] % every == 0]
+    compact = trajectories.CompactPaths.from_paths(paths, keyframe_interval)
+    assert len(compact) == len(paths)
+    assert (compact.ids() == np.unique(paths[:, 1])).all()
+    assert (compact.steps() == paths).all()
+    window = (paths[:, 0] >= 33) & (paths[:, 0] < 170)
+    assert (compact.steps(33, 170) == paths[window]).all()
+    assert len(compact.steps(170, 33)) == 0
+    for id in [1, 17, 30]:
+        assert (compact.path(id) == paths[paths[:, 1] == id]).all()
+    if every == 1 and keyframe_interval > 1:
+        assert compact.nbytes * 4 < paths.nbytes
+
+
+def test_compact_paths_new_ids_after_first_step():
+    compact = trajectories.CompactPaths()
+    compact.append(0, [1], [0], [0])
+    rows = [[0, 1, 0, 0]]
+    for step in range(1, 100):
+        compact.append(step, [1, 2, 3], [step, 1, 2], [0, step, 3])
+        rows += [[step, 1, step, 0], [step, 2, 1, step], [step, 3, 2, 3]]
+    assert (compact.steps() == rows).all()
+    paths = np.array(rows)
+    paths = paths[paths[:, 1] != 1]
+    assert (trajectories.CompactPaths.from_paths(paths).steps() == paths).all()
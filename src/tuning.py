@@ -0,0 +1,118 @@
+"""Tuning of the ABM hyperparameters with optuna.
+
+ABM runs report an interim loss to their trial, so that pruners stop hopeless
+trials early, and local workers share a study through an append-only journal
+file instead of an SQLite database, which serializes them on its lock.
+
+Example objective:
+
+    def objective(trial, problem, sinkhorn):
+        config = {"n_humans": trial.suggest_int("n_humans", 50, 300)}
+        callback = tuning.PruningCallback(trial, problem, sinkhorn)
+        M, _ = solver.solve_ot_with_abm(problem, None, **config, callback=callback)
+        callback.raise_if_pruned()
+        return tuning.loss_difference(problem, M, sinkhorn)
+"""
+
+import optuna
+from optuna.storages import JournalStorage
+from optuna.storages.journal import JournalFileBackend
+
+import optimal_transport as solver
+import parallel
+import util
+
+
+def loss_difference(problem, M, solution_ot):
+    """loss_difference returns the difference in % of the loss of the doubly
+    stochastic plan of the ABM cost matrix `M` to the loss of `solution_ot`."""
+    result = solver.compare(problem, None, util.doubly_stochastic(M), solution_ot)
+    return abs(result.loss_abm - result.loss_ot) / result.loss_ot * 100
+
+
+class PruningCallback:
+    """PruningCallback is a callback for solve_ot_with_abm, which reports the
+    loss_difference of the plan so far to `trial` and stops the run if the
+    pruner of the study prunes the trial.
+
+    It stops the run rather than raising optuna.TrialPruned, so that only
+    this replica of a solve_ot_with_abm_ensemble ends. The objective calls
+    `raise_if_pruned` once the run returned.
+    """
+
+    def __init__(self, trial, problem, solution_ot):
+        self.trial = trial
+        self.problem = problem
+        self.solution_ot = solution_ot
+        # step at which the trial was pruned
+        self.pruned_at = None
+
+    def __call__(self, step, M):
+        self.trial.report(loss_difference(self.problem, M, self.solution_ot), step)
+        if self.trial.should_prune():
+            self.pruned_at = step
+            return True
+        return False
+
+    def raise_if_pruned(self):
+        """raise_if_pruned raises optuna.TrialPruned if the run was pruned."""
+        if self.pruned_at is not None:
+            raise optuna.TrialPruned(f"pruned at step {self.pruned_at}")
+
+
+def journal_storage(path):
+    """journal_storage returns an optuna storage in the journal file `path`,
+    which processes share by appending to it."""
+    return JournalStorage(JournalFileBackend(str(path)))
+
+
+def _optimize(study_name, path, objective, n_trials, sampler, pruner):
+    study = optuna.load_study(
+        study_name=study_name,
+        storage=journal_storage(path),
+        sampler=sampler,
+        pruner=pruner,
+    )
+    study.optimize(objective, n_trials=n_trials)
+
+
+def optimize(
+    study_name,
+    path,
+    objective,
+    n_trials,
+    workers=None,
+    direction="minimize",
+    sampler=None,
+    pruner=None,
+):
+    """optimize runs `n_trials` trials of `objective(trial)` on `workers`
+    processes (default: parallel.WORKERS), which share the study `study_name`
+    in the journal file `path`. The study is created if it does not exist.
+
+    `objective`, `sampler` and `pruner` must be picklable, see
+    parallel.parallel_map; samplers and pruners are not stored in the
+    journal, every worker uses the given ones (default: optuna's).
+
+    Returns: the study
+    """
+    workers = parallel.WORKERS if workers is None else workers
+    optuna.create_study(
+        study_name=study_name,
+        storage=journal_storage(path),
+        direction=direction,
+        load_if_exists=True,
+    )
+    shares = [len(share) for share in parallel.split(range(n_trials), workers)]
+    n = len(shares)
+    parallel.parallel_map(
+        _optimize,
+        [study_name] * n,
+        [str(path)] * n,
+        [objective] * n,
+        shares,
+        [sampler] * n,
+        [pruner] * n,
+        workers=workers,
+    )
+    return optuna.load_study(study_name=study_name, storage=journal_storage(path))
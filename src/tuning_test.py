@@ -0,0 +1,109 @@
+import numpy as np
+import optuna
+import pytest
+
+import optimal_transport as solver
+import tuning
+
+
+def make_problem():
+    np.random.seed(0)
+    xs, xt = solver.generate_distributions(s=10, t=10)
+    problem = solver.Problem(xs, xt)
+    sinkhorn, _ = solver.solve_ot_with_sinkhorn(problem, None, emd=False)
+    return problem, sinkhorn
+
+
+def test_solve_ot_with_abm_callback():
+    problem, _ = make_problem()
+    config = {"n_humans": 20, "steps": 60, "backend": "cpu"}
+    exp_M, exp_meta = solver.solve_ot_with_abm(problem, None, **config)
+    calls = []
+
+    def callback(step, M):
+        calls.append((step, M))
+
+    M, meta = solver.solve_ot_with_abm(
+        problem, None, **config, callback=callback, callback_every=20
+    )
+    assert (M == exp_M).all(), "reporting does not change the run"
+    assert [step for step, _ in calls] == [20, 40, 60]
+    assert (calls[-1][1] == exp_M).all()
+    M, meta = solver.solve_ot_with_abm(
+        problem, None, **config, callback=lambda step, M: step == 40, callback_every=20
+    )
+    assert len(meta["alive_humans"]) == 40, "stopped"
+
+
+def test_solve_ot_with_abm_ensemble_callback():
+    problem, _ = make_problem()
+    configs = [{"n_humans": 20, "steps": 60, "seed": i} for i in range(2)]
+    configs[0]["callback"] = lambda step, M: step == 20
+    configs[0]["callback_every"] = 10
+    (_, stopped), (M, meta) = solver.solve_ot_with_abm_ensemble([problem] * 2, configs)
+    assert len(stopped["alive_humans"]) == 20
+    exp_M, _ = solver.solve_ot_with_abm(problem, None, **configs[1], backend="cpu")
+    assert (M == exp_M).all()
+
+
+def test_pruning_callback():
+    problem, sinkhorn = make_problem()
+
+    def objective(trial):
+        callback = tuning.PruningCallback(trial, problem, sinkhorn)
+        M, _ = solver.solve_ot_with_abm(
+            problem,
+            None,
+            n_humans=trial.suggest_int("n_humans", 10, 20),
+            steps=60,
+            backend="cpu",
+            callback=callback,
+            callback_every=20,
+        )
+        callback.raise_if_pruned()
+        return tuning.loss_difference(problem, M, sinkhorn)
+
+    study = optuna.create_study(pruner=optuna.pruners.ThresholdPruner(upper=1e-9))
+    study.optimize(objective, n_trials=1)
+    [trial] = study.trials
+    assert trial.state == optuna.trial.TrialState.PRUNED
+    assert list(trial.intermediate_values) == [20]
+    study = optuna.create_study(pruner=optuna.pruners.NopPruner())
+    study.optimize(objective, n_trials=1)
+    [trial] = study.trials
+    assert list(trial.intermediate_values) == [20, 40, 60]
+    assert trial.value == pytest.approx(trial.intermediate_values[60])
+
+
+def test_pruning_callback_ensemble():
+    problem, sinkhorn = make_problem()
+    pruned = optuna.create_study(pruner=optuna.pruners.ThresholdPruner(upper=1e-9))
+    kept = optuna.create_study(pruner=optuna.pruners.NopPruner())
+    callbacks = [
+        tuning.PruningCallback(study.ask(), problem, sinkhorn)
+        for study in [pruned, kept]
+    ]
+    config = {"n_humans": 20, "steps": 60, "callback_every": 20}
+    (_, pruned_meta), (_, kept_meta) = solver.solve_ot_with_abm_ensemble(
+        [problem] * 2, [{**config, "callback": c} for c in callbacks]
+    )
+    assert len(pruned_meta["alive_humans"]) == 20, "only the pruned replica stops"
+    assert len(kept_meta["alive_humans"]) == 60
+    with pytest.raises(optuna.TrialPruned):
+        callbacks[0].raise_if_pruned()
+    callbacks[1].raise_if_pruned()
+
+
+def quadratic(trial):
+    x = trial.suggest_float("x", -10, 10)
+    return (x - 2) ** 2
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_optimize(tmp_path, workers):
+    path = tmp_path / "journal.log"
+    study = tuning.optimize("test", path, quadratic, 6, workers=workers)
+    assert len(study.trials) == 6
+    study = tuning.optimize("test", path, quadratic, 2, workers=workers)
+    assert len(study.trials) == 8, "continues the study"
+    assert study.best_value == min(t.value for t in study.trials)
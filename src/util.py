@@ -1,106 +1,355 @@
 import numpy as np
 
+# columns of the resource collection events of the model, one row per
+# collection, see sx_cpu.CPUSimulation.events and human_behavior.cu
+COLLECTION_EVENT_COLUMNS = ["step", "id", "resource_id", "x", "y", "type"]
+
+
+def _event_columns(events, names):
+    """_event_columns returns the columns `names` of the collection `events`,
+    rows of COLLECTION_EVENT_COLUMNS or of just the columns `names`."""
+    if events.shape[1] == len(COLLECTION_EVENT_COLUMNS):
+        return events[:, [COLLECTION_EVENT_COLUMNS.index(name) for name in names]]
+    return events
+
+
+def _location_slots(locations, events):
+    """_location_slots returns the index of the first row in `locations` equal
+    to each row of `events`, -1 if there is none."""
+    rows = np.concatenate([locations, events]).reshape(len(locations) + len(events), -1)
+    _, inverse = np.unique(rows, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    first = np.full(inverse.max() + 1, len(locations))
+    np.minimum.at(first, inverse[: len(locations)], np.arange(len(locations)))
+    slots = first[inverse[len(locations) :]]
+    slots[slots == len(locations)] = -1
+    return slots
+
+
+def _next_where(flag, start, end):
+    """_next_where returns for each `start` the first index i >= start with
+    flag[i], if there is none before `end` it returns `end`."""
+    n = len(flag)
+    index = np.append(np.where(flag, np.arange(n), n), n)
+    next_index = np.minimum.accumulate(index[::-1])[::-1]
+    return np.minimum(next_index[np.minimum(start, n)], end)
+
+
+def _transport_pairs(
+    collections, srcLocations, tgtLocations, use_last_only, return_open=False
+):
+    """_transport_pairs returns the (source, target) event pairs of the
+    collection events, see `collected_resource_list_to_cost_matrix`.
+
+    Returns: i, j, x, y, weight
+        for every pair the rows of both events in `collections`, the slot in
+        the cost matrix (-1 if the locations are unknown) and its weight. The
+        pairs are in the order in which the cost matrix accumulates them.
+        If `return_open`, also the masks of the pairs and of the rows of the
+        last segment of every agent, which later events can still change.
+    """
+    # group the events by agent in order of first appearance, keeping the
+    # order of the events of each agent
+    _, first, agent = np.unique(
+        collections[:, 0], return_index=True, return_inverse=True
+    )
+    rank = np.argsort(np.argsort(first))[agent.reshape(-1)]
+    order = np.argsort(rank, kind="stable")
+    events, agent = collections[order, 1:], rank[order]
+    n = len(events)
+    position = np.arange(n)
+    end = np.searchsorted(agent, agent, side="right")  # end of the agents events
+    # hash the locations once
+    src_slot = _location_slots(srcLocations, events)
+    tgt_slot = _location_slots(tgtLocations, events)
+    is_src, is_tgt = src_slot >= 0, tgt_slot >= 0
+    equal_to_previous = np.zeros(n, dtype=bool)
+    equal_to_previous[1:] = (events[1:] == events[:-1]).all(axis=1) & (
+        agent[1:] == agent[:-1]
+    )
+    # segment starting at p: src = [p, q), tgt = [q, r)
+    run_end = _next_where(~equal_to_previous, position + 1, end)
+    q = np.full(n, n)
+    r = np.full(n, n)
+    # the events that can be paired with `a` depend on whether `a` is a
+    # source and/or a target location
+    for is_a, flag in [
+        (is_src & is_tgt, is_src | is_tgt),
+        (is_src & ~is_tgt, is_tgt),
+        (~is_src & is_tgt, is_src),
+    ]:
+        q[is_a] = _next_where(flag, run_end, end)[is_a]
+        r[is_a] = _next_where(~flag, q + 1, end)[is_a]
+    has_tgt = q < end
+
+    # follow the segments of all agents in lockstep
+    segments = []
+    p = np.searchsorted(agent, np.arange(agent[-1] + 1))
+    last = p.copy()  # start of the last segment of every agent
+    while len(p) > 0:
+        last[agent[p]] = p
+        p = p[has_tgt[p]]
+        segments.append(p)
+        p = r[p][r[p] < end[p]]
+    p = np.sort(np.concatenate(segments))
+    is_open = p == last[agent[p]]
+    q, r = q[p], r[p]
+    if use_last_only:
+        i, j, weight = q - 1, q, np.ones(len(p))
+        open_pair = is_open
+    else:
+        n_src, n_tgt = q - p, r - q
+        pairs = n_src * n_tgt
+        segment = np.repeat(np.arange(len(p)), pairs)
+        k = np.arange(pairs.sum()) - np.repeat(np.cumsum(pairs) - pairs, pairs)
+        i = p[segment] + k // n_tgt[segment]
+        j = q[segment] + k % n_tgt[segment]
+        weight = 1 / pairs[segment]
+        open_pair = is_open[segment]
+    forward = is_src[i] & is_tgt[j]
+    backward = ~forward & is_src[j] & is_tgt[i]
+    valid = forward | backward
+    x = np.where(valid, np.where(forward, src_slot[i], src_slot[j]), -1)
+    y = np.where(valid, np.where(forward, tgt_slot[j], tgt_slot[i]), -1)
+    if not return_open:
+        return order[i], order[j], x, y, weight
+    open_row = np.zeros(n, dtype=bool)
+    open_row[order] = position >= last[agent]
+    return order[i], order[j], x, y, weight, open_pair, open_row
+
 
 def collected_resource_list_to_cost_matrix(
     collections, srcLocations, tgtLocations, use_last_only=False
 ):
+    """collected_resource_list_to_cost_matrix converts the resource collection
+    events `collections` (rows of [agent id, x, y] or of
+    COLLECTION_EVENT_COLUMNS in order of collection) into a normalized
+    transport plan from srcLocations to tgtLocations.
+
+    The events of an agent are split into consecutive segments of sources
+    `src` and targets `tgt`: `src` starts with an event `a` and collects the
+    events equal to `a` and all following events that can not be paired with
+    `a`. `tgt` is the run of events after it that can be paired with `a`, the
+    first event after it starts the next segment. Every pair of `src` x `tgt`
+    transports 1/(len(src) * len(tgt)), or only the pair of the last source
+    and the first target if `use_last_only`.
+    """
+    srcLocations, tgtLocations = np.asarray(srcLocations), np.asarray(tgtLocations)
     cost = np.zeros((len(srcLocations), len(tgtLocations)), dtype="float")
-    agents = {}
-    for event in collections:
-        event = np.array(event)
-        if event[0] not in agents.keys():
-            agents[event[0]] = []
-        agents[event[0]].append(event[1:])
-
-    def get_resource_slot(path):
-        x = np.where((srcLocations == path[0]).all(axis=1))[0]
-        y = np.where((tgtLocations == path[1]).all(axis=1))[0]
-        if len(x) == 0 or len(y) == 0:
-            x = np.where((srcLocations == path[1]).all(axis=1))[0]
-            y = np.where((tgtLocations == path[0]).all(axis=1))[0]
-        if len(x) == 0 or len(y) == 0:
-            return None, None
-        x, y = x[0], y[0]
-        return x, y
-
-    def is_valid(path):
-        x, y = get_resource_slot(path)
-        if x is not None and y is not None:
-            return True
-        return False
-
-    for id, events in agents.items():
-        it = iter(events)
-        prefix = None
-        while True:
-            src, tgt = [], []
-            if prefix is not None:
-                src.append(prefix)
-                prefix = None
-            try:
-                if len(src) == 0:
-                    src.append(next(it))
-                tgt.append(next(it))
-                while (src[0] == tgt[-1]).all():
-                    src.append(tgt.pop())
-                    tgt.append(next(it))
-                while not is_valid([src[0], tgt[-1]]):
-                    src.append(tgt.pop())
-                    tgt.append(next(it))
-                stop = False
-                while is_valid([src[0], tgt[-1]]):
-                    try:
-                        tgt.append(next(it))
-                    except StopIteration:
-                        stop = True
-                        break
-                if not stop:
-                    prefix = tgt.pop()
-                if use_last_only:
-                    src = [src[-1]]
-                    tgt = [tgt[0]]
-                for i in range(len(src)):
-                    for j in range(len(tgt)):
-                        x, y = get_resource_slot([src[i], tgt[j]])
-                        cost[x, y] += 1 / (len(src) * len(tgt))
-                if stop:
-                    break
-            except StopIteration:
-                break
+    collections = np.asarray(collections)
+    if collections.size == 0:
+        return cost
+    collections = _event_columns(
+        collections.reshape(len(collections), -1), ["id", "x", "y"]
+    )
+    _, _, x, y, weight = _transport_pairs(
+        collections, srcLocations, tgtLocations, use_last_only
+    )
+    valid = x >= 0
+    np.add.at(cost, (x[valid], y[valid]), weight[valid])
+    # pairs without a slot (unknown locations) are added to every cell
+    cost += np.sum(weight[~valid])
     if np.sum(cost) == 0:
         return cost
     return cost / np.sum(cost)
 
 
+class CostMatrixIndex:
+    """CostMatrixIndex answers "cost matrix of the steps [i, j)" for the
+    resource collections of one run without re-scanning the event log.
+
+    The transport pairs of the whole run are computed once and each pair is
+    booked on the step of its later event (the step the transport completes).
+    Per cell prefix sums over the steps turn every window into two binary
+    searches per cell. Unlike filtering the events first, segments crossing
+    the window border keep the weights of the whole run, `filtered_cost_matrix`
+    filters first.
+
+    Arguments:
+        collected_resources: rows of [step, agent id, x, y] or of
+            COLLECTION_EVENT_COLUMNS
+    """
+
+    def __init__(
+        self, collected_resources, srcLocations, tgtLocations, use_last_only=False
+    ):
+        srcLocations, tgtLocations = np.asarray(srcLocations), np.asarray(tgtLocations)
+        self.shape = (len(srcLocations), len(tgtLocations))
+        self.locations = (srcLocations, tgtLocations)
+        self.use_last_only = use_last_only
+        events = np.asarray(collected_resources)
+        if events.ndim != 2:
+            events = events.reshape(-1, 4)
+        self.events = events[np.argsort(events[:, 0], kind="stable")]
+        n_cells = self.shape[0] * self.shape[1]
+        if len(events) > 0:
+            i, j, x, y, weight = _transport_pairs(
+                _event_columns(self.events, ["step", "id", "x", "y"])[:, 1:],
+                srcLocations,
+                tgtLocations,
+                use_last_only,
+            )
+            step = np.maximum(self.events[i, 0], self.events[j, 0])
+            # pairs of unknown locations go to an extra cell added to all
+            cell = np.where(x >= 0, x * self.shape[1] + y, n_cells)
+        else:
+            step, cell, weight = np.zeros((3, 0), dtype="int64")
+        self.first_step = int(step.min()) if len(step) > 0 else 0
+        self.n_steps = int(step.max()) - self.first_step + 2 if len(step) > 0 else 1
+        self.key = cell * self.n_steps + (step - self.first_step)
+        order = np.argsort(self.key, kind="stable")
+        self.key = self.key[order]
+        self.prefix = np.concatenate([[0], np.cumsum(weight[order])])
+        self.cells = np.arange(n_cells + 1) * self.n_steps
+
+    def _bound(self, step):
+        step = np.clip(step - self.first_step, 0, self.n_steps - 1)
+        return np.searchsorted(self.key, self.cells + step)
+
+    def events_between(self, i=None, j=None):
+        """events_between returns the collection events of the steps [i, j)."""
+        steps = self.events[:, 0]
+        lo = 0 if i is None else np.searchsorted(steps, i)
+        hi = len(steps) if j is None else np.searchsorted(steps, j)
+        return self.events[lo:hi]
+
+    def filtered_cost_matrix(self, i, j):
+        """filtered_cost_matrix returns the normalized transport plan of only
+        the events of the steps (i, j), as collected_resource_list_to_cost_matrix
+        of these events: segments are cut at the window borders."""
+        events = _event_columns(self.events_between(i + 1, j), ["step", "id", "x", "y"])
+        return collected_resource_list_to_cost_matrix(
+            events[:, 1:], *self.locations, self.use_last_only
+        )
+
+    def cost_matrix(self, i=None, j=None):
+        """cost_matrix returns the normalized transport plan of the pairs
+        completed in the steps [i, j), all steps if a bound is None."""
+        lo = self._bound(self.first_step if i is None else i)
+        hi = self._bound(self.first_step + self.n_steps if j is None else j)
+        cells = self.prefix[hi] - self.prefix[lo]
+        cost = cells[:-1].reshape(self.shape) + cells[-1]
+        if np.sum(cost) == 0:
+            return cost
+        return cost / np.sum(cost)
+
+
+class CostMatrixAccumulator:
+    """CostMatrixAccumulator keeps the cost matrix of a growing stream of
+    collection events up to date, `add` costs only the new events.
+
+    The segments of an agent (see collected_resource_list_to_cost_matrix)
+    only depend on its events from their start on, so all but the last
+    segment of every agent are final once the next one starts. Their pairs
+    are summed up, while the events of the last segment are kept and paired
+    again with the next events of their agent.
+
+    `cost_matrix()` equals collected_resource_list_to_cost_matrix of all
+    events added so far.
+    """
+
+    def __init__(self, srcLocations, tgtLocations, use_last_only=False):
+        srcLocations, tgtLocations = np.asarray(srcLocations), np.asarray(tgtLocations)
+        self.shape = (len(srcLocations), len(tgtLocations))
+        self.locations = (srcLocations, tgtLocations)
+        self.use_last_only = use_last_only
+        # sums of the final pairs per cell, the last one is added to all
+        self.final = np.zeros(self.shape[0] * self.shape[1] + 1)
+        # rows of [agent id, x, y] of the last segments of all agents and
+        # (agent id, cell, weight) of their pairs
+        self.open_events = np.zeros((0, 3), dtype="int64")
+        self.open_pairs = np.zeros((0, 3))
+
+    def add(self, collections):
+        """add adds the collection events `collections` (rows of
+        [agent id, x, y] or of COLLECTION_EVENT_COLUMNS in order of
+        collection), which follow all events added before."""
+        collections = np.asarray(collections)
+        if collections.size == 0:
+            return
+        collections = _event_columns(
+            collections.reshape(len(collections), -1), ["id", "x", "y"]
+        )
+        # pair the new events again with the last segments of their agents
+        touched = np.isin(self.open_events[:, 0], collections[:, 0])
+        events = np.concatenate([self.open_events[touched], collections])
+        i, _, x, y, weight, open_pair, open_row = _transport_pairs(
+            events, *self.locations, self.use_last_only, return_open=True
+        )
+        cell = np.where(x >= 0, x * self.shape[1] + y, self.final.size - 1)
+        np.add.at(self.final, cell[~open_pair], weight[~open_pair])
+        self.open_events = np.concatenate(
+            [self.open_events[~touched], events[open_row]]
+        )
+        pairs = np.stack([events[i, 0], cell, weight], axis=1)[open_pair]
+        self.open_pairs = np.concatenate(
+            [self.open_pairs[~np.isin(self.open_pairs[:, 0], events[:, 0])], pairs]
+        )
+
+    def cost_matrix(self):
+        """cost_matrix returns the normalized transport plan of all events
+        added so far."""
+        cells = self.final.copy()
+        np.add.at(cells, self.open_pairs[:, 1].astype("int64"), self.open_pairs[:, 2])
+        cost = cells[:-1].reshape(self.shape) + cells[-1]
+        if np.sum(cost) == 0:
+            return cost
+        return cost / np.sum(cost)
+
+
 def _fix_zeros(M):
     """_fix_zeros checks for zeros in rows (axis=1) and columns (axis=0) and
-    distribute evenly."""
-    for i in range(2):
-        range_sum = M.sum(axis=i)
-        zero_row_indices = np.where(range_sum == 0)[0]
-        if zero_row_indices.size > 0:
-            replacement_value = 1 / M.shape[i]
-            for idx in zero_row_indices:
-                if i == 0:
-                    M[:, idx] = replacement_value
-                else:
-                    M[idx] = replacement_value
+    distribute evenly. M can be a stack of matrices (..., rows, columns), it
+    is modified in place."""
+    n_rows, n_cols = M.shape[-2:]
+    zero_cols = M.sum(axis=-2, keepdims=True) == 0
+    M[np.broadcast_to(zero_cols, M.shape)] = 1 / n_rows
+    zero_rows = M.sum(axis=-1, keepdims=True) == 0
+    M[np.broadcast_to(zero_rows, M.shape)] = 1 / n_cols
     return M
 
 
-def doubly_stochastic(M):
+def doubly_stochastic(
+    M, tol=1e-9, max_iterations=1000, out=None, return_iterations=False
+):
     """doubly_stochastic tries to convert matrix M into a doubly stochastic
-    matrix (see https://en.wikipedia.org/wiki/Doubly_stochastic_matrix)."""
-    n_rows, n_cols = M.shape
+    matrix (see https://en.wikipedia.org/wiki/Doubly_stochastic_matrix) by
+    alternately normalizing rows and columns (Sinkhorn-Knopp).
+
+    Arguments:
+        M: matrix or stack of matrices (..., rows, columns), all converted at
+            once
+        tol: stop when the row sums of all matrices deviate by at most `tol`
+            (relative) from 1/rows, None always runs `max_iterations`
+        out: buffer for the result, may be M itself to work in place
+        return_iterations: also return the number of iterations used
+
+    Returns: M or (M, iterations)
+    """
+    M = np.asarray(M)
+    if out is None:
+        out = np.array(M, dtype="float")
+    elif out is not M:
+        out[...] = M
+    n_rows, n_cols = out.shape[-2:]
     target_row_sum = 1 / n_rows
     target_col_sum = 1 / n_cols
-    _fix_zeros(M)
-    # Iteratively adjust rows and columns
-    for _ in range(1000):  # Limit iterations to ensure convergence
+    _fix_zeros(out)
+    row_sums = out.sum(axis=-1, keepdims=True)
+    col_sums = np.empty(out.shape[:-2] + (1, n_cols), dtype=out.dtype)
+    iterations = 0
+    while iterations < max_iterations:
+        iterations += 1
         # Normalize rows
-        row_sums = M.sum(axis=1, keepdims=True)
-        M = M / row_sums * target_row_sum
+        np.divide(target_row_sum, row_sums, out=row_sums)
+        out *= row_sums
         # Normalize columns
-        col_sums = M.sum(axis=0, keepdims=True)
-        M = M / col_sums * target_col_sum
-    return M
+        np.sum(out, axis=-2, keepdims=True, out=col_sums)
+        np.divide(target_col_sum, col_sums, out=col_sums)
+        out *= col_sums
+        np.sum(out, axis=-1, keepdims=True, out=row_sums)
+        if tol is not None and np.max(np.abs(row_sums * n_rows - 1)) <= tol:
+            break
+    if return_iterations:
+        return out, iterations
+    return out
@@ -3,6 +3,77 @@ import pytest
 import numpy as np
 
 
+def reference_cost_matrix(collections, srcLocations, tgtLocations, use_last_only=False):
+    """reference_cost_matrix is the original iterator based implementation of
+    util.collected_resource_list_to_cost_matrix."""
+    cost = np.zeros((len(srcLocations), len(tgtLocations)), dtype="float")
+    agents = {}
+    for event in collections:
+        event = np.array(event)
+        if event[0] not in agents.keys():
+            agents[event[0]] = []
+        agents[event[0]].append(event[1:])
+
+    def get_resource_slot(path):
+        x = np.where((srcLocations == path[0]).all(axis=1))[0]
+        y = np.where((tgtLocations == path[1]).all(axis=1))[0]
+        if len(x) == 0 or len(y) == 0:
+            x = np.where((srcLocations == path[1]).all(axis=1))[0]
+            y = np.where((tgtLocations == path[0]).all(axis=1))[0]
+        if len(x) == 0 or len(y) == 0:
+            return None, None
+        x, y = x[0], y[0]
+        return x, y
+
+    def is_valid(path):
+        x, y = get_resource_slot(path)
+        if x is not None and y is not None:
+            return True
+        return False
+
+    for id, events in agents.items():
+        it = iter(events)
+        prefix = None
+        while True:
+            src, tgt = [], []
+            if prefix is not None:
+                src.append(prefix)
+                prefix = None
+            try:
+                if len(src) == 0:
+                    src.append(next(it))
+                tgt.append(next(it))
+                while (src[0] == tgt[-1]).all():
+                    src.append(tgt.pop())
+                    tgt.append(next(it))
+                while not is_valid([src[0], tgt[-1]]):
+                    src.append(tgt.pop())
+                    tgt.append(next(it))
+                stop = False
+                while is_valid([src[0], tgt[-1]]):
+                    try:
+                        tgt.append(next(it))
+                    except StopIteration:
+                        stop = True
+                        break
+                if not stop:
+                    prefix = tgt.pop()
+                if use_last_only:
+                    src = [src[-1]]
+                    tgt = [tgt[0]]
+                for i in range(len(src)):
+                    for j in range(len(tgt)):
+                        x, y = get_resource_slot([src[i], tgt[j]])
+                        cost[x, y] += 1 / (len(src) * len(tgt))
+                if stop:
+                    break
+            except StopIteration:
+                break
+    if np.sum(cost) == 0:
+        return cost
+    return cost / np.sum(cost)
+
+
 @pytest.mark.parametrize(
     "name, pos_source, pos_target, collection_list, use_last_only, exp",
     [
@@ -184,6 +255,125 @@ def test_collected_resource_list_to_cost_matrix(
     assert (exp == got).all()
 
 
+@pytest.mark.parametrize("use_last_only", [False, True])
+@pytest.mark.parametrize(
+    "seed, n_agents, n_events, n_locations",
+    [[0, 1, 20, 2], [1, 5, 200, 4], [2, 20, 500, 6], [3, 3, 100, 10]],
+)
+def test_collected_resource_list_to_cost_matrix_random(
+    seed, n_agents, n_events, n_locations, use_last_only
+):
+    """random event streams, including repeated, unknown and locations which
+    are both source and target, give the result of the reference."""
+    rng = np.random.default_rng(seed)
+    locations = rng.permutation(n_locations * n_locations)[: 2 * n_locations]
+    locations = np.stack(np.divmod(locations, n_locations), axis=1)
+    pos_source = locations[: n_locations // 2 + 1]
+    pos_target = locations[n_locations // 2 : n_locations + 1]
+    ids = rng.integers(1, n_agents + 1, n_events)
+    events = locations[rng.integers(0, n_locations + 1, n_events)]
+    if seed == 3:  # also visit locations which are neither source nor target
+        events = locations[rng.integers(0, len(locations), n_events)]
+    collection_list = np.concatenate([ids[:, None], events], axis=1)
+    exp = reference_cost_matrix(
+        collection_list, pos_source, pos_target, use_last_only=use_last_only
+    )
+    got = util.collected_resource_list_to_cost_matrix(
+        collection_list, pos_source, pos_target, use_last_only=use_last_only
+    )
+    assert exp.shape == got.shape
+    assert (exp == got).all()
+
+
+def test_collected_resource_list_to_cost_matrix_empty():
+    got = util.collected_resource_list_to_cost_matrix(
+        np.array([]), np.array([[0, 0]]), np.array([[5, 5]])
+    )
+    assert (got == np.zeros((1, 1))).all()
+
+
+def test_cost_matrix_index():
+    pos_source = np.array([[0, 0], [1, 1]])
+    pos_target = np.array([[5, 5], [6, 6]])
+    # [step, id, x, y]: agent 1 moves 0,0 -> 5,5 -> 1,1 -> 6,6, agent 2 6,6 -> 1,1
+    collected_resources = np.array(
+        [
+            [1, 1, 0, 0],
+            [2, 2, 6, 6],
+            [3, 1, 5, 5],
+            [4, 1, 1, 1],
+            [5, 2, 1, 1],
+            [6, 1, 6, 6],
+        ]
+    )
+    index = util.CostMatrixIndex(collected_resources, pos_source, pos_target)
+    assert np.allclose(
+        index.cost_matrix(),
+        util.collected_resource_list_to_cost_matrix(
+            collected_resources[:, 1:], pos_source, pos_target
+        ),
+    )
+    assert (index.cost_matrix(0, 4) == [[1, 0], [0, 0]]).all()
+    assert (index.cost_matrix(4, 7) == [[0, 0], [0, 1]]).all()
+    assert (index.cost_matrix(0, 3) == 0).all(), "no transport completed yet"
+    assert np.allclose(index.cost_matrix(3, None), [[1 / 3, 0], [0, 2 / 3]])
+    assert (index.events_between(2, 4) == collected_resources[1:3]).all()
+    # filtering first cuts the transport of agent 1 from 1,1 (step 4) to 6,6
+    for i, j in [(0, 4), (3, 7), (1, 6)]:
+        window = collected_resources[
+            (collected_resources[:, 0] > i) & (collected_resources[:, 0] < j)
+        ]
+        exp = util.collected_resource_list_to_cost_matrix(
+            window[:, 1:], pos_source, pos_target
+        )
+        assert (index.filtered_cost_matrix(i, j) == exp).all()
+    assert (index.filtered_cost_matrix(4, 7) == 0).all()
+    assert (index.cost_matrix(4, 7) == [[0, 0], [0, 1]]).all()
+
+
+def test_cost_matrix_index_empty():
+    index = util.CostMatrixIndex(np.zeros((0, 4)), [[0, 0]], [[5, 5]])
+    assert (index.cost_matrix(0, 10) == np.zeros((1, 1))).all()
+
+
+@pytest.mark.parametrize("use_last_only", [False, True])
+def test_cost_matrix_accumulator(use_last_only):
+    rng = np.random.default_rng(0)
+    pos_source = rng.integers(0, 5, (4, 2))
+    pos_target = rng.integers(0, 5, (3, 2))
+    # events of 4 agents at the sources, the targets and an unknown location
+    locations = np.concatenate([pos_source, pos_target, [[9, 9]]])
+    events = np.column_stack(
+        [rng.integers(0, 4, 200), locations[rng.integers(0, len(locations), 200)]]
+    )
+    accumulator = util.CostMatrixAccumulator(pos_source, pos_target, use_last_only)
+    assert (accumulator.cost_matrix() == 0).all()
+    bounds = [0, 1, 2, 30, 30, 31, 120, 200]
+    for start, end in zip(bounds, bounds[1:]):
+        accumulator.add(events[start:end])
+        exp = util.collected_resource_list_to_cost_matrix(
+            events[:end], pos_source, pos_target, use_last_only
+        )
+        assert np.allclose(accumulator.cost_matrix(), exp)
+
+    pos_source = np.array([[0, 0], [1, 1]])
+    pos_target = np.array([[5, 5], [6, 6]])
+    # [step, id, x, y] and the event stream of the model with resource ids and types
+    collected_resources = np.array([[1, 1, 0, 0], [2, 2, 6, 6], [3, 1, 5, 5]])
+    events = np.insert(collected_resources, 2, [10, 13, 12], axis=1)
+    events = np.column_stack([events, [0, 1, 1]])
+    exp_M = util.collected_resource_list_to_cost_matrix(
+        collected_resources[:, 1:], pos_source, pos_target
+    )
+    M = util.collected_resource_list_to_cost_matrix(events, pos_source, pos_target)
+    assert (M == exp_M).all()
+    index = util.CostMatrixIndex(events, pos_source, pos_target)
+    assert (index.cost_matrix() == exp_M).all()
+    assert (index.events_between(2, 4) == events[1:]).all(), "rows are kept as-is"
+    index = util.CostMatrixIndex(np.zeros((0, 6)), pos_source, pos_target)
+    assert (index.cost_matrix() == 0).all()
+
+
 @pytest.mark.parametrize(
     "name, M",
     [
@@ -304,3 +494,26 @@ def test__fix_zeros():
             ]
         ),
     )
+
+
+def test_doubly_stochastic_batched():
+    rng = np.random.default_rng(0)
+    M = rng.random((3, 4, 5))
+    M[1, :, 2] = 0
+    M[2, 0] = 0
+    got, iterations = util.doubly_stochastic(M, return_iterations=True)
+    assert 0 < iterations < 1000, "stops at the tolerance"
+    for i in range(len(M)):
+        assert np.allclose(got[i], util.doubly_stochastic(M[i]), atol=1e-9)
+    assert np.allclose(got.sum(axis=-1), 1 / 4)
+    assert np.allclose(got.sum(axis=-2), 1 / 5)
+
+
+def test_doubly_stochastic_in_place():
+    M = np.array([[0.1, 0.2], [0.3, 0.4]])
+    got, iterations = util.doubly_stochastic(
+        M, tol=None, max_iterations=10, out=M, return_iterations=True
+    )
+    assert got is M
+    assert iterations == 10
+    assert np.allclose(M.sum(axis=0), 0.5)